@@ -0,0 +1,44 @@
+'''
+    Fake of the subset of the boto3 API used by the spawner
+    and blobstore.py, backed by fakes3.
+'''
+
+import fakes3
+from botocore.exceptions import ClientError
+
+
+class _Object:
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def put(self, Body, ContentType=None, CacheControl=None):
+        fakes3.put(self.bucket, self.key, data=Body)
+
+
+class _Resource:
+
+    def Object(self, bucket, key):
+        return _Object(bucket, key)
+
+
+class _Client:
+
+    def head_object(self, Bucket, Key):
+        if not fakes3.exists(Bucket, Key):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        fakes3.put(Bucket, Key, src=Filename)
+
+
+def resource(name):
+    assert name == 's3'
+    return _Resource()
+
+
+def client(name):
+    assert name == 's3'
+    return _Client()
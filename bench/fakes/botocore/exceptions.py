@@ -0,0 +1,6 @@
+class ClientError(Exception):
+
+    def __init__(self, error_response, operation_name):
+        super().__init__('%s: %s' % (operation_name,
+                                     error_response['Error']['Code']))
+        self.response = error_response
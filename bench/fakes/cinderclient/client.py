@@ -0,0 +1,49 @@
+'''
+    Fake of the subset of the cinderclient API used by
+    os_provision.py and os_teardown.py.
+'''
+
+import fakestack
+from fakestack import log_call, locked_state
+
+
+class Volume:
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.status = data['status']
+
+    def get(self):
+        log_call('cinder volumes.get')
+        with locked_state() as state:
+            self.status = state['volumes'][self.id]['status']
+
+    def delete(self):
+        log_call('cinder volumes.delete')
+        with locked_state() as state:
+            state['volumes'].pop(self.id)
+
+
+class _Volumes:
+
+    def create(self, name, size):
+        log_call('cinder volumes.create')
+        with locked_state() as state:
+            data = {'id': fakestack.new_id(), 'name': name, 'size': size,
+                    'status': 'available'}
+            state['volumes'][data['id']] = data
+        return Volume(data)
+
+    def get(self, volume_id):
+        log_call('cinder volumes.get')
+        with locked_state() as state:
+            return Volume(state['volumes'][volume_id])
+
+
+class Client:
+
+    def __init__(self, version, *args, **kwargs):
+        self.volumes = _Volumes()
+
+    def authenticate(self):
+        log_call('cinder authenticate')
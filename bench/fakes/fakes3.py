@@ -0,0 +1,42 @@
+'''
+    Local stand-in for S3 shared by the fake boto3 package
+    and the aws shim. Objects are stored as plain files under
+    $PAPR_BENCH_STATE/s3/<bucket>/<key>, and each request is
+    logged to calls.log so that the harness can count them.
+'''
+
+import os
+import shutil
+
+STATE_DIR = os.environ['PAPR_BENCH_STATE']
+S3_DIR = os.path.join(STATE_DIR, 's3')
+
+
+def log_call(api):
+    with open(os.path.join(STATE_DIR, 'calls.log'), 'a') as f:
+        f.write(api + '\n')
+
+
+def path(bucket, key):
+    return os.path.join(S3_DIR, bucket, key)
+
+
+def exists(bucket, key):
+    log_call('s3 HEAD')
+    return os.path.isfile(path(bucket, key))
+
+
+def put(bucket, key, data=None, src=None):
+    "Store an object from either data or the file src."
+
+    log_call('s3 PUT')
+    dst = path(bucket, key)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # write atomically like S3 does
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    if src is not None:
+        shutil.copyfile(src, tmp)
+    else:
+        with open(tmp, 'wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+    os.rename(tmp, dst)
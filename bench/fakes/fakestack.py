@@ -0,0 +1,109 @@
+'''
+    In-memory-ish OpenStack shared by the fake novaclient and
+    cinderclient packages. Since the provisioner and the
+    teardown script run in separate processes, the state is
+    kept in a JSON file in $PAPR_BENCH_STATE, protected by a
+    lock. Each API call is logged to calls.log so that the
+    harness can count them.
+
+    Servers get a guest directory under guests/<addr> which
+    the shims use as the root of the "host". Snapshots of
+    servers are copies of it under images/<id>.
+'''
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import contextlib
+
+STATE_DIR = os.environ['PAPR_BENCH_STATE']
+STATE_FILE = os.path.join(STATE_DIR, 'openstack.json')
+
+# how long servers stay in BUILD
+BOOT_SECS = float(os.environ.get('PAPR_BENCH_BOOT_SECS', '0'))
+
+# how many of the first servers end up in ERROR rather than ACTIVE
+BOOT_FAILURES = int(os.environ.get('PAPR_BENCH_BOOT_FAILURES', '0'))
+
+
+def log_call(api):
+    with open(os.path.join(STATE_DIR, 'calls.log'), 'a') as f:
+        f.write(api + '\n')
+
+
+@contextlib.contextmanager
+def locked_state():
+    with open(STATE_FILE + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(STATE_FILE) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {'servers': {}, 'volumes': {}, 'fips': {},
+                     'next_addr': 1}
+        yield state
+        tmp = STATE_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, STATE_FILE)
+
+
+def new_addr(state):
+    n = state['next_addr']
+    state['next_addr'] += 1
+    return '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+
+
+def make_guest(addr, distro):
+    "Create the root dir of a fake host."
+
+    root = os.path.join(STATE_DIR, 'guests', addr)
+    for d in ['etc', 'run', 'root/.ssh', 'var/tmp', 'var/cache/dnf']:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    with open(os.path.join(root, 'etc/os-release'), 'w') as f:
+        f.write('ID=fedora\nVERSION_ID=27\n')
+    if 'atomic' in distro:
+        open(os.path.join(root, 'run/ostree-booted'), 'w').close()
+
+
+def link_guest(alias, addr):
+    os.symlink(addr, os.path.join(STATE_DIR, 'guests', alias))
+
+
+def remove_guest(addr):
+    path = os.path.join(STATE_DIR, 'guests', addr)
+    if os.path.islink(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def snapshot_guest(addr, image_id):
+    "Save the root dir of a fake host as an image."
+
+    shutil.copytree(os.path.join(STATE_DIR, 'guests', addr),
+                    os.path.join(STATE_DIR, 'images', image_id),
+                    symlinks=True)
+
+
+def restore_guest(addr, image_id):
+    "Create the root dir of a fake host booted from a snapshot."
+
+    shutil.copytree(os.path.join(STATE_DIR, 'images', image_id),
+                    os.path.join(STATE_DIR, 'guests', addr), symlinks=True)
+
+
+def remove_snapshot(image_id):
+    shutil.rmtree(os.path.join(STATE_DIR, 'images', image_id),
+                  ignore_errors=True)
+
+
+def new_id():
+    return str(uuid.uuid4())
+
+
+def now():
+    return time.time()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+'''
+    Fake Kubernetes API server, implementing just what the
+    kube backend uses: creating, getting, listing, watching
+    and deleting Jobs and their pods, and following pod logs.
+
+    Pods are run locally like the containers of the docker
+    shim: in a guest directory, with the volume mounts and
+    guest paths of their command rewritten. Persistent volume
+    claims are mapped to local dirs with --claim NAME=DIR.
+    Images with "missing" in their name fail to be pulled.
+
+    It prints its URL on stdout once it's listening.
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import datetime
+import threading
+import subprocess
+import http.server
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'shims'))
+
+import fakeenv  # noqa: E402
+
+# how long watches last before the client has to re-establish them
+WATCH_SECS = 30
+
+BOOT_SECS = float(os.environ.get('PAPR_BENCH_BOOT_SECS', '0'))
+
+
+class Cluster:
+
+    def __init__(self, claims):
+        self.claims = claims
+        self.lock = threading.Condition()
+        self.version = 0
+        # (kind, name) -> object
+        self.objects = {}
+        # (version, kind, type, object) of all changes
+        self.events = []
+        # pod name -> Popen of its command
+        self.procs = {}
+
+    def now(self):
+        return datetime.datetime.utcnow().isoformat() + 'Z'
+
+    def put(self, kind, obj, type='MODIFIED'):
+        "Store an object and notify watchers; must hold the lock."
+
+        self.version += 1
+        obj['metadata']['resourceVersion'] = str(self.version)
+        self.objects[(kind, obj['metadata']['name'])] = obj
+        self.events.append((self.version, kind, type,
+                            json.loads(json.dumps(obj))))
+        self.lock.notify_all()
+
+    def remove(self, kind, name):
+        obj = self.objects.pop((kind, name), None)
+        if obj is not None:
+            self.put(kind, obj, 'DELETED')
+            del self.objects[(kind, name)]
+
+    def create_job(self, job):
+        fakeenv.log_call('kube POST jobs')
+        name = job['metadata']['name']
+        template = job['spec']['template']
+        pod = {'metadata': {'name': name + '-' + os.urandom(3).hex(),
+                            'labels': dict(template['metadata'].get(
+                                'labels', {}), **{'job-name': name})},
+               'spec': template['spec'],
+               'status': {'phase': 'Pending',
+                          'containerStatuses': [{
+                              'name': 'test',
+                              'state': {'waiting': {
+                                  'reason': 'ContainerCreating'}}}]}}
+        job['status'] = {}
+        with self.lock:
+            if ('jobs', name) in self.objects:
+                return None
+            self.put('jobs', job, 'ADDED')
+            self.put('pods', pod, 'ADDED')
+        threading.Thread(target=self.run_pod, args=(job, pod),
+                         daemon=True).start()
+        return job
+
+    def run_pod(self, job, pod):
+        name = pod['metadata']['name']
+        container = pod['spec']['containers'][0]
+        status = pod['status']['containerStatuses'][0]
+
+        if 'missing' in container['image']:
+            with self.lock:
+                status['state'] = {'waiting': {'reason': 'ErrImagePull'}}
+                self.put('pods', pod)
+            return
+
+        # like pulling the image and creating the container
+        time.sleep(BOOT_SECS)
+
+        root = os.path.join(fakeenv.GUESTS_DIR, name)
+        for d in ['etc', 'run', 'root', 'var/tmp', 'dev']:
+            os.makedirs(os.path.join(root, d))
+        # NB: mounts may well be under e.g. /tmp themselves
+        script = fakeenv.guestify(root, container['command'][-1])
+        for mount in container.get('volumeMounts', []):
+            script = script.replace(mount['mountPath'],
+                                    self.volume_dir(pod, mount, root))
+        script = script.replace('/dev/termination-log',
+                                root + '/dev/termination-log')
+
+        logfile = os.path.join(root, 'pod.log')
+        env = dict(os.environ, PATH=fakeenv.GUEST_BIN + ':' +
+                   os.environ['PATH'])
+        open(logfile, 'wb').close()
+        with self.lock:
+            p = subprocess.Popen(['sh', '-c', script],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, env=env,
+                                 start_new_session=True)
+            self.procs[name] = p
+            status['state'] = {'running': {'startedAt': self.now()}}
+            pod['status']['phase'] = 'Running'
+            self.put('pods', pod)
+
+        deadline = job['spec'].get('activeDeadlineSeconds')
+        timer = None
+        if deadline is not None:
+            timer = threading.Timer(deadline, self.expire, args=(job, pod))
+            timer.start()
+
+        with open(logfile, 'ab') as log:
+            for line in p.stdout:
+                log.write(self.now().encode('utf-8') + b' ' + line)
+                log.flush()
+        rc = p.wait()
+        if rc < 0:
+            # killed by a signal, as a shell would report it
+            rc = 128 - rc
+        if timer is not None:
+            timer.cancel()
+
+        message = ''
+        fn = os.path.join(root, 'dev', 'termination-log')
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                message = f.read()
+
+        with self.lock:
+            if ('jobs', job['metadata']['name']) not in self.objects:
+                return
+            status['state'] = {'terminated': {'exitCode': rc,
+                                              'message': message}}
+            pod['status']['phase'] = 'Succeeded' if rc == 0 else 'Failed'
+            self.put('pods', pod)
+            if job['status'].get('conditions'):
+                return
+            cond = 'Complete' if rc == 0 else 'Failed'
+            job['status']['conditions'] = [{'type': cond, 'status': 'True'}]
+            self.put('jobs', job)
+
+    def volume_dir(self, pod, mount, root):
+        for volume in pod['spec'].get('volumes', []):
+            if volume['name'] != mount['name']:
+                continue
+            if 'persistentVolumeClaim' in volume:
+                claim = volume['persistentVolumeClaim']['claimName']
+                return os.path.join(self.claims[claim],
+                                    mount.get('subPath', ''))
+        # e.g. emptyDir
+        path = os.path.join(root, 'volumes', mount['name'])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def expire(self, job, pod):
+        with self.lock:
+            job['status']['conditions'] = [{'type': 'Failed',
+                                            'status': 'True',
+                                            'reason': 'DeadlineExceeded'}]
+            self.put('jobs', job)
+        self.kill(pod['metadata']['name'])
+
+    def kill(self, pod):
+        p = self.procs.get(pod)
+        if p is not None and p.poll() is None:
+            os.killpg(p.pid, signal.SIGKILL)
+
+    def delete_job(self, name):
+        fakeenv.log_call('kube DELETE jobs')
+        with self.lock:
+            if ('jobs', name) not in self.objects:
+                return False
+            self.remove('jobs', name)
+            pods = [n for (k, n), obj in self.objects.items()
+                    if k == 'pods' and
+                    obj['metadata']['labels'].get('job-name') == name]
+            for pod in pods:
+                self.remove('pods', pod)
+        for pod in pods:
+            self.kill(pod)
+        return True
+
+
+def matches(obj, query):
+    "Whether an object matches the label and field selectors of a query."
+
+    for sel in query.get('labelSelector', []):
+        key, val = sel.split('=', 1)
+        if obj['metadata'].get('labels', {}).get(key) != val:
+            return False
+    for sel in query.get('fieldSelector', []):
+        key, val = sel.split('=', 1)
+        assert key == 'metadata.name'
+        if obj['metadata']['name'] != val:
+            return False
+    return True
+
+
+def make_handler(cluster):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def parse(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            # /api/v1/namespaces/NS/KIND[/NAME[/SUB]]
+            # /apis/batch/v1/namespaces/NS/KIND[/NAME]
+            parts = url.path.strip('/').split('/')
+            parts = parts[parts.index('namespaces') + 2:]
+            return parts + [None] * (3 - len(parts)), query
+
+        def do_POST(self):
+            (kind, _, _), _ = self.parse()
+            length = int(self.headers['Content-Length'])
+            job = json.loads(self.rfile.read(length))
+            job = cluster.create_job(job)
+            if job is None:
+                self.reply(409, {'reason': 'AlreadyExists'})
+            else:
+                self.reply(201, job)
+
+        def do_DELETE(self):
+            (kind, name, _), _ = self.parse()
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+            if cluster.delete_job(name):
+                self.reply(200, {'kind': 'Status', 'status': 'Success'})
+            else:
+                self.reply(404, {'reason': 'NotFound'})
+
+        def do_GET(self):
+            (kind, name, sub), query = self.parse()
+            if sub == 'log':
+                return self.logs(name, query)
+            if name is not None:
+                fakeenv.log_call('kube GET ' + kind)
+                with cluster.lock:
+                    obj = cluster.objects.get((kind, name))
+                if obj is None:
+                    return self.reply(404, {'reason': 'NotFound'})
+                return self.reply(200, obj)
+            if query.get('watch') == ['1']:
+                return self.watch(kind, query)
+            fakeenv.log_call('kube LIST ' + kind)
+            with cluster.lock:
+                items = [obj for (k, _), obj in cluster.objects.items()
+                         if k == kind and matches(obj, query)]
+                version = str(cluster.version)
+            self.reply(200, {'items': items,
+                             'metadata': {'resourceVersion': version}})
+
+        def watch(self, kind, query):
+            fakeenv.log_call('kube WATCH ' + kind)
+            version = int(query.get('resourceVersion', ['0'])[0])
+            self.start_stream()
+            end = time.time() + WATCH_SECS
+            while time.time() < end:
+                with cluster.lock:
+                    events = [e for e in cluster.events if e[0] > version
+                              and e[1] == kind and matches(e[3], query)]
+                    if not events:
+                        version = cluster.version
+                        cluster.lock.wait(end - time.time())
+                        continue
+                    version = events[-1][0]
+                for _, _, type, obj in events:
+                    if not self.send_line(json.dumps({'type': type,
+                                                      'object': obj})):
+                        return
+
+        def logs(self, name, query):
+            fakeenv.log_call('kube GET log')
+            since = query.get('sinceTime', [''])[0]
+            logfile = os.path.join(fakeenv.GUESTS_DIR, name, 'pod.log')
+            self.start_stream()
+            pos = 0
+            while True:
+                with cluster.lock:
+                    pod = cluster.objects.get(('pods', name))
+                    done = pod is None or 'terminated' in \
+                        pod['status']['containerStatuses'][0]['state']
+                if os.path.isfile(logfile):
+                    with open(logfile, 'rb') as f:
+                        f.seek(pos)
+                        for line in f:
+                            if not line.endswith(b'\n'):
+                                break
+                            pos += len(line)
+                            if line.decode('utf-8').split(' ')[0] < since:
+                                continue
+                            if not self.send_line(line.rstrip(b'\n')):
+                                return
+                if done:
+                    return
+                time.sleep(0.1)
+
+        def start_stream(self):
+            # HTTP/1.0: the stream ends when we close the connection
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+
+        def send_line(self, line):
+            if isinstance(line, str):
+                line = line.encode('utf-8')
+            try:
+                self.wfile.write(line + b'\n')
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return False
+            return True
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Kubernetes API")
+    parser.add_argument('--claim', action='append', default=[],
+                        metavar='NAME=DIR', help="persistent volume claim")
+    args = parser.parse_args()
+
+    claims = dict([c.split('=', 1) for c in args.claim])
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), make_handler(Cluster(claims)))
+    print('http://127.0.0.1:%d' % server.server_port, flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+'''
+    Fake of the subset of the novaclient API used by
+    os_provision.py and os_teardown.py.
+'''
+
+import os
+import re
+
+import fakestack
+from fakestack import log_call, locked_state
+from novaclient import exceptions
+
+FLAVORS = [('m1.small', 2048, 1, 20, 0),
+           ('m1.medium', 4096, 2, 40, 0),
+           ('m1.large', 8192, 4, 80, 0)]
+
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Server:
+
+    def __init__(self, data):
+        self._load(data)
+
+    def _load(self, data):
+        self.id = data['id']
+        self.name = data['name']
+        self.networks = {data['network']: [data['addr']]}
+        self.status = 'ACTIVE'
+        if fakestack.now() < data['created'] + fakestack.BOOT_SECS:
+            self.status = 'BUILD'
+        elif data.get('failed'):
+            self.status = 'ERROR'
+
+    def get(self):
+        log_call('nova servers.get')
+        with locked_state() as state:
+            if self.id not in state['servers']:
+                raise exceptions.NotFound()
+            self._load(state['servers'][self.id])
+
+    def delete(self):
+        log_call('nova servers.delete')
+        with locked_state() as state:
+            data = state['servers'].pop(self.id)
+        fakestack.remove_guest(data['addr'])
+
+    def add_floating_ip(self, fip):
+        log_call('nova servers.add_floating_ip')
+        with locked_state() as state:
+            state['fips'][fip.ip]['instance_id'] = self.id
+            addr = state['servers'][self.id]['addr']
+        # make the guest reachable through its floating ip too
+        fakestack.link_guest(fip.ip, addr)
+
+    def remove_floating_ip(self, ip):
+        log_call('nova servers.remove_floating_ip')
+        with locked_state() as state:
+            state['fips'][ip]['instance_id'] = None
+        fakestack.remove_guest(ip)
+
+
+class Image:
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.name = data['name']
+        self.metadata = dict(data['metadata'])
+        self.status = 'ACTIVE'
+        if fakestack.now() < data['created'] + fakestack.BOOT_SECS:
+            self.status = 'SAVING'
+
+
+class _Servers:
+
+    def create(self, name, meta=None, image=None, userdata=None,
+               flavor=None, key_name=None, nics=None):
+        log_call('nova servers.create')
+        with locked_state() as state:
+            data = {'id': fakestack.new_id(), 'name': name,
+                    'network': os.environ.get('os_network', 'private'),
+                    'addr': fakestack.new_addr(state),
+                    'created': fakestack.now(), 'volumes': []}
+            state['servers'][data['id']] = data
+            nfailed = state.get('failed_boots', 0)
+            if nfailed < fakestack.BOOT_FAILURES:
+                data['failed'] = True
+                state['failed_boots'] = nfailed + 1
+            snapshot = image.id in state.setdefault('images', {})
+        if snapshot:
+            fakestack.restore_guest(data['addr'], image.id)
+        else:
+            fakestack.make_guest(data['addr'], image.name)
+        return Server(data)
+
+    def create_image(self, server, name, metadata=None):
+        log_call('nova servers.create_image')
+        with locked_state() as state:
+            data = {'id': fakestack.new_id(), 'name': name,
+                    'metadata': metadata or {}, 'created': fakestack.now()}
+            state.setdefault('images', {})[data['id']] = data
+            addr = state['servers'][server.id]['addr']
+        fakestack.snapshot_guest(addr, data['id'])
+        return data['id']
+
+    def findall(self, name=None):
+        log_call('nova servers.findall')
+        with locked_state() as state:
+            return [Server(s) for s in state['servers'].values()
+                    if name is None or s['name'] == name]
+
+    def find(self, name):
+        log_call('nova servers.find')
+        with locked_state() as state:
+            for s in state['servers'].values():
+                if s['name'] == name:
+                    return Server(s)
+        raise exceptions.NotFound()
+
+    def list(self, search_opts=None):
+        log_call('nova servers.list')
+        regex = re.compile((search_opts or {}).get('name', ''))
+        with locked_state() as state:
+            return [Server(s) for s in state['servers'].values()
+                    if regex.search(s['name'])]
+
+
+class _Images:
+
+    def findall(self, name):
+        log_call('nova images.findall')
+        with locked_state() as state:
+            snapshots = [Image(i) for i in state.get('images', {}).values()
+                         if i['name'] == name]
+        # any other name is a base image
+        return snapshots or [_Obj(id=name, name=name, metadata={})]
+
+    def list(self):
+        log_call('nova images.list')
+        with locked_state() as state:
+            return [Image(i) for i in state.get('images', {}).values()]
+
+    def get(self, image_id):
+        log_call('nova images.get')
+        with locked_state() as state:
+            if image_id not in state.get('images', {}):
+                raise exceptions.NotFound()
+            return Image(state['images'][image_id])
+
+    def set_meta(self, image, metadata):
+        log_call('nova images.set_meta')
+        with locked_state() as state:
+            state['images'][image.id]['metadata'].update(metadata)
+
+    def delete(self, image):
+        log_call('nova images.delete')
+        with locked_state() as state:
+            state.get('images', {}).pop(image.id, None)
+        fakestack.remove_snapshot(image.id)
+
+
+class _Flavors:
+
+    def findall(self):
+        log_call('nova flavors.findall')
+        return [_Obj(name=name, ram=ram, vcpus=vcpus, disk=disk,
+                     ephemeral=ephemeral)
+                for name, ram, vcpus, disk, ephemeral in FLAVORS]
+
+
+class _Networks:
+
+    def find(self, label):
+        log_call('nova networks.find')
+        return _Obj(id=label, label=label)
+
+
+class _Volumes:
+
+    def create_server_volume(self, server_id, volume_id):
+        log_call('nova volumes.create_server_volume')
+        with locked_state() as state:
+            state['servers'][server_id]['volumes'].append(volume_id)
+            state['volumes'][volume_id]['status'] = 'in-use'
+
+    def delete_server_volume(self, server_id, volume_id):
+        log_call('nova volumes.delete_server_volume')
+        with locked_state() as state:
+            state['servers'][server_id]['volumes'].remove(volume_id)
+            state['volumes'][volume_id]['status'] = 'available'
+
+    def get_server_volumes(self, server_id):
+        log_call('nova volumes.get_server_volumes')
+        with locked_state() as state:
+            return [_Obj(id=v)
+                    for v in state['servers'][server_id]['volumes']]
+
+
+class _FloatingIPs:
+
+    def create(self, pool):
+        log_call('nova floating_ips.create')
+        with locked_state() as state:
+            fip = {'ip': fakestack.new_addr(state), 'instance_id': None}
+            state['fips'][fip['ip']] = fip
+        return _Obj(**fip)
+
+    def list(self):
+        log_call('nova floating_ips.list')
+        with locked_state() as state:
+            return [_Obj(**f) for f in state['fips'].values()]
+
+    def findall(self, ip):
+        log_call('nova floating_ips.findall')
+        with locked_state() as state:
+            return [_Obj(**f) for f in state['fips'].values()
+                    if f['ip'] == ip]
+
+    def delete(self, fip):
+        log_call('nova floating_ips.delete')
+        with locked_state() as state:
+            state['fips'].pop(fip.ip, None)
+
+
+class Client:
+
+    def __init__(self, version, **kwargs):
+        self.servers = _Servers()
+        self.images = _Images()
+        self.flavors = _Flavors()
+        self.networks = _Networks()
+        self.volumes = _Volumes()
+        self.floating_ips = _FloatingIPs()
+
+    def authenticate(self):
+        log_call('nova authenticate')
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+'''
+    Check that the entry points which each run starts many
+    times over import quickly, using `python -X importtime`.
+    Each is imported the way its script would be, a few
+    times, and the median of its cumulative import time is
+    compared against its budget. We also check that the
+    heavy dependencies which only some code paths need
+    aren't loaded upfront. See README.md for details.
+'''
+
+import os
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+
+# (module, dir it's imported from as a script or None if
+# it's imported from the top dir, budget in ms, modules it
+# must not import)
+ENTRY_POINTS = [
+    ('papr.spawner', None, 400, ['boto3', 'jinja2', 'requests', 'cProfile']),
+    ('gh', 'papr/utils', 50, ['requests', 'simplejson', 'cProfile']),
+    ('httpcache', 'papr/utils', 60, ['requests']),
+]
+
+# e.g. "import time:       112 |        340 |   papr.utils.gh"
+IMPORTTIME_RE = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| *(\S+)$')
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+
+    failed = False
+    print("%-16s %8s %8s  %s" % ("MODULE", "MEDIAN", "BUDGET", "NOTES"))
+    for module, path, budget, forbidden in ENTRY_POINTS:
+        budget *= args.scale
+        times, loaded = measure(module, path, args.runs)
+        median = statistics.median(times)
+        notes = ["loads %s" % m for m in forbidden if m in loaded]
+        if median > budget:
+            notes.append("over budget")
+        failed = failed or len(notes) > 0
+        print("%-16s %6dms %6dms  %s" % (module, median, budget,
+                                         ', '.join(notes)))
+
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check import times")
+    parser.add_argument('--runs', type=int, default=5, metavar='N',
+                        help="number of imports per module (default: 5)")
+    parser.add_argument('--scale', type=float, default=1, metavar='F',
+                        help="multiply all budgets by F, e.g. on slow "
+                        "machines (default: 1)")
+    return parser.parse_args()
+
+
+def measure(module, path, runs):
+    "Returns the cumulative import times in ms and the modules loaded."
+
+    code = 'import %s' % module
+    if path is not None:
+        code = 'import sys; sys.path.insert(0, %r); %s' % (path, code)
+
+    times = []
+    loaded = set()
+    for _ in range(runs):
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                           cwd=TOP_DIR, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, universal_newlines=True,
+                           check=True)
+        for line in p.stderr.splitlines():
+            m = IMPORTTIME_RE.match(line)
+            if m is None:
+                continue
+            loaded.add(m.group(2).split('.')[0])
+            if m.group(2) == module:
+                times.append(int(m.group(1)) / 1000)
+    return times, loaded
+
+
+if __name__ == '__main__':
+    sys.exit(main())
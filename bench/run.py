@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmark the whole pipeline (main -> spawner ->
+    testrunners -> provisioner) end-to-end against local
+    stand-ins for GitHub, OpenStack and docker. See
+    README.md for details.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import textwrap
+import threading
+import subprocess
+import collections
+import http.server
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+TOP_DIR = os.path.dirname(BENCH_DIR)
+
+REPO = 'bench/repo'
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='papr-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    print("INFO: working in %s" % workdir, file=sys.stderr)
+
+    github = GitHubStub()
+    results = []
+    try:
+        for i in range(args.repeat):
+            rundir = os.path.join(workdir, 'run-%d' % i)
+            results.append(bench(args, rundir, github))
+    finally:
+        github.shutdown()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for result in results:
+            print_report(result)
+
+    ok = all(r['rc'] == 0 and r['failures'] == 0 for r in results)
+    return 0 if ok else 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark PAPR runs")
+    parser.add_argument('--suites', type=int, default=10, metavar='N',
+                        help="number of testsuites (default: 10)")
+    parser.add_argument('--env', choices=['container', 'host', 'cluster'],
+                        default='container',
+                        help="type of test environment (default: container)")
+    parser.add_argument('--cluster-size', type=int, default=2, metavar='N',
+                        help="number of hosts per cluster (default: 2)")
+    parser.add_argument('--tests', type=int, default=3, metavar='N',
+                        help="number of test commands per suite (default: 3)")
+    parser.add_argument('--test-cmd', default='true', metavar='CMD',
+                        help="test command to run (default: true)")
+    parser.add_argument('--parallel', action='store_true',
+                        help="run the test commands as one parallel group")
+    parser.add_argument('--ostree', metavar='REVISION',
+                        help="deploy this ostree revision on hosts")
+    parser.add_argument('--artifacts', type=int, default=0, metavar='N',
+                        help="number of ~1M artifacts per suite, the same "
+                        "in all suites (default: 0)")
+    parser.add_argument('--s3', action='store_true',
+                        help="upload results to a fake S3")
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help="run suites through a work queue served by N "
+                        "local workers")
+    parser.add_argument('--kube', action='store_true',
+                        help="run container suites on a fake Kubernetes")
+    parser.add_argument('--pull', action='store_true',
+                        help="test a PR rather than a branch")
+    parser.add_argument('--boot-secs', type=float, default=0, metavar='SECS',
+                        help="how long fake servers take to boot")
+    parser.add_argument('--boot-failures', type=int, default=0, metavar='N',
+                        help="make the first N fake servers fail to boot")
+    parser.add_argument('--var', action='append', default=[],
+                        metavar='KEY=VAL', help="extra env var for main, "
+                        "e.g. max_runners=4")
+    parser.add_argument('--repeat', type=int, default=1, metavar='N',
+                        help="number of runs (default: 1)")
+    parser.add_argument('--workdir', help="work in this dir and keep it")
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the work dir")
+    parser.add_argument('--json', action='store_true',
+                        help="output results as JSON")
+    return parser.parse_args()
+
+
+def gen_papr_yml(args):
+    "Generate a .papr.yml with the requested number and type of suites."
+
+    if args.env == 'container':
+        env = "container:\n  image: fedora:27\n"
+    elif args.env == 'host':
+        env = "host:\n  distro: fedora/27/atomic\n"
+        if args.ostree:
+            env += "  ostree:\n    revision: %s\n" % json.dumps(args.ostree)
+    else:
+        env = "cluster:\n  hosts:\n"
+        for i in range(args.cluster_size):
+            env += "    - name: host%d\n      distro: fedora/27/cloud\n" % i
+        env += "  container:\n    image: fedora:27\n"
+
+    # JSON strings are valid YAML and keep e.g. 'true' a string
+    if args.parallel:
+        tests = "  - %s\n" % json.dumps([args.test_cmd] * args.tests)
+    else:
+        tests = ''.join(["  - %s\n" % json.dumps(args.test_cmd)] * args.tests)
+    if args.artifacts:
+        tests += "  - %s\n" % json.dumps(
+            "mkdir -p out && for i in $(seq %d); do "
+            "seq -f $i-%%g 120000 > out/$i.bin; done" % args.artifacts)
+        tests += "artifacts:\n  - out\n"
+
+    docs = []
+    for i in range(args.suites):
+        docs.append("%scontext: suite-%d\ntests:\n%s" % (env, i, tests))
+    return '---\n'.join(docs)
+
+
+GIT = ['git', '-c', 'user.name=PAPR Bench', '-c', 'user.email=bench@papr']
+
+
+def git(*args, cwd):
+    subprocess.check_call(GIT + list(args), cwd=cwd,
+                          stdout=subprocess.DEVNULL)
+
+
+def make_origin(args, origin):
+    "Create the repo to test, including the refs GitHub creates for PRs."
+
+    os.makedirs(origin)
+    git('init', '-q', '-b', 'master', cwd=origin)
+    with open(os.path.join(origin, '.papr.yml'), 'w') as f:
+        f.write(gen_papr_yml(args))
+    with open(os.path.join(origin, 'README'), 'w') as f:
+        f.write("benchmark\n")
+    git('add', '.', cwd=origin)
+    git('commit', '-q', '-m', 'Initial commit', cwd=origin)
+
+    if args.pull:
+        git('checkout', '-q', '-b', 'pr', cwd=origin)
+        with open(os.path.join(origin, 'README'), 'a') as f:
+            f.write("change\n")
+        git('commit', '-q', '-am', 'Change', cwd=origin)
+        git('update-ref', 'refs/pull/1/head', 'pr', cwd=origin)
+        tree = subprocess.check_output(['git', 'rev-parse', 'pr^{tree}'],
+                                       cwd=origin).decode().strip()
+        merge = subprocess.check_output(GIT + ['commit-tree', tree,
+                                               '-p', 'master', '-p', 'pr',
+                                               '-m', 'Merge'],
+                                        cwd=origin).decode().strip()
+        git('update-ref', 'refs/pull/1/merge', merge, cwd=origin)
+        git('checkout', '-q', 'master', cwd=origin)
+
+
+def bench(args, rundir, github):
+
+    state_dir = os.path.join(rundir, 'bench-state')
+    origin = os.path.join(rundir, 'origin')
+    os.makedirs(state_dir)
+    make_origin(args, origin)
+
+    # main only clones if there's no checkout yet, so give it one
+    # pointing at our origin
+    checkout = os.path.join(rundir, 'checkouts', REPO)
+    subprocess.check_call(['git', 'clone', '-q', origin, checkout])
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': os.path.join(BENCH_DIR, 'shims') + ':' + env['PATH'],
+        'PYTHONPATH': os.path.join(BENCH_DIR, 'fakes') + ':' + TOP_DIR,
+        'PAPR_BENCH_STATE': state_dir,
+        'PAPR_BENCH_BOOT_SECS': str(args.boot_secs),
+        'PAPR_BENCH_BOOT_FAILURES': str(args.boot_failures),
+        'github_repo': REPO,
+        'github_token': 'bench',
+        'github_api_url': github.url,
+        'os_keyname': 'bench',
+        'os_network': 'private',
+        'os_privkey': 'bench',
+        'OS_AUTH_URL': 'http://127.0.0.1:1/',
+        'OS_TENANT_ID': 'bench',
+        'OS_TENANT_NAME': 'bench',
+        'OS_USERNAME': 'bench',
+        'OS_PASSWORD': 'bench',
+        'BUILD_ID': str(os.getpid()),
+    })
+    if args.s3:
+        env['s3_prefix'] = 'bench-bucket/papr'
+    if args.pull:
+        env['github_pull_id'] = '1'
+    else:
+        env['github_branch'] = 'master'
+
+    kube = None
+    if args.kube:
+        checkouts = os.path.join(rundir, 'kube-checkouts')
+        os.makedirs(checkouts)
+        kubeapi = os.path.join(BENCH_DIR, 'fakes', 'kubeapi.py')
+        kube = subprocess.Popen([sys.executable, kubeapi,
+                                 '--claim', 'papr-checkouts=' + checkouts],
+                                env=env, stdout=subprocess.PIPE)
+        env.update({'kube_api_url': kube.stdout.readline().decode().strip(),
+                    'kube_checkout_claim': 'papr-checkouts',
+                    'kube_checkout_dir': checkouts})
+
+    for var in args.var:
+        key, val = var.split('=', 1)
+        env[key] = val
+
+    workers = []
+    if args.workers:
+        env['work_queue'] = os.path.join(rundir, 'queue.sqlite')
+        for i in range(args.workers):
+            workdir = os.path.join(rundir, 'worker-%d' % i)
+            # like main, workers only clone if there's no mirror yet
+            subprocess.check_call(['git', 'clone', '-q', '--bare', origin,
+                                   os.path.join(workdir, 'checkouts', REPO)])
+            log = open(os.path.join(workdir, 'worker.log'), 'w')
+            workers.append(subprocess.Popen(
+                [sys.executable, '-m', 'papr.utils.workqueue', 'work'],
+                cwd=workdir, env=env, stdin=subprocess.DEVNULL,
+                stdout=log, stderr=subprocess.STDOUT))
+            log.close()
+
+    github.reset()
+    forks_before = read_forks()
+    start = time.time()
+    try:
+        with open(os.path.join(rundir, 'output.log'), 'w') as log:
+            p = subprocess.Popen([os.path.join(TOP_DIR, 'papr', 'main')],
+                                 cwd=rundir, env=env,
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=log, stderr=subprocess.STDOUT)
+            peak = ProcessSampler(p.pid)
+            rc = p.wait()
+            peak.stop()
+    finally:
+        if kube is not None:
+            kube.terminate()
+            kube.wait()
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+    wall = time.time() - start
+    forks = read_forks() - forks_before
+
+    failures = None
+    fn = os.path.join(rundir, 'state', 'failures')
+    if os.path.isfile(fn):
+        with open(fn) as f:
+            failures = int(f.read())
+
+    calls = collections.Counter()
+    fn = os.path.join(state_dir, 'calls.log')
+    if os.path.isfile(fn):
+        with open(fn) as f:
+            calls.update(line.strip() for line in f)
+
+    return {'rc': rc, 'wall_secs': round(wall, 3), 'failures': failures,
+            'processes': forks, 'peak_processes': peak.peak,
+            'github_calls': dict(github.calls), 'calls': dict(calls),
+            'rundir': rundir}
+
+
+def read_forks():
+    "Returns the number of processes created since boot."
+
+    # NB: this is system-wide, so keep the machine otherwise idle
+    with open('/proc/stat') as f:
+        for line in f:
+            if line.startswith('processes '):
+                return int(line.split()[1])
+    return 0
+
+
+class ProcessSampler:
+    "Track the peak number of processes descended from a pid."
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.done.wait(0.05):
+            self.peak = max(self.peak, self._count())
+
+    def _count(self):
+        children = collections.defaultdict(list)
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % pid) as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # the comm field may contain spaces, so skip past it
+            ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+            children[ppid].append(int(pid))
+
+        n = 0
+        todo = [self.pid]
+        while todo:
+            pid = todo.pop()
+            n += 1
+            todo += children.get(pid, [])
+        return n
+
+
+class GitHubStub:
+    "Minimal GitHub API answering the requests we make."
+
+    def __init__(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                # only used to find the target branch of PRs
+                stub.count('GET', self.path)
+                self.reply(200, {'base': {'ref': 'master'}})
+
+            def do_POST(self):
+                stub.count('POST', self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                self.reply(201, {})
+
+            def reply(self, code, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-RateLimit-Limit', '5000')
+                self.send_header('X-RateLimit-Remaining', '5000')
+                self.send_header('X-RateLimit-Reset',
+                                 str(int(time.time()) + 3600))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def count(self, method, path):
+        # e.g. POST /repos/o/r/statuses/<sha> -> POST statuses
+        kind = path.split('?')[0].split('/')
+        kind = kind[4] if len(kind) > 4 else path
+        with self.lock:
+            self.calls['%s %s' % (method, kind)] += 1
+
+    def reset(self):
+        with self.lock:
+            self.calls = collections.Counter()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def print_report(result):
+    print(textwrap.dedent("""\
+        rc:               %(rc)d
+        failed suites:    %(failures)s
+        wall time:        %(wall_secs).2fs
+        processes:        %(processes)d (peak %(peak_processes)d)""" %
+                          result))
+    print("GitHub API calls: %d" % sum(result['github_calls'].values()))
+    for call, n in sorted(result['github_calls'].items()):
+        print("  %-36s %d" % (call, n))
+    print("fake env calls:   %d" % sum(result['calls'].values()))
+    for call, n in sorted(result['calls'].items()):
+        print("  %-36s %d" % (call, n))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
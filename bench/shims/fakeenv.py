@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+'''
+    Stand-in for the docker, ssh, scp, rsync, ssh-keyscan, nc
+    and aws commands, dispatched on the name we're invoked as.
+
+    Test environments (containers and OpenStack servers) are
+    just directories under $PAPR_BENCH_STATE/guests. Commands
+    "in" them are run locally, with absolute paths under
+    /etc, /root, /run, /tmp and /var rewritten to point into
+    the guest directory, and with the guest/bin dir first in
+    $PATH. The latter has stubs for the few distro tools the
+    testrunner calls (yum, rpm-ostree, ...) and makes sh be
+    bash as on the distros we support.
+'''
+
+import os
+import re
+import sys
+import uuid
+import fnmatch
+import shutil
+import subprocess
+
+STATE_DIR = os.environ['PAPR_BENCH_STATE']
+GUESTS_DIR = os.path.join(STATE_DIR, 'guests')
+GUEST_BIN = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'guest', 'bin')
+
+GUEST_PATH_RE = re.compile(r'(?<![\w./-])/(?:etc|root|run|tmp|var)\b')
+
+
+def log_call(cmd):
+    with open(os.path.join(STATE_DIR, 'calls.log'), 'a') as f:
+        f.write(cmd + '\n')
+
+
+def guestify(root, s):
+    "Rewrite guest absolute paths in s to be under root."
+
+    def repl(m):
+        # leave alone paths which already point into the state dir
+        if s.startswith(STATE_DIR, m.start()):
+            return m.group(0)
+        return root + m.group(0)
+    return GUEST_PATH_RE.sub(repl, s)
+
+
+def run_in_guest(root, args, script=None):
+    env = dict(os.environ)
+    env['PATH'] = GUEST_BIN + ':' + env['PATH']
+    env['PAPR_BENCH_GUEST_ROOT'] = root
+    if script is not None:
+        args = ['sh', '-c', guestify(root, script)]
+    elif len(args) == 2 and args[0] == 'sh':
+        # a script file (e.g. worker.sh) which itself uses guest paths
+        with open(guestify(root, args[1])) as f:
+            args = ['sh', '-c', guestify(root, f.read())]
+    else:
+        args = [guestify(root, arg) for arg in args]
+    return subprocess.call(args, env=env)
+
+
+def copy(src, dst):
+    "Copy with docker cp/rsync semantics: 'dir/.' copies the contents."
+
+    if src.endswith('/.') or src.endswith('/'):
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+    elif os.path.isdir(src):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+    else:
+        shutil.copy(src, dst)
+
+
+def guest_root(name):
+    root = os.path.join(GUESTS_DIR, name)
+    if not os.path.isdir(root):
+        return None
+    return root
+
+
+def resolve(spec, sep=':'):
+    "Resolve '<guest>:<path>' to a local path; plain paths are kept."
+
+    if sep not in spec or spec.startswith('/') or spec.startswith('.'):
+        return spec
+    name, path = spec.split(sep, 1)
+    name = name.split('@')[-1]
+    root = guest_root(name)
+    if root is None:
+        sys.exit("fakeenv: no such guest: %s" % name)
+    return root + path
+
+
+def docker(args):
+    cmd = args[0]
+    log_call('docker ' + cmd)
+    if cmd == 'pull':
+        return 0
+    elif cmd == 'run':
+        cid = uuid.uuid4().hex
+        root = os.path.join(GUESTS_DIR, cid)
+        for d in ['etc', 'run', 'root', 'var/tmp', 'var/cache/dnf']:
+            os.makedirs(os.path.join(root, d))
+        with open(os.path.join(root, 'etc/os-release'), 'w') as f:
+            f.write('ID=fedora\nVERSION_ID=27\n')
+        cidfile = args[args.index('--cidfile') + 1]
+        with open(cidfile, 'w') as f:
+            f.write(cid)
+        print(cid)
+        return 0
+    elif cmd == 'exec':
+        root = guest_root(args[1])
+        if root is None:
+            sys.exit("fakeenv: no such container: %s" % args[1])
+        return run_in_guest(root, args[2:])
+    elif cmd == 'cp':
+        copy(resolve(args[1]), resolve(args[2]))
+        return 0
+    elif cmd == 'rm':
+        for cid in [a for a in args[1:] if not a.startswith('-')]:
+            shutil.rmtree(os.path.join(GUESTS_DIR, cid), ignore_errors=True)
+        return 0
+    sys.exit("fakeenv: unsupported docker command: %s" % cmd)
+
+
+def split_ssh_args(args):
+    "Returns the (destination, command) of an ssh command line."
+
+    i = 0
+    while i < len(args) and args[i].startswith('-'):
+        # options which take an argument
+        if args[i] in ['-i', '-o', '-p', '-F', '-l']:
+            i += 1
+        i += 1
+    return args[i], args[i + 1:]
+
+
+def ssh(args):
+    log_call('ssh')
+    dest, cmd = split_ssh_args(args)
+    root = guest_root(dest.split('@')[-1])
+    if root is None:
+        print("ssh: connect to host %s port 22: No route to host" % dest,
+              file=sys.stderr)
+        return 255
+    if cmd == ['sh']:
+        return run_in_guest(root, None, sys.stdin.read())
+    if len(cmd) == 2 and cmd[0] == 'sh':
+        return run_in_guest(root, cmd)
+    # like real ssh, the command is passed to a shell
+    return run_in_guest(root, None, ' '.join(cmd))
+
+
+def scp(args):
+    log_call('scp')
+    paths = [a for a in args if not a.startswith('-')]
+    # drop the arguments of options
+    for i, a in enumerate(args):
+        if a in ['-i', '-o', '-P', '-F'] and args[i + 1] in paths:
+            paths.remove(args[i + 1])
+    *srcs, dst = paths
+    for src in srcs:
+        copy(resolve(src), resolve(dst))
+    return 0
+
+
+def rsync(args):
+    log_call('rsync')
+    paths = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a == '-e':
+            skip = True
+        elif not a.startswith('-'):
+            paths.append(a)
+    *srcs, dst = paths
+    dst = resolve(dst)
+    for src in srcs:
+        copy(resolve(src), dst)
+    return 0
+
+
+def ssh_keyscan(args):
+    log_call('ssh-keyscan')
+    for addr in args:
+        if guest_root(addr) is not None:
+            print("%s ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQCfake" % addr)
+    return 0
+
+
+def nc(args):
+    # sshwait only uses this to check for an SSH banner
+    log_call('nc')
+    hosts = [a for a in args if not a.startswith('-') and a != '22']
+    hosts = [h for h in hosts if not re.match(r'^[0-9]+m?s$', h)]
+    if guest_root(hosts[-1]) is None:
+        print("Ncat: Connection refused.")
+        return 1
+    sys.stdin.read()
+    print("SSH-2.0-OpenSSH_7.4 fake")
+    return 0
+
+
+def aws(args):
+    # only `aws s3 sync DIR s3://BUCKET/PREFIX`, through fakes3
+    import fakes3
+
+    assert args[:2] == ['s3', 'sync']
+    filters = []
+    paths = []
+    i = 2
+    while i < len(args):
+        if args[i] in ['--exclude', '--include']:
+            filters.append((args[i] == '--include', args[i + 1]))
+            i += 1
+        elif args[i] == '--content-type':
+            i += 1
+        else:
+            paths.append(args[i])
+        i += 1
+    src, dst = paths
+    bucket, _, prefix = dst[len('s3://'):].partition('/')
+
+    for dirpath, _, files in os.walk(src):
+        for fn in files:
+            path = os.path.relpath(os.path.join(dirpath, fn), src)
+            # like aws, later filters take precedence
+            included = True
+            for include, pattern in filters:
+                if fnmatch.fnmatch(path, pattern):
+                    included = include
+            if included:
+                fakes3.put(bucket, os.path.join(prefix, path),
+                           src=os.path.join(dirpath, fn))
+    return 0
+
+
+COMMANDS = {'docker': docker, 'ssh': ssh, 'scp': scp, 'rsync': rsync,
+            'ssh-keyscan': ssh_keyscan, 'nc': nc, 'aws': aws}
+
+
+if __name__ == '__main__':
+    sys.exit(COMMANDS[os.path.basename(sys.argv[0])](sys.argv[1:]))
@@ -8,76 +8,69 @@ import re
 import time
 import yaml
 import traceback
+import copy
 import argparse
+import tempfile
 import subprocess
 
 # XXX: switch to relative imports when we're a proper module
 from papr import PKG_DIR
 import papr.utils.parser as paprparser
+import papr.utils.kube as kube
 
 GH_NAME_REGEX = re.compile('^[A-Za-z0-9_.-]+$')
 
-def paprsuite2kubejob(gh_org, gh_repo, commitsha, suiteidx, suite):
+def paprsuite2kubejob(gh_org, gh_repo, commitsha, suiteidx, suite,
+                      checkout_claim=None, checkout_subpath=None):
     commitsha_short = commitsha[0:10]
     name = 'papr-{}-{}-{}-{}'.format(gh_org, gh_repo, commitsha_short, suiteidx)
-    metadata = {'name': name}
-    cmd = 'set -xeuo pipefail\n'
-    for test in suite['tests']:
-        cmd += test + '\n'
+    name = name.lower().replace('_', '-').replace('.', '-')[:63]
+
+    # reuse the script the kube backend runs, which handles packages, env,
+    # build, etc... from the flushed suite
+    with tempfile.TemporaryDirectory() as tmpd:
+        parsed = os.path.join(tmpd, 'parsed')
+        paprparser.flush_suite(suite, parsed)
+        script = kube.suite_script(parsed)
+        timeout = kube.read_file(parsed, 'timeout')
+
+    if checkout_claim:
+        volume, mount = kube.checkout_volume(checkout_claim, checkout_subpath)
+        return kube.job_spec(name, suite['container']['image'], script,
+                             timeout=timeout, volumes=[volume], mounts=[mount])
+
+    # no shared checkout volume; clone it in an init container
     volumes = [
-        {'name': 'builddir', 'emptyDir': {}}
+        {'name': 'checkout', 'emptyDir': {}}
+    ]
+    mounts = [
+        { 'name': 'checkout',
+          'mountPath': kube.CHECKOUT_MOUNT,
+        }
     ]
-    containers = [{
-        'name': name,
-        'image': suite['container']['image'],
-        'volumeMounts': [
-            { 'name': 'builddir',
-              'mountPath': '/srv',
-            }
-        ],
-        'securityContext': {'runAsUser': 0},
-        'workingDir': '/srv/build',
-        'command': ["/usr/bin/bash", "-c", cmd],
-    }]
     initContainers = [
         { 'name': 'init-git',
           'image': 'registry.centos.org/centos/centos:7',
-          'volumeMounts': [
-              { 'name': 'builddir',
-                'mountPath': '/srv',
-              }
-          ],
+          'volumeMounts': copy.deepcopy(mounts),
           'securityContext': {'runAsUser': 0},
-          'workingDir': '/srv/',
+          'workingDir': kube.CHECKOUT_MOUNT,
           'command': ['/bin/sh', '-c',
                       '''set -xeuo pipefail; yum -y install git
-                      git clone --depth=100 https://github.com/{gh_org}/{gh_repo} build
-                      cd build
+                      git clone --depth=100 https://github.com/{gh_org}/{gh_repo} .
                       git checkout {commitsha}'''.format(gh_org=gh_org, gh_repo=gh_repo, commitsha=commitsha)]
         }
     ]
-    r = {'apiVersion': 'batch/v1',
-         'kind': 'Job',
-         'metadata': metadata,
-         'spec': {
-             'template': {
-                 'metadata': dict(metadata),
-                 'spec': {
-                     'volumes': volumes,
-                     'initContainers': initContainers,
-                     'containers': containers,
-                     'restartPolicy': 'Never'
-                 },
-             },
-         },
-    }
-    return r
+    return kube.job_spec(name, suite['container']['image'], script,
+                         timeout=timeout, volumes=volumes, mounts=mounts,
+                         init_containers=initContainers)
 
 def main():
     "Main entry point."
 
     parser = argparse.ArgumentParser(description='Convert .papr.yml to Kuberentes Jobs')
     parser.add_argument('--limit', action='store', type=int, help='Emit at most N jobs')
+    parser.add_argument('--checkout-claim', action='store', help='PVC holding checkouts, rather than cloning in each pod')
+    parser.add_argument('--checkout-subpath', action='store', help='Path of the checkout in that PVC')
     parser.add_argument('ghid', action='store', help='github repo')
     parser.add_argument('commitsha', action='store', help='commit sha')
     parser.add_argument('path', action='store', help='Path to papr YAML (normally .papr.yml)')
@@ -99,7 +92,9 @@ def main():
     for i,suite in enumerate(suites):
         if not suite.get('container'):
             continue
-        jobs.append(paprsuite2kubejob(org, proj, args.commitsha, i, suite))
+        jobs.append(paprsuite2kubejob(org, proj, args.commitsha, i, suite,
+                                      args.checkout_claim,
+                                      args.checkout_subpath))
         if len(jobs) == args.limit:
             break
     yaml.dump(joblist, stream=stream, explicit_start=True)
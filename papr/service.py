@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+'''
+    Long-running service mode. Rather than being invoked once
+    per trigger, jobs are added to a persistent queue and
+    picked up by a single service process:
+
+      papr-service enqueue --repo owner/repo --pull-id 42
+      papr-service run --workers 4
+
+    Each job runs the usual main script in its own directory
+    under jobs/ so that concurrent jobs don't clobber each
+    other's state/ dir. The checkouts and caches are shared
+    between all the jobs, which keeps them warm. Queued jobs
+    for the same PR or branch are superseded as soon as a
+    newer one is added, and so is a job already running for
+    the same PR (through the spawner's run registry).
+'''
+
+import os
+import sys
+import time
+import signal
+import shutil
+import sqlite3
+import argparse
+import subprocess
+
+from papr import PKG_DIR
+
+JOBS_DIR = 'jobs'
+QUEUE_DB = os.path.join(JOBS_DIR, 'queue.sqlite')
+
+# directories shared by all jobs, relative to the service dir
+SHARED_DIRS = ['checkouts', 'cache', 'cluster_keypair', 'runs']
+
+# finished job dirs are deleted after this long
+MAX_JOB_AGE = 7 * 24 * 60 * 60
+PRUNE_INTERVAL = 60 * 60
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        repo TEXT NOT NULL,
+        branch TEXT,
+        pull_id INTEGER,
+        commit_sha TEXT,
+        contexts TEXT,
+        -- one of queued, running, done, superseded or interrupted
+        state TEXT NOT NULL DEFAULT 'queued',
+        rc INTEGER,
+        created REAL NOT NULL,
+        started REAL,
+        finished REAL
+    )
+'''
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+    return args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="PAPR service mode")
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    enqueue = subparsers.add_parser('enqueue', help="queue a new job")
+    enqueue.add_argument('--repo', required=True,
+                         help="GitHub repo in <owner>/<repo> format")
+    target = enqueue.add_mutually_exclusive_group(required=True)
+    target.add_argument('--branch', help="branch to test")
+    target.add_argument('--pull-id', type=int, help="pull request to test")
+    enqueue.add_argument('--commit', help="SHA of commit to expect")
+    enqueue.add_argument('--contexts',
+                         help="pipe-separated list of contexts to run")
+    enqueue.set_defaults(func=cmd_enqueue)
+
+    run = subparsers.add_parser('run', help="process queued jobs")
+    run.add_argument('--workers', type=int, default=4, metavar='N',
+                     help="maximum number of jobs to run at once")
+    run.set_defaults(func=cmd_run)
+
+    ls = subparsers.add_parser('list', help="list jobs")
+    ls.add_argument('--limit', type=int, default=20, metavar='N',
+                    help="list at most the last N jobs")
+    ls.set_defaults(func=cmd_list)
+
+    return parser.parse_args()
+
+
+def open_db():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    # the service and enqueuers may write at the same time
+    db = sqlite3.connect(QUEUE_DB, timeout=60, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute(SCHEMA)
+    return db
+
+
+def cmd_enqueue(args):
+    db = open_db()
+    db.execute('BEGIN IMMEDIATE')
+
+    # whatever was queued for the same target is now stale
+    if args.pull_id is not None:
+        cur = db.execute("UPDATE jobs SET state = 'superseded' "
+                         "WHERE state = 'queued' AND repo = ? "
+                         "AND pull_id = ?", (args.repo, args.pull_id))
+    else:
+        cur = db.execute("UPDATE jobs SET state = 'superseded' "
+                         "WHERE state = 'queued' AND repo = ? "
+                         "AND branch = ?", (args.repo, args.branch))
+    if cur.rowcount > 0:
+        print("INFO: superseded %d queued job(s)" % cur.rowcount)
+
+    cur = db.execute("INSERT INTO jobs (repo, branch, pull_id, commit_sha, "
+                     "contexts, created) VALUES (?, ?, ?, ?, ?, ?)",
+                     (args.repo, args.branch, args.pull_id, args.commit,
+                      args.contexts, time.time()))
+    db.execute('COMMIT')
+    print("INFO: queued job %d" % cur.lastrowid)
+    return 0
+
+
+def cmd_list(args):
+    db = open_db()
+    for job in db.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?",
+                          (args.limit,)):
+        target = job['branch'] or 'PR #%d' % job['pull_id']
+        rc = '' if job['rc'] is None else 'rc=%d' % job['rc']
+        print("%d\t%s\t%s\t%s\t%s" % (job['id'], job['repo'], target,
+                                      job['state'], rc))
+    return 0
+
+
+def cmd_run(args):
+    db = open_db()
+
+    # jobs which were running when a previous service died
+    db.execute("UPDATE jobs SET state = 'interrupted' "
+               "WHERE state = 'running'")
+
+    for d in SHARED_DIRS:
+        os.makedirs(d, exist_ok=True)
+
+    running = {}
+    superseded = set()
+    last_prune = 0
+    while True:
+        for job_id, p in list(running.items()):
+            if p.poll() is None:
+                continue
+            print("INFO: job %d exited with rc %d" % (job_id, p.returncode))
+            db.execute("UPDATE jobs SET state = 'done', rc = ?, "
+                       "finished = ? WHERE id = ?",
+                       (p.returncode, time.time(), job_id))
+            del running[job_id]
+            superseded.discard(job_id)
+
+        # a newer job for the same PR waits for the older one since they
+        # share the checkout, so stop the older one rather than wait
+        for job_id in supersede_running(db, running, superseded):
+            print("INFO: superseding job %d" % job_id)
+            superseded.add(job_id)
+
+        while len(running) < args.workers:
+            job = claim_job(db)
+            if job is None:
+                break
+            print("INFO: starting job %d" % job['id'])
+            running[job['id']] = start_job(job)
+
+        if time.time() - last_prune > PRUNE_INTERVAL:
+            prune_jobs(db)
+            last_prune = time.time()
+
+        time.sleep(2)
+
+
+def claim_job(db):
+    "Mark the oldest runnable job as running and return it."
+
+    db.execute('BEGIN IMMEDIATE')
+
+    # We only run one job per repo at a time since they
+    # share the same checkout.
+    job = db.execute("SELECT * FROM jobs WHERE state = 'queued' AND "
+                     "repo NOT IN (SELECT repo FROM jobs "
+                     "WHERE state = 'running') "
+                     "ORDER BY id LIMIT 1").fetchone()
+    if job is not None:
+        db.execute("UPDATE jobs SET state = 'running', started = ? "
+                   "WHERE id = ?", (time.time(), job['id']))
+
+    db.execute('COMMIT')
+    return job
+
+
+def supersede_running(db, running, superseded):
+    "Signal running jobs of PRs with a newer job queued; yields their IDs."
+
+    for job in db.execute("SELECT id, repo, pull_id FROM jobs AS old "
+                          "WHERE state = 'running' AND pull_id IS NOT NULL "
+                          "AND EXISTS (SELECT 1 FROM jobs WHERE "
+                          "state = 'queued' AND repo = old.repo AND "
+                          "pull_id = old.pull_id AND id > old.id)"):
+        if job['id'] in superseded or job['id'] not in running:
+            continue
+        # main execs the spawner, which registers itself once it handles
+        # SIGUSR1; until then, we just try again on the next round
+        fn = os.path.join(os.environ.get('runs_dir') or 'runs', job['repo'],
+                          'pull-%d' % job['pull_id'])
+        try:
+            with open(fn) as f:
+                entry = f.read().split()
+        except OSError:
+            continue
+        pid = running[job['id']].pid
+        if len(entry) == 2 and int(entry[0]) == pid:
+            os.kill(pid, signal.SIGUSR1)
+            yield job['id']
+
+
+def start_job(job):
+
+    job_dir = os.path.join(JOBS_DIR, str(job['id']))
+    os.makedirs(job_dir)
+
+    # main works relative to its cwd; give it its own state
+    # dir, but point it at the shared checkouts and caches
+    for d in SHARED_DIRS:
+        os.symlink(os.path.abspath(d), os.path.join(job_dir, d))
+
+    env = dict(os.environ)
+    for var in ['github_branch', 'github_pull_id', 'github_commit',
+                'github_contexts']:
+        env.pop(var, None)
+    env['github_repo'] = job['repo']
+    if job['branch']:
+        env['github_branch'] = job['branch']
+    else:
+        env['github_pull_id'] = str(job['pull_id'])
+    if job['commit_sha']:
+        env['github_commit'] = job['commit_sha']
+    if job['contexts']:
+        env['github_contexts'] = job['contexts']
+
+    with open(os.path.join(job_dir, 'output.log'), 'w') as log:
+        return subprocess.Popen([os.path.join(PKG_DIR, 'main')],
+                                cwd=job_dir, env=env,
+                                stdin=subprocess.DEVNULL,
+                                stdout=log, stderr=subprocess.STDOUT)
+
+
+def prune_jobs(db):
+    "Delete the dirs of jobs which finished a while ago."
+
+    cutoff = time.time() - MAX_JOB_AGE
+    for job in db.execute("SELECT id FROM jobs WHERE state = 'done' "
+                          "AND finished < ?", (cutoff,)).fetchall():
+        job_dir = os.path.join(JOBS_DIR, str(job['id']))
+        if os.path.isdir(job_dir):
+            # NB: files copied out of containers may be owned by root
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
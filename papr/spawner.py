@@ -4,25 +4,41 @@
 # and wait for them.
 
 import os
+import re
 import sys
 import time
+import fcntl
+import sqlite3
+import signal
 import traceback
-import threading
 import subprocess
 
-import boto3
-import jinja2
-
 # XXX: switch to relative imports when we're a proper module
 from papr import PKG_DIR
 import papr.utils.parser as parser
 import papr.utils.common as common
 import papr.utils.gh as gh
+import papr.utils.result_cache as result_cache
+import papr.utils.history as history
+import papr.utils.profiling as profiling
+import papr.utils.kube as kube
+import papr.utils.workqueue as workqueue
+import papr.utils.httpcache as httpcache
+import papr.utils.runstatus as runstatus
+from papr.utils.outmux import OutputMux
+
+# set from signal handlers to 'superseded' or 'aborted' to stop all runners
+stop_reason = None
 
+# exit code of runners which hit a transient error (see common.sh)
+TRANSIENT_RC = 75
 
+
+@profiling.profiled('spawner')
 def main():
     "Main entry point."
 
+    started = time.time()
     try:
         suites = parse_suites()
     except parser.ParserError as e:
@@ -35,9 +51,24 @@ def main():
     else:
         n = len(suites)
         if n > 0:
-            spawn_testrunners(n)
+            skip_unchanged_paths(suites)
+            reuse_cached_results(suites)
+            estimate_durations(suites)
+            prefetch_pull()
+            register_run()
+            # make the setup part available even if we never finish
+            profiling.checkpoint()
+            status = runstatus.RunStatus(suites)
+            if status.url():
+                print("INFO: live status at %s" % status.url())
+            try:
+                spawn_testrunners(suites, status)
+            finally:
+                unregister_run()
+                status.finish(stop_reason or 'finished')
+                # even partial runs tell us how long phases take
+                record_history(suites, started)
             inspect_suite_failures(suites)
-            update_required_context(suites)
         else:
             print("INFO: No testsuites to run.")
 
@@ -63,7 +94,11 @@ def parse_suites():
         only_contexts = only_contexts.split('|')
 
     suites = []
+    nrunners = 0
+    tree = checkout_tree()
     branch = os.environ.get('github_branch')
+    use_kube = kube.enabled()
+    use_queue = workqueue.enabled()
     suite_parser = parser.SuiteParser(yml_file)
     for idx, suite in enumerate(suite_parser.parse()):
         if len(os.environ.get('RHCI_DEBUG_ALWAYS_RUN', '')) == 0:
@@ -80,38 +115,340 @@ def parse_suites():
                 print("INFO: %s suite not in github_contexts env var." %
                       common.ordinal(idx + 1))
                 continue
-        suite_dir = 'state/suite-%d/parsed' % len(suites)
-        parser.flush_suite(suite, suite_dir)
+        if suite.get('cache-results', True):
+            suite['cache_key'] = result_cache.cache_key(
+                suite, os.environ['github_repo'], tree)
+        if use_kube and kube.eligible(suite):
+            suite['backend'] = 'kube'
+        elif use_queue:
+            suite['backend'] = 'queue'
+        # each shard gets its own state dir and testrunner
+        suite['runners'] = []
+        for shard in range(suite.get('shards', 1)):
+            flush_runner(suite, nrunners, shard)
+            suite['runners'].append(nrunners)
+            nrunners += 1
         suites.append(suite)
 
     return suites
 
 
-def spawn_testrunners(n):
+def flush_runner(suite, idx, shard):
+    "Write out what the runner of a shard needs in its state dir."
+
+    suite_dir = 'state/suite-%d/parsed' % idx
+    parser.flush_suite(suite, suite_dir, shard)
+    if 'backend' in suite:
+        with open(os.path.join(suite_dir, 'backend'), 'w') as f:
+            f.write(suite['backend'])
+
+
+def checkout_tree():
+    "Returns the ID of the git tree we're testing."
+
+    repo = os.path.join('checkouts', os.environ['github_repo'])
+    out = subprocess.check_output(['git', '-C', repo, 'rev-parse',
+                                   'HEAD^{tree}'])
+    return out.decode('utf-8').strip()
+
+
+def changed_files():
+    "Returns the list of files changed by the PR, or None if unknown."
+
+    # we can only reliably compute this if we have the merge commit, in
+    # which case we diff the PR against its merge base
+    if not os.path.isfile('state/is_merge_sha'):
+        return None
+
+    repo = os.path.join('checkouts', os.environ['github_repo'])
+    out = subprocess.check_output(['git', '-C', repo, 'diff', '--name-only',
+                                   '-z', 'HEAD^1...HEAD^2'])
+    return [f for f in out.decode('utf-8').split('\0') if f != '']
+
+
+def skip_unchanged_paths(suites):
+    "Skip suites for which none of the changed files are relevant."
+
+    if len(os.environ.get('RHCI_DEBUG_ALWAYS_RUN', '')) > 0:
+        return
+
+    if not any(['paths' in s or 'paths-ignore' in s for s in suites]):
+        return
+
+    files = changed_files()
+    if files is None:
+        return
+
+    for suite in suites:
+        if 'paths' not in suite and 'paths-ignore' not in suite:
+            continue
+
+        relevant = files
+        if 'paths' in suite:
+            regex = common.compile_globs(suite['paths'])
+            relevant = [f for f in relevant if regex.fullmatch(f)]
+        if 'paths-ignore' in suite:
+            regex = common.compile_globs(suite['paths-ignore'])
+            relevant = [f for f in relevant if not regex.fullmatch(f)]
+
+        if len(relevant) == 0:
+            print("INFO: no relevant files changed for suite '%s'." %
+                  suite['context'])
+            suite['rc'] = 0
+            suite['url'] = None
+            suite['outcome'] = 'skipped'
+            gh_status('success', suite['context'],
+                      "Skipped since no relevant files changed.")
+
+
+def reuse_cached_results(suites):
+    "Skip suites which already passed on the exact same tree."
+
+    if len(os.environ.get('RHCI_DEBUG_ALWAYS_RUN', '')) > 0:
+        return
+
+    result_cache.prune()
+    for suite in suites:
+        if 'cache_key' not in suite or 'rc' in suite:
+            continue
+        result = result_cache.lookup(suite['cache_key'])
+        if result is None:
+            continue
+        print("INFO: reusing cached result from %s for suite '%s'." %
+              (result['commit'], suite['context']))
+        suite['rc'] = result['rc']
+        suite['url'] = result['url']
+        suite['outcome'] = 'cached'
+        gh_status('success', suite['context'], "All tests passed "
+                  "(cached result from %s)." % result['commit'][:7],
+                  result['url'])
+
+
+def estimate_durations(suites):
+    "Annotate suites with their expected duration based on past runs."
+
+    # the history is nice to have, but not worth failing the run over
+    try:
+        expected = history.expected_durations(os.environ['github_repo'])
+    except (OSError, sqlite3.Error):
+        traceback.print_exc()
+        return
+
+    for suite in suites:
+        if suite['context'] in expected:
+            suite['expected_duration'] = expected[suite['context']]
+
+
+def prefetch_pull():
+    "Fetch the PR metadata the runners need once rather than in each."
+
+    if not os.environ.get('github_pull_id'):
+        return
+
+    httpcache.prune()
+    try:
+        pull = httpcache.github('pulls/%s' % os.environ['github_pull_id'])
+    except Exception:
+        # the runners will just query it themselves
+        traceback.print_exc()
+        return
+    with open('state/pull_target_branch', 'w') as f:
+        f.write(pull['base']['ref'])
+
+
+def record_history(suites, started):
+
+    # the history is nice to have, but not worth failing the run over
+    try:
+        history.record_run(suites, started)
+    except (OSError, sqlite3.Error):
+        traceback.print_exc()
+
+
+def run_registry_file():
+    "Returns the path to the file registering the current run of this PR."
+    # separate workspaces can share it through runs_dir
+    return os.path.join(os.environ.get('runs_dir') or 'runs',
+                        os.environ['github_repo'],
+                        'pull-%s' % os.environ['github_pull_id'])
+
+
+def register_run():
+    "Register as the current run of this PR and supersede older ones."
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: stop('superseded'))
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop('aborted'))
 
-    testrunner = os.path.join(PKG_DIR, "testrunner")
+    if not os.environ.get('github_pull_id'):
+        return
+
+    fn = run_registry_file()
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        entry = f.read().split()
+        if len(entry) == 2 and entry[1] != os.environ['github_commit']:
+            pid = int(entry[0])
+            if is_spawner(pid):
+                print("INFO: superseding run of %s (pid %d)" %
+                      (entry[1], pid))
+                os.kill(pid, signal.SIGUSR1)
+        f.seek(0)
+        f.truncate()
+        f.write("%d %s" % (os.getpid(), os.environ['github_commit']))
+
+
+def unregister_run():
+
+    if not os.environ.get('github_pull_id'):
+        return
+
+    with open(run_registry_file(), 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        entry = f.read().split()
+        # only remove it if we haven't been superseded already
+        if len(entry) == 2 and int(entry[0]) == os.getpid():
+            f.seek(0)
+            f.truncate()
+
+
+def is_spawner(pid):
+    "Checks that pid is still a spawner (i.e. it wasn't recycled)."
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return b'spawner.py' in f.read()
+    except OSError:
+        return False
 
-    runners = []
-    threads = []
-    for i in range(n):
-        p = subprocess.Popen([testrunner, str(i)],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        t = threading.Thread(target=read_pipe,
-                             args=(i, p.stdout))
-        t.start()
-        runners.append(p)
-        threads.append(t)
 
-    # We don't implement any fail fast here, so just do a
-    # naive wait to collect them all.
+def stop(reason):
+    global stop_reason
+    print("INFO: stopping all runners: %s" % reason)
+    stop_reason = reason
+
+
+def spawn_testrunners(suites, status):
+
+    # optionally cap the number of testrunners running at once
+    max_runners = int(os.environ.get('max_runners') or 0)
+    fail_fast = len(os.environ.get('fail_fast', '')) > 0
+    max_retries, deadline = runner_retry_budget()
+
+    contexts = {suite['context']: i for i, suite in enumerate(suites)}
+    pending = sorted([i for i, suite in enumerate(suites)
+                      if 'rc' not in suite],
+                     key=lambda i: schedule_key(suites, i))
+
+    mux = OutputMux()
+    running = {}
+    retries = {}
+    runner_started = {}
     failed = []
-    for i, runner in enumerate(runners):
-        if runner.wait() != 0:
-            failed.append(i)
+    stopped = False
+    required_posted = False
+    while pending or running:
+
+        if stop_reason is not None and not stopped:
+            # Kill the whole process group of each runner so that
+            # whatever they're waiting on also goes away. They'll
+            # still tear down their environments on the way out.
+            for procs in running.values():
+                for _, p in procs:
+                    try:
+                        os.killpg(p.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+            for j in pending:
+                stop_suite(suites[j])
+            pending = []
+            stopped = True
+
+        for i, procs in list(running.items()):
+            if any([p.poll() is None or not mux.done(idx)
+                    for idx, p in procs]):
+                continue
+
+            # rerun runners which hit a transient infra error rather
+            # than the whole run, as long as the budget allows
+            rerun = [idx for idx, p in procs
+                     if p.returncode != 0 and not stopped and
+                     failed_transiently(idx, p.returncode) and
+                     retries.get(idx, 0) < max_retries and
+                     (deadline is None or
+                      time.time() - suites[i]['started'] < deadline)]
+            if rerun:
+                procs = [(idx, p) for idx, p in procs if idx not in rerun]
+                for idx in rerun:
+                    retries[idx] = retries.get(idx, 0) + 1
+                    print("INFO: runner %d failed, retrying (%d/%d)" %
+                          (idx, retries[idx], max_retries))
+                    reset_runner(suites[i], idx, runner_started[idx])
+                    runner_started[idx] = time.time()
+                    procs.append((idx, start_runner(suites[i], idx, mux)))
+                running[i] = procs
+                continue
+
+            for idx, p in procs:
+                if p.returncode != 0 and not stopped:
+                    failed.append(idx)
+            del running[i]
+            if stopped:
+                stop_suite(suites[i])
+                continue
+            suites[i]['duration'] = time.time() - suites[i]['started']
+            finish_suite(suites[i])
+            cache_suite_result(suites[i])
+            if fail_fast and suites[i].get('required') and suites[i]['rc']:
+                for j in pending:
+                    cancel_suite(suites[j], "Cancelled since a required "
+                                 "testsuite failed.")
+                pending = []
+
+        for i in list(pending):
+            # Jobs on Kubernetes and queued suites don't use any
+            # local resources
+            nrunning = sum([len(procs) for j, procs in running.items()
+                            if 'backend' not in suites[j]])
+            if (max_runners and nrunning >= max_runners and
+                    'backend' not in suites[i]):
+                continue
+
+            # dependencies may have been filtered out, in which case we
+            # just ignore them
+            deps = [contexts[dep] for dep in suites[i].get('depends-on', [])
+                    if dep in contexts]
+            if any(['rc' not in suites[dep] for dep in deps]):
+                continue
+
+            pending.remove(i)
+            failed_deps = [dep for dep in deps if suites[dep]['rc'] != 0]
+            if failed_deps:
+                cancel_suite(suites[i], "Skipped since dependency '%s' "
+                             "failed." % suites[failed_deps[0]]['context'])
+                continue
+
+            running[i] = []
+            suites[i]['outcome'] = 'ran'
+            suites[i]['started'] = time.time()
+            for idx in suites[i]['runners']:
+                runner_started[idx] = time.time()
+                running[i].append((idx, start_runner(suites[i], idx, mux)))
+
+        # post the 'required' context as soon as it's decided rather than
+        # waiting for the slowest non-required suite
+        required = [suite for suite in suites if suite.get('required')]
+        if (not required_posted and not stopped and
+                all(['rc' in s for s in required])):
+            update_required_context(suites, status)
+            required_posted = True
+
+        status.update()
+        if running:
+            mux.poll(1)
 
-    for thread in threads:
-        thread.join()
+    if stop_reason == 'aborted':
+        raise Exception("aborted")
 
     # NB: When we say 'failed' here, we're talking about
     # infrastructure failure. Bad PR code should never cause
@@ -120,32 +457,163 @@ def spawn_testrunners(n):
         raise Exception("the following runners failed: %s" % str(failed))
 
 
-def read_pipe(idx, fd):
-    # NB: We can't trust the output from the testrunner, so
-    # just read it and write it back in binary mode.
-    s = fd.readline()
-    while s != b'':
-        if not s.endswith(b'\n'):
-            s += b'\n'
-            # pylint: disable=no-member
-        sys.stdout.buffer.write((b'[%d] ' % idx) + s)
-        s = fd.readline()
+def start_runner(suite, idx, mux):
+    "Start the testrunner of the given state dir."
+
+    cmd = [os.path.join(PKG_DIR, "testrunner"), str(idx)]
+    if suite.get('backend') == 'queue':
+        # a worker on another builder runs it for us
+        cmd = [sys.executable, '-m', 'papr.utils.workqueue',
+               'proxy', str(idx)]
+    # each runner gets its own process group so that we can
+    # kill it and all its children
+    p = subprocess.Popen(cmd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    mux.add(idx, p.stdout, 'state/suite-%d/runner.log.gz' % idx)
+    return p
+
+
+def runner_retry_budget():
+    "Returns how many times and for how long failed runners may be rerun."
+
+    # same format as the budgets of the phases of the testrunner, see
+    # retry in common.sh
+    retries, deadline = 1, None
+    for entry in os.environ.get('retry_budgets', '').split(','):
+        phase, _, budget = entry.partition('=')
+        if phase != 'runner':
+            continue
+        m = re.fullmatch(r'(\d+)(?::(\d+))?', budget)
+        if m is None:
+            print("WARNING: ignoring invalid runner budget '%s'" % budget)
+            continue
+        retries = int(m.group(1))
+        if m.group(2):
+            deadline = int(m.group(2))
+    return retries, deadline
+
+
+def failed_transiently(idx, rc):
+    "Whether a runner failed because of a transient infra error."
+
+    # i.e. it ran out of retries of a phase (see retry in common.sh), or
+    # exited with EX_TEMPFAIL directly
+    return (rc == TRANSIENT_RC or
+            os.path.isfile('state/suite-%d/transient' % idx))
+
+
+def reset_runner(suite, idx, started):
+    "Set aside the state dir of a failed runner so that it can be rerun."
+
+    state = 'state/suite-%d' % idx
+    attempt = 1
+    while os.path.exists('%s.try%d' % (state, attempt)):
+        attempt += 1
+    os.rename(state, '%s.try%d' % (state, attempt))
+    flush_runner(suite, idx, suite['runners'].index(idx))
+
+    # the failed attempt shows up as a retry in the history
+    with open(os.path.join(state, 'timings'), 'w') as f:
+        f.write("runner.retry %f %f\n" % (started, time.time()))
+
+
+def schedule_key(suites, idx):
+    "Start required suites first, then by descending priority."
+    # then start the suites expected to take the longest first so that
+    # they don't hold up the whole run by starting last
+    suite = suites[idx]
+    return (not suite.get('required', False), -suite.get('priority', 0),
+            -suite.get('expected_duration', 0), idx)
+
+
+def cancel_suite(suite, description):
+    gh_status('error', suite['context'], description)
+    suite['rc'] = 1
+
+
+def stop_suite(suite):
+    suite['outcome'] = 'cancelled'
+    if stop_reason == 'superseded':
+        cancel_suite(suite, "Superseded by a newer commit.")
+    else:
+        cancel_suite(suite, "Run was aborted.")
 
 
-def inspect_suite_failures(suites):
+def finish_suite(suite):
+
+    if len(suite['runners']) == 1:
+        idx = suite['runners'][0]
+        suite['rc'] = read_suite_rc(idx)
+        suite['url'] = read_suite_url(idx)
+    else:
+        merge_shards(suite)
 
-    for i, suite in enumerate(suites):
-        assert 'rc' not in suite
 
-        # If the rc file doesn't exist but the runner exited
-        # nicely, then it means there was a semantic error
-        # in the YAML (e.g. bad Docker image, bad ostree
-        # revision, etc...).
-        if not os.path.isfile("state/suite-%d/rc" % i):
-            suite['rc'] = 1
-        else:
-            with open("state/suite-%d/rc" % i) as f:
-                suite['rc'] = int(f.read().strip())
+def cache_suite_result(suite):
+
+    # we only cache passing results; failures should always be retested
+    # since they may be flakes
+    if suite['rc'] == 0 and suite['url'] and 'cache_key' in suite:
+        result_cache.store(suite['cache_key'], suite['rc'], suite['url'],
+                           os.environ['github_commit'])
+
+
+def merge_shards(suite):
+    "Report the results of all the shards of a suite under its context."
+
+    total = len(suite['runners'])
+    rcs = [read_suite_rc(idx) for idx in suite['runners']]
+    suite['rc'] = next((rc for rc in rcs if rc != 0), 0)
+
+    results_shards = []
+    for shard, idx in enumerate(suite['runners']):
+        name = "%s [shard %d/%d]" % (suite['context'], shard + 1, total)
+        url = read_suite_url(idx) or os.environ['github_url']
+        results_shards.append((name, rcs[shard] == 0, url))
+
+    # the index links to the logs and artifacts of every shard
+    suite['url'] = None
+    if os.environ.get('s3_prefix'):
+        suite['url'] = upload_results_index(results_shards)
+
+    failed = len([r for r in results_shards if not r[1]])
+    if failed == 0:
+        desc = "All tests passed in %d shards" % total
+        if (os.environ.get('github_pull_id') and
+                not os.path.isfile('state/is_merge_sha')):
+            desc += ", but merge commit could not be tested"
+        gh_status('success', suite['context'], desc + '.', suite['url'])
+    else:
+        gh_status('failure', suite['context'], "Tests failed in %d/%d "
+                  "shards." % (failed, total), suite['url'])
+
+
+def read_suite_rc(idx):
+
+    # If the rc file doesn't exist but the runner exited
+    # nicely, then it means there was a semantic error
+    # in the YAML (e.g. bad Docker image, bad ostree
+    # revision, etc...).
+    if not os.path.isfile("state/suite-%d/rc" % idx):
+        return 1
+
+    with open("state/suite-%d/rc" % idx) as f:
+        return int(f.read().strip())
+
+
+def read_suite_url(idx):
+    if not os.path.isfile("state/suite-%d/url" % idx):
+        return None
+
+    with open("state/suite-%d/url" % idx) as f:
+        return f.read().strip()
+
+
+def inspect_suite_failures(suites):
+
+    assert all(['rc' in suite for suite in suites])
 
     # It's helpful to have an easy global way to figure out
     # if any of the suites failed, e.g. for integration in
@@ -159,7 +627,7 @@ def count_failures(suites):
     return sum([int(suite['rc'] != 0) for suite in suites])
 
 
-def update_required_context(suites):
+def update_required_context(suites, status):
 
     # don't send 'required' context if we're only targeting some testsuites
     if 'github_contexts' in os.environ:
@@ -175,38 +643,49 @@ def update_required_context(suites):
     # links to the results of all the required suites
 
     results_suites = []
-    for i, suite in enumerate(suites):
-        name = suite['context']
-        if os.path.isfile("state/suite-%d/url" % i):
-            with open("state/suite-%d/url" % i) as f:
-                url = f.read().strip()
-        else:
-            # something went really wrong in the tester, fallback to src url
-            url = os.environ['github_url']
+    for suite in required_suites:
+        # something went really wrong in the tester, fallback to src url
+        url = suite.get('url') or os.environ['github_url']
         result = (suite['rc'] == 0)
-        results_suites.append((name, result, url))
+        results_suites.append((suite['context'], result, url))
+
+    # keep it next to the live status of the run
+    s3_key = None
+    if status.prefix:
+        s3_key = '%s/index.html' % status.prefix
+    url = upload_results_index(results_suites, s3_key)
+    status.required_url = url
+
+    failed = count_failures(required_suites)
+    gh_status('success' if failed == 0 else 'failure', 'required',
+              "%d/%d PASSES" % (total - failed, total), url)
+
+
+def upload_results_index(results, s3_key=None):
+    "Upload a basic index linking to each (name, passed, url) result."
+
+    # only load jinja2 (and boto3 below) when we actually need them; they're
+    # the bulk of our startup time
+    import jinja2
 
     tpl_fname = os.path.join(PKG_DIR, 'utils', 'required-index.j2')
 
-    s3_key = '%s/%s/%s.%s/%s' % (os.environ['s3_prefix'],
-                                 os.environ['github_repo'],
-                                 os.environ['github_commit'],
-                                 # rough equivalent of date +%s%N
-                                 int(time.time() * 1e9),
-                                 'index.html')
+    if s3_key is None:
+        s3_key = '%s/%s/%s.%s/%s' % (os.environ['s3_prefix'],
+                                     os.environ['github_repo'],
+                                     os.environ['github_commit'],
+                                     # rough equivalent of date +%s%N
+                                     int(time.time() * 1e9),
+                                     'index.html')
 
     with open(tpl_fname) as tplf:
         tpl = jinja2.Template(tplf.read(), autoescape=True)
         tpl.globals['url'] = os.environ.get('github_url', "N/A")
         tpl.globals['commit'] = os.environ.get('github_commit', "N/A")
-        data = tpl.render(suites=results_suites)
+        data = tpl.render(suites=results)
         upload_to_s3(s3_key, data, 'text/html')
 
-    url = 'https://s3.amazonaws.com/%s' % s3_key
-
-    failed = count_failures(required_suites)
-    gh_status('success' if failed == 0 else 'failure', 'required',
-              "%d/%d PASSES" % (total - failed, total), url)
+    return 'https://s3.amazonaws.com/%s' % s3_key
 
 
 def gh_status(state, context, description, url=None):
@@ -244,6 +723,7 @@ def gh_comment(text):
 
 
 def upload_to_s3(bucket_key, data, type):
+    import boto3
     s3 = boto3.resource("s3")
     bucket, key = bucket_key.split('/', 1)
     s3.Object(bucket, key).put(Body=data, ContentType=type)
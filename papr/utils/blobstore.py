@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+'''
+    This script is not meant to be run manually. It is
+    called from the testrunner before uploading the results
+    of a testsuite to S3 (if s3_blobs is set).
+
+    The same artifacts (e.g. RPMs built by several suites,
+    or unchanged files on reruns) would otherwise be uploaded
+    and stored again under the unique prefix of every run.
+    Instead, each file in a subdir of the upload dir (i.e.
+    all but the top-level logs the commit status links to)
+    is uploaded once under a key derived from its content:
+
+      <s3_prefix>/<repo>/blobs/<sha256><ext>
+
+    and removed from the upload dir. What was moved there is
+    recorded in a manifest.json in the upload dir, mapping
+    paths to their blob, which the indexer then links to.
+
+    The blobs we know are in S3 are recorded in the cache dir
+    so that we don't even need to check them again. They must
+    not be expired sooner than KNOWN_MAX_AGE in S3.
+'''
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import mimetypes
+import concurrent.futures
+
+KNOWN_DB = 'cache/blobs.sqlite'
+
+# how long we trust that a blob we uploaded or saw is still there
+KNOWN_MAX_AGE = 7 * 24 * 60 * 60
+
+UPLOAD_THREADS = 8
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS known (
+        key TEXT PRIMARY KEY,
+        timestamp REAL NOT NULL
+    );
+'''
+
+
+def main():
+    "Main entry point."
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('upload_dir', help="dir to upload")
+    parser.add_argument('prefix', help="S3 path under which to store the "
+                        "blobs dir, in <bucket>/<prefix> form")
+    args = parser.parse_args()
+
+    store(args.upload_dir, args.prefix)
+    return 0
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_name(path, digest):
+    # keep the extension so that S3 serves it with the right type
+    ext = os.path.splitext(path)[1].lower()
+    return 'blobs/%s%s' % (digest, ext)
+
+
+def content_type(path):
+    if path.endswith('.log'):
+        # like the logs synced by the testrunner
+        return 'text/plain; charset=utf-8'
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def open_known_db():
+    os.makedirs(os.path.dirname(KNOWN_DB), exist_ok=True)
+    # concurrent testrunners may be writing to it
+    conn = sqlite3.connect(KNOWN_DB, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def find_files(upload_dir):
+    "Yields the paths relative to upload_dir of the files to store."
+
+    for dirpath, _, files in os.walk(upload_dir):
+        if dirpath == upload_dir:
+            continue
+        for fn in files:
+            path = os.path.join(dirpath, fn)
+            if not os.path.islink(path):
+                yield os.path.relpath(path, upload_dir)
+
+
+def store(upload_dir, prefix):
+    "Move the files in the subdirs of upload_dir to the blob store."
+
+    import boto3
+    from botocore.exceptions import ClientError
+
+    bucket, _, key_prefix = prefix.partition('/')
+    s3 = boto3.client('s3')
+
+    def key_of(blob):
+        return '%s/%s' % (key_prefix, blob) if key_prefix else blob
+
+    def upload(path, blob):
+        "Upload a blob unless it's already there; returns True on success."
+
+        key = key_of(blob)
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                print("ERROR: %s: %s" % (path, e))
+                return False
+        try:
+            s3.upload_file(path, bucket, key,
+                           ExtraArgs={'ContentType': content_type(path)})
+        except Exception as e:
+            # it'll just be uploaded with the rest of the dir instead
+            print("ERROR: %s: %s" % (path, e))
+            return False
+        return True
+
+    files = {}
+    for relpath in find_files(upload_dir):
+        path = os.path.join(upload_dir, relpath)
+        digest = hash_file(path)
+        files[relpath] = {'sha256': digest, 'size': os.path.getsize(path),
+                          'blob': blob_name(relpath, digest)}
+    if not files:
+        return
+
+    conn = open_known_db()
+    cutoff = time.time() - KNOWN_MAX_AGE
+    known = set()
+    for (blob,) in conn.execute('SELECT key FROM known WHERE timestamp > ?',
+                                (cutoff,)):
+        known.add(blob)
+
+    # several files may well have the same content
+    todo = {}
+    for relpath, entry in files.items():
+        key = 's3://%s/%s' % (bucket, key_of(entry['blob']))
+        if key not in known:
+            todo.setdefault(entry['blob'], (relpath, key))
+
+    failed = set()
+    with concurrent.futures.ThreadPoolExecutor(UPLOAD_THREADS) as executor:
+        futures = {executor.submit(upload, os.path.join(upload_dir, relpath),
+                                   blob): (blob, key)
+                   for blob, (relpath, key) in todo.items()}
+        for future in concurrent.futures.as_completed(futures):
+            blob, key = futures[future]
+            if future.result():
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO known VALUES (?, ?)',
+                                 (key, time.time()))
+            else:
+                failed.add(blob)
+
+    with conn:
+        conn.execute('DELETE FROM known WHERE timestamp <= ?', (cutoff,))
+    conn.close()
+
+    stored = {p: e for p, e in files.items() if e['blob'] not in failed}
+    print("INFO: stored %d files as blobs (%d not known yet)" %
+          (len(stored), len(set(todo) - failed)))
+
+    # only remove the files once the manifest pointing to them is written
+    with open(os.path.join(upload_dir, 'manifest.json'), 'w') as f:
+        json.dump({'files': stored}, f, indent=2, sort_keys=True)
+    for relpath in stored:
+        os.unlink(os.path.join(upload_dir, relpath))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,3 +25,37 @@ def str_to_timeout(s):
     if s.endswith('h'):
         timeout *= 60 * 60
     return timeout
+
+
+# translate a glob into a regex; '*' and '?' do not match '/', whereas '**'
+# matches across directories, and a trailing '/' matches a whole directory
+def glob_to_regex(pattern):
+    if pattern.endswith('/'):
+        pattern += '**'
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+# compile a list of globs into a single regex so that matching a path
+# against all of them is a single pass
+def compile_globs(patterns):
+    assert len(patterns) > 0
+    regexes = [glob_to_regex(p) for p in patterns]
+    return re.compile('(?:%s)' % '|'.join(regexes))
@@ -29,27 +29,21 @@ common_update_github() {
         return
     fi
 
+    # Also update the merge sha if we're testing a merge commit.
+    # This is useful for homu: https://github.com/servo/homu/pull/54
+    local merge_commit=
+    if [ -f state/is_merge_sha ]; then
+        merge_commit="--commit $(cat state/sha)"
+    fi
+
     python3 $THIS_DIR/utils/gh.py \
         --repo $github_repo \
-        --commit $github_commit \
+        --commit $github_commit $merge_commit \
         --token env:github_token \
         --state "$ghstate" \
         --context "$context" \
         --description "$description" \
         --url "$url"
-
-    # Also update the merge sha if we're testing a merge commit.
-    # This is useful for homu: https://github.com/servo/homu/pull/54
-    if [ -f state/is_merge_sha ]; then
-        python3 $THIS_DIR/utils/gh.py \
-            --repo $github_repo \
-            --commit $(cat state/sha) \
-            --token env:github_token \
-            --state "$ghstate" \
-            --context "$context" \
-            --description "$description" \
-            --url "$url"
-    fi
 }
 
 # Block until a node is available through SSH
@@ -59,7 +53,10 @@ ssh_wait() {
     local node_addr=$1; shift
     local node_key=$1; shift
 
-    timeout 300s "$THIS_DIR/utils/sshwait" $node_addr
+    if ! timeout 300s "$THIS_DIR/utils/sshwait" $node_addr; then
+        echo "ERROR: Timed out while waiting for SSH."
+        return 1
+    fi
 
     # We have to be extra cautious here -- OpenStack
     # networking takes some time to settle, so we wait until
@@ -98,22 +95,100 @@ ssh_wait() {
     fi
 }
 
-# Generic query to the GitHub API
+# Exit code of commands which failed because of a transient
+# infrastructure error (EX_TEMPFAIL), i.e. which may well
+# succeed if tried again.
+TRANSIENT_RC=75
+
+# How many times transient errors of each phase are retried
+# per runner, and for how long after the first attempt (in
+# secs). Overridable through $retry_budgets, e.g.
+# "provision=3:3600,pull=0".
+declare -A RETRY_BUDGETS=(
+    [provision]=2:1800
+    [pull]=3:600
+    [makecache]=4:600
+)
+
+# Print the "retries:deadline" budget of a phase
+# $1    phase
+retry_budget() {
+    local budget=${RETRY_BUDGETS[$1]:-0:0}
+    local overrides=${retry_budgets:-}
+    local entry
+    for entry in ${overrides//,/ }; do
+        if [ "${entry%%=*}" == $1 ]; then
+            local override=${entry#*=}
+            if [[ $override == *:* ]]; then
+                budget=$override
+            else
+                budget=$override:${budget#*:}
+            fi
+        fi
+    done
+    echo $budget
+}
+
+# Run a command, retrying it as long as it fails with
+# $TRANSIENT_RC and the budget of the phase isn't exhausted.
+# Failed attempts are recorded in the timings of the runner
+# as "<phase>.retry", and count towards the budget of all
+# the attempts of that phase by the runner (e.g. by all the
+# provisioners of a cluster). Once it's exhausted, the phase
+# is added to the transient file of the runner, which lets
+# the spawner rerun it if it fails. Note that like in any
+# condition, errexit does not apply within the command.
+# $1    phase
+# $2..  command
+retry() {
+    local phase=$1; shift
+    local budget=$(retry_budget $phase)
+    local deadline=$(($(date +%s) + ${budget#*:}))
+
+    while true; do
+        local start=$(date +%s.%N)
+        local rc=0
+        "$@" || rc=$?
+        if [ $rc != $TRANSIENT_RC ]; then
+            return $rc
+        fi
+
+        local used=0
+        if [ -f $state/timings ]; then
+            used=$(grep -c "^$phase\.retry " $state/timings || :)
+        fi
+        echo "$phase.retry $start $(date +%s.%N)" >> $state/timings
+        if [ $used -ge ${budget%:*} ] || [ $(date +%s) -ge $deadline ]; then
+            echo "ERROR: $phase failed, giving up after $used retries."
+            echo $phase >> $state/transient
+            return $rc
+        fi
+
+        echo "WARNING: $phase failed, retrying ($((used + 1))/${budget%:*})..."
+        sleep $((10 * (used + 1)))
+    done
+}
+
+# Run a command, considering any failure as transient.
+# $@    command
+as_transient() {
+    "$@" || return $TRANSIENT_RC
+}
+
+# Generic query to the GitHub API, through the HTTP cache
 # $1    resource
 # $2..  path to key to print
 query_github() {
-    resource=$1; shift
-    python3 -c "
-import sys
-import requests
-header = {'Authorization': 'token ${github_token}'}
-d = requests.get('https://api.github.com/repos/${github_repo}/$resource', headers=header)
-if (d.status_code != requests.codes.ok):
-    raise Exception('API Error: {}'.format(d.content))
-j = d.json()
-for q in sys.argv[1:]:
-    if q.isdigit():
-        q = int(q)
-    j = j[q]
-print(j)" "$@"
+    python3 $THIS_DIR/utils/httpcache.py github "$@"
+}
+
+# Print the python3 options to run a script under cProfile if
+# profiling of the given component was requested through
+# $PAPR_PROFILE (see profiling.py).
+# $1    component
+profile_opts() {
+    local wanted=${PAPR_PROFILE:-}
+    if [ "$wanted" == all ] || [[ ,$wanted, == *,$1,* ]]; then
+        echo "-m cProfile -o ${PAPR_PROFILE_DIR:-state/profiles}/$1.$$.prof"
+    fi
 }
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+'''
+    This script is not meant to be run manually. It is
+    started by the testrunner once the container of a
+    testsuite is up (if docker_api is set), and serves the
+    envcmd, envcp and envfetch calls of that testrunner
+    through the Docker Engine API rather than forking a
+    `sudo docker exec/cp` (and opening a new API connection)
+    for each of them.
+
+    It runs as root, like those commands would, and listens
+    on a Unix socket owned by the testrunner user. A request
+    is a list of NUL-terminated fields, preceded by their
+    number:
+
+      exec RCFILE TIMEOUT ARG...  -- run a command
+      put RCFILE SRC DEST         -- copy local SRC to DEST
+      get RCFILE SRC DEST         -- copy SRC to local DEST
+      quit RCFILE                 -- exit
+
+    Copies have the same semantics as `docker cp`. The output
+    of the command (stdout and stderr, interleaved) or any
+    error is streamed back, and the exit code is then written
+    to RCFILE before closing the connection. This keeps the
+    client side to just `printf | nc -U` (see dockerctl() in
+    the testrunner). RCFILE must be a dockerctl.rc.* file in
+    the dir of the socket (i.e. the state dir of the suite).
+
+    Extracting files from the container as root is only safe
+    with tarfile extraction filters (Python 3.12, or backports
+    thereof). Without them, `get` is refused, and a
+    SOCKET.noget file tells the testrunner to keep using
+    `docker cp` for those.
+'''
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import struct
+import tarfile
+import argparse
+import tempfile
+import threading
+import contextlib
+import http.client
+import socketserver
+import urllib.parse
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+
+# same as `timeout --signal=KILL`
+TIMEOUT_RC = 137
+
+# os.ModeDir in the path stats of the archive endpoint
+MODE_DIR = 1 << 31
+
+
+class DockerError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+class Docker:
+    "Minimal client for the API of a single container."
+
+    def __init__(self, sock_path, cid):
+        self.sock_path = sock_path
+        self.cid = cid
+        # idle keep-alive connections; a request only needs a
+        # new one if they're all busy (e.g. streaming an exec)
+        self.pool = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def request(self, method, path, body=None, headers={}):
+        "Yields the connection and response of an API request."
+
+        with self.lock:
+            conn = self.pool.pop() if self.pool else None
+        resp = None
+        try:
+            if conn is not None:
+                try:
+                    resp = self._send(conn, method, path, body, headers)
+                except ConnectionError:
+                    # the daemon closed it while idle
+                    conn.close()
+            if resp is None:
+                conn = UnixHTTPConnection(self.sock_path)
+                resp = self._send(conn, method, path, body, headers)
+            yield conn, resp
+        except BaseException:
+            if conn is not None:
+                conn.close()
+            raise
+        # only reuse connections left in a clean state; exec
+        # streams in particular are closed by the daemon
+        if resp.isclosed() and conn.sock is not None:
+            with self.lock:
+                self.pool.append(conn)
+        else:
+            conn.close()
+
+    def _send(self, conn, method, path, body, headers):
+        if hasattr(body, 'seek'):
+            body.seek(0)
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def call(self, method, path, data=None):
+        "Makes a JSON API request and returns the decoded reply."
+
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        with self.request(method, path, body, headers) as (_, resp):
+            reply = resp.read()
+        check(resp, reply)
+        return json.loads(reply.decode('utf-8')) if reply else None
+
+    def exec(self, cmd, out, timeout=None):
+        "Runs a command, streaming its output. Returns its exit code."
+
+        exec_id = self.call('POST', '/containers/%s/exec' % self.cid,
+                            {'Cmd': cmd, 'AttachStdout': True,
+                             'AttachStderr': True})['Id']
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        # the daemon hijacks this connection for the stream and
+        # closes it at the end, so there's no point pooling it
+        conn = UnixHTTPConnection(self.sock_path)
+        body = json.dumps({'Detach': False, 'Tty': False}).encode('utf-8')
+        try:
+            conn.connect()
+            sock = conn.sock
+            resp = self._send(conn, 'POST', '/exec/%s/start' % exec_id,
+                              body, {'Content-Type': 'application/json'})
+            with contextlib.closing(resp):
+                if resp.status != 200:
+                    check(resp, resp.read())
+                demux(sock, resp, out, deadline)
+        except socket.timeout:
+            # NB: like with the docker CLI, this doesn't
+            # kill the command itself, just stops waiting
+            return TIMEOUT_RC
+        finally:
+            conn.close()
+
+        return self.call('GET', '/exec/%s/json' % exec_id)['ExitCode']
+
+    def stat(self, path):
+        "Returns the path stats of a file, or None if it doesn't exist."
+
+        with self.request('HEAD', archive_path(self.cid, path)) as (_, resp):
+            resp.read()
+        if resp.status == 404:
+            return None
+        check(resp, b'')
+        stat = resp.headers['X-Docker-Container-Path-Stat']
+        return json.loads(base64.b64decode(stat).decode('utf-8'))
+
+    def put(self, src, dest):
+        "Copies a local file or dir into the container."
+
+        contents = src.endswith('/.')
+        src = os.path.normpath(src)
+
+        stat = self.stat(dest)
+        if stat is not None and stat['mode'] & MODE_DIR:
+            parent, name = dest, os.path.basename(src)
+        else:
+            # create or replace dest itself
+            parent, name = os.path.split(dest.rstrip('/'))
+            contents = False
+
+        with tempfile.TemporaryFile() as f:
+            with tarfile.open(fileobj=f, mode='w') as tar:
+                if contents:
+                    for entry in sorted(os.listdir(src)):
+                        tar.add(os.path.join(src, entry), arcname=entry,
+                                filter=as_root)
+                else:
+                    tar.add(src, arcname=name, filter=as_root)
+            size = f.tell()
+            with self.request('PUT', archive_path(self.cid, parent), f,
+                              {'Content-Type': 'application/x-tar',
+                               'Content-Length': str(size)}) as (_, resp):
+                reply = resp.read()
+            check(resp, reply)
+
+    def get(self, src, dest, owner):
+        "Copies a file or dir from the container, owned by owner."
+
+        contents = src.endswith('/.')
+        src = os.path.normpath(src)
+
+        if os.path.isdir(dest):
+            root, name = dest, None
+        else:
+            root, name = os.path.split(dest.rstrip('/'))
+            contents = False
+
+        with self.request('GET', archive_path(self.cid, src)) as (_, resp):
+            if resp.status != 200:
+                check(resp, resp.read())
+            extracted = []
+            with tarfile.open(fileobj=resp, mode='r|') as tar:
+                members = rebase(tar, contents, name, extracted)
+                # the 'tar' filter keeps us within root, even if
+                # the container has e.g. symlinks pointing out of it
+                tar.extractall(root or '.', members=members, filter='tar')
+            # so that the connection can be reused
+            resp.read()
+
+        for member in extracted:
+            os.lchown(os.path.join(root, member), *owner)
+
+
+def check(resp, reply):
+    if resp.status < 400:
+        return
+    try:
+        msg = json.loads(reply.decode('utf-8'))['message']
+    except ValueError:
+        msg = reply.decode('utf-8', 'replace').strip()
+    raise DockerError("%d %s" % (resp.status, msg))
+
+
+def archive_path(cid, path):
+    return '/containers/%s/archive?%s' % (
+        cid, urllib.parse.urlencode({'path': path}))
+
+
+def as_root(tarinfo):
+    "Makes copies owned by root in the container, like docker cp."
+
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    return tarinfo
+
+
+def rebase(tar, contents, name, extracted):
+    """
+    Yields the members of an archive of the container with
+    their top-level dir stripped (if contents) or renamed
+    (if name), and appends their final names to extracted.
+    """
+
+    def rename(path):
+        top, _, rest = path.partition('/')
+        if contents:
+            return rest
+        if name is not None:
+            return name + '/' + rest if rest else name
+        return path
+
+    for member in tar:
+        member.name = rename(member.name)
+        if not member.name:
+            # the dir whose contents we want
+            continue
+        if member.islnk():
+            member.linkname = rename(member.linkname)
+        extracted.append(member.name)
+        yield member
+
+
+def demux(sock, resp, out, deadline):
+    "Copies the stdout and stderr frames of an exec stream to out."
+
+    while True:
+        if deadline is not None:
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+        header = resp.read(8)
+        if len(header) < 8:
+            return
+        _, size = struct.unpack('>BxxxL', header)
+        while size > 0:
+            data = resp.read(min(size, 65536))
+            if not data:
+                return
+            size -= len(data)
+            out.write(data)
+
+
+def parse_timeout(value):
+    if value in ['-', 'infinity']:
+        return None
+    return float(value)
+
+
+def can_get():
+    "Whether we can safely extract archives of the container."
+    return hasattr(tarfile, 'tar_filter')
+
+
+def make_handler(docker, owner, state_dir):
+
+    def valid_rcfile(path):
+        # we run as root, so don't let clients write just anywhere
+        return (os.path.dirname(os.path.realpath(path)) == state_dir and
+                os.path.basename(path).startswith('dockerctl.rc.'))
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            fields = self.read_fields()
+            if fields is None or len(fields) < 2:
+                return
+            op, rcfile, args = fields[0], fields[1], fields[2:]
+            if not valid_rcfile(rcfile):
+                self.write("dockerctl: invalid rcfile: %s\n" % rcfile)
+                return
+
+            try:
+                rc = self.dispatch(op, args)
+            except (DockerError, OSError, tarfile.TarError, ValueError,
+                    KeyError, IndexError, http.client.HTTPException) as e:
+                self.write("dockerctl: %s: %s\n" % (op, e))
+                rc = 1
+
+            # NB: don't follow symlinks planted in place of it
+            fd = os.open(rcfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                         os.O_NOFOLLOW, 0o644)
+            with os.fdopen(fd, 'w') as f:
+                os.fchown(fd, *owner)
+                f.write('%d\n' % rc)
+
+            if op == 'quit':
+                threading.Thread(target=self.server.shutdown).start()
+
+        def read_fields(self):
+            # the first field is the number of fields which follow
+            data = b''
+            count = None
+            while count is None or data.count(b'\0') < count + 1:
+                chunk = self.rfile.read1(65536)
+                if not chunk:
+                    return None
+                data += chunk
+                if count is None and b'\0' in data:
+                    count = int(data[:data.index(b'\0')])
+            fields = data.split(b'\0')[1:count + 1]
+            return [f.decode('utf-8', 'surrogateescape') for f in fields]
+
+        def dispatch(self, op, args):
+            if op == 'exec':
+                return docker.exec(args[1:], self.wfile,
+                                   parse_timeout(args[0]))
+            elif op == 'put':
+                docker.put(args[0], args[1])
+            elif op == 'get':
+                if not can_get():
+                    raise ValueError("unsupported without tarfile filters")
+                docker.get(args[0], args[1], owner)
+            elif op != 'quit':
+                raise ValueError("unknown operation")
+            return 0
+
+        def write(self, msg):
+            try:
+                self.wfile.write(msg.encode('utf-8'))
+            except OSError:
+                pass
+
+    return Handler
+
+
+def watch_parent(pid, server):
+    "Exits once the testrunner is gone, e.g. with PAPR_DEBUG_NO_TEARDOWN."
+
+    while os.path.exists('/proc/%d' % pid):
+        time.sleep(5)
+    server.shutdown()
+
+
+def serve(args):
+    owner = tuple(int(i) for i in args.owner.split(':'))
+    state_dir = os.path.dirname(os.path.realpath(args.socket))
+
+    docker = Docker(args.docker_socket, args.cid)
+    # fail early (and let the testrunner use the CLI) if we can't reach it
+    docker.call('GET', '/containers/%s/json' % args.cid)
+
+    if not can_get():
+        # we must not extract container files as root without them
+        print("dockerctl: tarfile extraction filters not supported, "
+              "copies from the container go through the CLI",
+              file=sys.stderr)
+        with open(args.socket + '.noget', 'w'):
+            pass
+
+    # only expose the socket once it's ready and has the right owner
+    tmp = args.socket + '.tmp'
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    server = socketserver.ThreadingUnixStreamServer(
+        tmp, make_handler(docker, owner, state_dir))
+    server.daemon_threads = True
+    os.chown(tmp, *owner)
+    os.chmod(tmp, 0o600)
+    os.rename(tmp, args.socket)
+
+    if args.parent is not None:
+        threading.Thread(target=watch_parent, args=(args.parent, server),
+                         daemon=True).start()
+
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(args.socket)
+    return 0
+
+
+def main():
+    "Main entry point."
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    server = subparsers.add_parser('serve')
+    server.add_argument('cid', help="ID of the container")
+    server.add_argument('socket', help="path of the socket to listen on")
+    server.add_argument('--owner', required=True, metavar='UID:GID',
+                        help="owner of the socket and fetched files")
+    server.add_argument('--parent', type=int, metavar='PID',
+                        help="exit once this process is gone")
+    server.add_argument('--docker-socket', default=DOCKER_SOCKET,
+                        metavar='PATH', help="path of the docker socket "
+                        "(default: %s)" % DOCKER_SOCKET)
+
+    args = parser.parse_args()
+    return serve(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
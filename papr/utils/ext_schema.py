@@ -68,6 +68,23 @@ def ext_repos(value, rule_obj, path):
     return True
 
 
+def ext_tests(value, rule_obj, path):
+    # Until this is fixed:
+    # https://github.com/Grokzen/pykwalify/issues/67
+    if type(value) is not list:
+        raise SchemaError("expected list of str or lists of str")
+    for i, test in enumerate(value):
+        if type(test) is list:
+            if len(test) == 0:
+                raise SchemaError("parallel group %d is empty" % i)
+            if any(type(t) is not str for t in test):
+                raise SchemaError("parallel group %d is not a list of str"
+                                  % i)
+        elif type(test) is not str:
+            raise SchemaError("test %d is not a str or list of str" % i)
+    return True
+
+
 def ext_ostree(value, rule_obj, path):
     if type(value) is str:
         if value != "latest":
@@ -92,6 +109,12 @@ def ext_timeout(value, rule_obj, path):
     return True
 
 
+def ext_shards(value, rule_obj, path):
+    if value < 1 or value > 10:
+        raise SchemaError("shards must be between 1 and 10")
+    return True
+
+
 def ext_build(value, rule_obj, path):
     if type(value) not in [dict, bool]:
         raise SchemaError("expected bool or map")
@@ -99,7 +122,8 @@ def ext_build(value, rule_obj, path):
         schema = {'mapping':
                   {'config-opts': {'type': 'str'},
                    'build-opts': {'type': 'str'},
-                   'install-opts': {'type': 'str'}
+                   'install-opts': {'type': 'str'},
+                   'ccache': {'type': 'bool'}
                    }
                   }
         c = Core(source_data=value, schema_data=schema)
@@ -13,9 +13,16 @@ import os
 import sys
 import json
 import argparse
-import requests
 import datetime
-from simplejson.scanner import JSONDecodeError
+
+# we're also run as a script
+if __package__:
+    from . import profiling
+else:
+    import profiling  # pylint: disable=import-error
+
+# can be pointed at e.g. a GitHub Enterprise instance
+API_URL = os.environ.get('github_api_url', 'https://api.github.com')
 
 
 class CommitNotFoundException(Exception):
@@ -26,8 +33,9 @@ def _main():
     "Main entry point."
 
     args = _parse_args()
-    status(args.repo, args.commit, args.token, args.state,
-           args.context, args.description, args.url)
+    for commit in args.commit:
+        status(args.repo, commit, args.token, args.state,
+               args.context, args.description, args.url)
 
 
 def _parse_args():
@@ -37,10 +45,12 @@ def _parse_args():
     """
 
     parser = argparse.ArgumentParser()
-    required_args = ['repo', 'commit', 'token', 'state']
+    required_args = ['repo', 'token', 'state']
     optional_args = ['context', 'description', 'url']
     for arg in required_args:
         parser.add_argument('--' + arg, required=True)
+    # multiple commits can be updated at once to save on startup time
+    parser.add_argument('--commit', required=True, action='append')
     for arg in optional_args:
         parser.add_argument('--' + arg)
     args = parser.parse_args()
@@ -66,9 +76,17 @@ def _parse_args():
                         "argument is empty." % arg)
                 setattr(args, arg, None)
 
+    for i, val in enumerate(args.commit):
+        if val.startswith('env:'):
+            args.commit[i] = os.environ.get(val[4:])
+        if not args.commit[i]:
+            parser.error("Parameter 'commit' is required, but the given "
+                         "argument '%s' is empty." % val)
+
     return args
 
 
+@profiling.profiled('gh')
 def status(repo, commit, token, state,
            context=None, description=None, url=None):
     data = _craft_data_dict(state, context, description, url)
@@ -91,9 +109,11 @@ def _craft_data_dict(state, context, description, url):
 def _update_status(repo, commit, token, data):
     "Sends the status update's data using the GitHub API."
 
+    # NB: requests is slow to import, so only do it when needed
+    import requests
+
     header = {'Authorization': 'token ' + token}
-    api_url = ("https://api.github.com/repos/%s/statuses/%s" %
-               (repo, commit))
+    api_url = "%s/repos/%s/statuses/%s" % (API_URL, repo, commit)
 
     if __name__ == '__main__':
         eprint("Updating status of commit", commit, "with data", data)
@@ -103,7 +123,9 @@ def _update_status(repo, commit, token, data):
         resp = requests.post(api_url, data=json.dumps(data), headers=header)
         _print_ratelimit_info(resp)
         body = resp.json()
-    except JSONDecodeError:
+    # NB: this is the base class of the JSON decoding errors raised by
+    # requests, whether it uses simplejson or json
+    except ValueError:
         eprint("Expected JSON, but received:")
         eprint("---")
         eprint(resp.content)
@@ -131,9 +153,10 @@ def _update_status(repo, commit, token, data):
 def comment(repo, token, issue, text):
     "Creates a comment using the GitHub API."
 
+    import requests
+
     token_header = {'Authorization': 'token ' + token}
-    api_url = ("https://api.github.com/repos/%s/issues/%d/comments" %
-               (repo, issue))
+    api_url = "%s/repos/%s/issues/%d/comments" % (API_URL, repo, issue)
 
     data = {'body': text}
 
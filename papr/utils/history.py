@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+'''
+    History of past runs, kept in a SQLite database in the
+    cache dir. The spawner records every run in it, along
+    with the duration of each testsuite and of each phase of
+    its runners (as written by the testrunner in
+    state/suite-N/timings). It is then used to start the
+    longest testsuites first, and can be queried, e.g.:
+
+      papr-history stats --repo owner/repo
+      papr-history phases --days 7
+      papr-history flaky
+
+    The stats include a suggested timeout for each suite
+    based on its past durations, which is usually much
+    tighter than the default of 2h.
+
+    If usage_sampling is set, the resource usage of each
+    runner (see sampler.sh) is summarized in it as well:
+
+      papr-history usage --repo owner/repo
+'''
+
+import os
+import sys
+import csv
+import math
+import time
+import sqlite3
+import argparse
+
+from . import common
+
+HISTORY_DB = 'cache/history.sqlite'
+
+# how many of the latest runs of a suite to use to estimate its duration,
+# and how far back to look for them
+EXPECTED_SAMPLES = 20
+EXPECTED_DAYS = 30
+
+# bounds how many rows we look at for all the suites of a repo
+EXPECTED_MAX_ROWS = 2000
+
+# we don't suggest timeouts for suites with fewer runs than this
+MIN_SAMPLES = 5
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        repo TEXT NOT NULL,
+        branch TEXT,
+        pull_id INTEGER,
+        commit_sha TEXT,
+        started REAL NOT NULL,
+        finished REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS suites (
+        run_id INTEGER NOT NULL REFERENCES runs(id),
+        context TEXT NOT NULL,
+        -- one of ran, cached, skipped or cancelled
+        outcome TEXT NOT NULL,
+        rc INTEGER,
+        -- only set if outcome is ran
+        duration REAL,
+        timeout INTEGER,
+        cache_key TEXT
+    );
+    CREATE TABLE IF NOT EXISTS phases (
+        run_id INTEGER NOT NULL REFERENCES runs(id),
+        context TEXT NOT NULL,
+        runner INTEGER NOT NULL,
+        phase TEXT NOT NULL,
+        duration REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS usage (
+        run_id INTEGER NOT NULL REFERENCES runs(id),
+        context TEXT NOT NULL,
+        runner INTEGER NOT NULL,
+        samples INTEGER NOT NULL,
+        ncpus INTEGER,
+        -- fraction of ncpus busy between samples
+        cpu_p50 REAL,
+        cpu_p95 REAL,
+        cpu_peak REAL,
+        -- in MiB; swap and disk are NULL for containers
+        mem_p95 REAL,
+        mem_peak REAL,
+        mem_total REAL,
+        swap_peak REAL,
+        swapped_pages INTEGER,
+        disk_peak REAL,
+        io_read REAL,
+        io_write REAL
+    );
+    CREATE INDEX IF NOT EXISTS runs_repo ON runs (repo, started);
+    CREATE INDEX IF NOT EXISTS suites_run ON suites (run_id);
+    CREATE INDEX IF NOT EXISTS phases_run ON phases (run_id);
+    CREATE INDEX IF NOT EXISTS usage_run ON usage (run_id);
+'''
+
+
+def open_db():
+    os.makedirs(os.path.dirname(HISTORY_DB), exist_ok=True)
+    # concurrent runs may be recording at the same time
+    db = sqlite3.connect(HISTORY_DB, timeout=60)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+def record_run(suites, started):
+    "Record a run, given the suites as annotated by the spawner."
+
+    db = open_db()
+    with db:
+        cur = db.execute("INSERT INTO runs (repo, branch, pull_id, "
+                         "commit_sha, started, finished) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (os.environ['github_repo'],
+                          os.environ.get('github_branch'),
+                          os.environ.get('github_pull_id'),
+                          os.environ.get('github_commit'),
+                          started, time.time()))
+        run_id = cur.lastrowid
+        for suite in suites:
+            # suites interrupted before finishing have no duration
+            outcome = suite.get('outcome', 'cancelled')
+            if outcome == 'ran' and suite.get('duration') is None:
+                outcome = 'cancelled'
+            db.execute("INSERT INTO suites (run_id, context, outcome, rc, "
+                       "duration, timeout, cache_key) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (run_id, suite['context'], outcome, suite.get('rc'),
+                        suite.get('duration'),
+                        common.str_to_timeout(suite.get('timeout', '2h')),
+                        suite.get('cache_key')))
+            if outcome != 'ran':
+                continue
+            for idx in suite['runners']:
+                for phase, duration in read_timings(idx):
+                    db.execute("INSERT INTO phases (run_id, context, runner, "
+                               "phase, duration) VALUES (?, ?, ?, ?, ?)",
+                               (run_id, suite['context'], idx, phase,
+                                duration))
+                usage = read_usage(idx)
+                if usage is not None:
+                    usage.update(run_id=run_id, context=suite['context'],
+                                 runner=idx)
+                    db.execute("INSERT INTO usage (%s) VALUES (%s)" %
+                               (', '.join(usage),
+                                ', '.join(['?'] * len(usage))),
+                               list(usage.values()))
+    db.close()
+
+
+def read_timings(idx):
+    "Returns the (phase, duration) tuples recorded by a testrunner."
+
+    fn = 'state/suite-%d/timings' % idx
+    if not os.path.isfile(fn):
+        return []
+
+    timings = []
+    with open(fn) as f:
+        for line in f:
+            phase, start, end = line.split()
+            timings.append((phase, float(end) - float(start)))
+    return timings
+
+
+def read_usage(idx):
+    "Summarizes the usage samples of a testrunner, if any."
+
+    fn = 'state/suite-%d/usage.csv' % idx
+    if not os.path.isfile(fn):
+        return None
+
+    with open(fn) as f:
+        # the last line may have been cut short when the sampler was killed
+        samples = [row for row in csv.DictReader(f)
+                   if None not in row.values()]
+    if not samples:
+        return None
+
+    def column(name, scale=1):
+        return [int(row[name]) / scale for row in samples if row[name]]
+
+    def delta(name, scale=1):
+        values = column(name, scale)
+        return values[-1] - values[0] if values else None
+
+    # utilization between consecutive samples
+    cpu = []
+    for prev, cur in zip(samples, samples[1:]):
+        if not (prev['cpu_usec'] and cur['cpu_usec'] and cur['ncpus']):
+            continue
+        secs = int(cur['time']) - int(prev['time'])
+        if secs > 0:
+            used = int(cur['cpu_usec']) - int(prev['cpu_usec'])
+            cpu.append(used / (secs * 1e6 * int(cur['ncpus'])))
+
+    mem = column('mem_used_kb', 1024)
+    mem_total = column('mem_total_kb', 1024)
+    swap = column('swap_used_kb', 1024)
+    disk = column('disk_used_kb', 1024)
+    ncpus = column('ncpus')
+    return {'samples': len(samples),
+            'ncpus': int(max(ncpus)) if ncpus else None,
+            'cpu_p50': percentile(cpu, 50) if cpu else None,
+            'cpu_p95': percentile(cpu, 95) if cpu else None,
+            'cpu_peak': max(cpu) if cpu else None,
+            'mem_p95': percentile(mem, 95) if mem else None,
+            'mem_peak': max(mem) if mem else None,
+            'mem_total': max(mem_total) if mem_total else None,
+            'swap_peak': max(swap) if swap else None,
+            'swapped_pages': delta('swap_pages'),
+            'disk_peak': max(disk) if disk else None,
+            'io_read': delta('io_read_kb', 1024),
+            'io_write': delta('io_write_kb', 1024)}
+
+
+def expected_durations(repo):
+    "Returns the expected duration in seconds of the suites of a repo."
+
+    if not os.path.isfile(HISTORY_DB):
+        return {}
+
+    db = open_db()
+    samples = {}
+    for row in db.execute("SELECT context, duration FROM suites "
+                          "JOIN runs ON runs.id = suites.run_id "
+                          "WHERE repo = ? AND started > ? "
+                          "AND outcome = 'ran' AND duration IS NOT NULL "
+                          "ORDER BY started DESC LIMIT ?",
+                          (repo, time.time() - EXPECTED_DAYS * 24 * 60 * 60,
+                           EXPECTED_MAX_ROWS)):
+        durations = samples.setdefault(row['context'], [])
+        if len(durations) < EXPECTED_SAMPLES:
+            durations.append(row['duration'])
+    db.close()
+
+    return {context: percentile(durations, 50)
+            for context, durations in samples.items()}
+
+
+def percentile(values, p):
+    "Nearest-rank percentile."
+
+    values = sorted(values)
+    rank = int(math.ceil(p / 100 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def suggest_timeout(durations):
+    "Suggest a timeout string with some margin above most durations."
+
+    if len(durations) < MIN_SAMPLES:
+        return None
+
+    # round up to the next 5 minutes
+    minutes = percentile(durations, 95) * 1.5 / 60
+    return "%dm" % (int(math.ceil(minutes / 5)) * 5)
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+    if not os.path.isfile(HISTORY_DB):
+        print("No history recorded in %s." % HISTORY_DB)
+        return 1
+    db = open_db()
+    return args.func(db, args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the run history")
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    stats = subparsers.add_parser('stats', help="duration and verdict "
+                                  "statistics per context")
+    stats.set_defaults(func=cmd_stats)
+
+    phases = subparsers.add_parser('phases', help="slowest phases")
+    phases.add_argument('--limit', type=int, default=20, metavar='N',
+                        help="list at most N phases")
+    phases.set_defaults(func=cmd_phases)
+
+    flaky = subparsers.add_parser('flaky', help="contexts which both passed "
+                                  "and failed on the same content")
+    flaky.set_defaults(func=cmd_flaky)
+
+    usage = subparsers.add_parser('usage', help="resource usage per "
+                                  "context, if sampled")
+    usage.set_defaults(func=cmd_usage)
+
+    for p in [stats, phases, flaky, usage]:
+        p.add_argument('--repo', help="only consider runs of this repo")
+        p.add_argument('--days', type=int, default=30, metavar='N',
+                       help="only consider runs of the last N days "
+                       "(default: 30)")
+
+    return parser.parse_args()
+
+
+def query_suites(db, args, columns, where=''):
+    "Select from the suites of the runs matching the repo/days filters."
+
+    query = ("SELECT repo, %s FROM suites JOIN runs "
+             "ON runs.id = suites.run_id WHERE started > ?" % columns)
+    params = [time.time() - args.days * 24 * 60 * 60]
+    if args.repo:
+        query += " AND repo = ?"
+        params.append(args.repo)
+    return db.execute(query + where, params)
+
+
+def cmd_stats(db, args):
+    stats = {}
+    for row in query_suites(db, args, 'context, outcome, rc, duration',
+                            " AND (outcome != 'ran' "
+                            "OR duration IS NOT NULL)"):
+        s = stats.setdefault((row['repo'], row['context']),
+                             {'n': 0, 'cached': 0, 'failed': 0,
+                              'durations': []})
+        s['n'] += 1
+        if row['outcome'] == 'cached':
+            s['cached'] += 1
+        elif row['outcome'] == 'ran':
+            s['durations'].append(row['duration'])
+            if row['rc'] != 0:
+                s['failed'] += 1
+
+    print("%-40s %5s %7s %7s %7s %7s %8s" % ("CONTEXT", "RUNS", "P50",
+                                             "P95", "FAILED", "CACHED",
+                                             "TIMEOUT"))
+    for (repo, context), s in sorted(stats.items()):
+        durations = s['durations']
+        p50 = p95 = failed = '-'
+        if durations:
+            p50 = format_duration(percentile(durations, 50))
+            p95 = format_duration(percentile(durations, 95))
+            failed = "%d%%" % (100 * s['failed'] / len(durations))
+        name = context if args.repo else "%s: %s" % (repo, context)
+        print("%-40s %5d %7s %7s %7s %6d%% %8s" %
+              (name, s['n'], p50, p95, failed, 100 * s['cached'] / s['n'],
+               suggest_timeout(durations) or '-'))
+    return 0
+
+
+def cmd_phases(db, args):
+    query = ("SELECT repo, phases.context, phase, phases.duration "
+             "FROM phases JOIN runs ON runs.id = phases.run_id "
+             "WHERE started > ?")
+    params = [time.time() - args.days * 24 * 60 * 60]
+    if args.repo:
+        query += " AND repo = ?"
+        params.append(args.repo)
+
+    samples = {}
+    for row in db.execute(query, params):
+        key = (row['repo'], row['context'], row['phase'])
+        samples.setdefault(key, []).append(row['duration'])
+
+    phases = [(percentile(durations, 95), percentile(durations, 50), key)
+              for key, durations in samples.items()]
+    phases.sort(reverse=True)
+
+    print("%-40s %-12s %7s %7s" % ("CONTEXT", "PHASE", "P50", "P95"))
+    for p95, p50, (repo, context, phase) in phases[:args.limit]:
+        name = context if args.repo else "%s: %s" % (repo, context)
+        print("%-40s %-12s %7s %7s" % (name, phase, format_duration(p50),
+                                       format_duration(p95)))
+    return 0
+
+
+def cmd_flaky(db, args):
+    # results of the same suite definition on the same tree should
+    # always be the same; if not, then the suite is flaky
+    verdicts = {}
+    for row in query_suites(db, args, 'context, rc, cache_key',
+                            " AND outcome = 'ran' "
+                            "AND cache_key IS NOT NULL"):
+        key = (row['repo'], row['context'])
+        passed = verdicts.setdefault(key, {}).setdefault(row['cache_key'],
+                                                         set())
+        passed.add(row['rc'] == 0)
+
+    print("%-40s %6s" % ("CONTEXT", "FLAKES"))
+    for (repo, context), by_key in sorted(verdicts.items()):
+        flakes = len([p for p in by_key.values() if len(p) > 1])
+        if flakes > 0:
+            name = context if args.repo else "%s: %s" % (repo, context)
+            print("%-40s %6d" % (name, flakes))
+    return 0
+
+
+def cmd_usage(db, args):
+    query = ("SELECT repo, usage.* FROM usage JOIN runs "
+             "ON runs.id = usage.run_id WHERE started > ?")
+    params = [time.time() - args.days * 24 * 60 * 60]
+    if args.repo:
+        query += " AND repo = ?"
+        params.append(args.repo)
+
+    samples = {}
+    for row in db.execute(query, params):
+        samples.setdefault((row['repo'], row['context']), []).append(row)
+
+    print("%-40s %5s %4s %6s %6s %7s %7s %7s %7s %7s  %s" %
+          ("CONTEXT", "RUNS", "CPUS", "CPU95", "CPUMAX", "MEM95", "MEMMAX",
+           "MEMTOT", "SWAP", "DISK", "NOTES"))
+    for (repo, context), rows in sorted(samples.items()):
+
+        def values(col):
+            return [row[col] for row in rows if row[col] is not None]
+
+        cpu_p95 = values('cpu_p95')
+        cpu_peak = values('cpu_peak')
+        mem_p95 = values('mem_p95')
+        mem_peak = values('mem_peak')
+        mem_total = values('mem_total')
+        swap = values('swap_peak')
+        swapped = values('swapped_pages')
+        disk = values('disk_peak')
+        ncpus = values('ncpus')
+
+        notes = []
+        if any(swapped) or any(swap):
+            notes.append('swapping')
+        if cpu_p95 and percentile(cpu_p95, 50) > 0.9:
+            notes.append('cpu-starved')
+        if (mem_peak and mem_total and cpu_peak and
+                max(mem_peak) < 0.5 * min(mem_total) and
+                max(cpu_peak) < 0.5):
+            notes.append('oversized')
+
+        name = context if args.repo else "%s: %s" % (repo, context)
+        print("%-40s %5d %4s %6s %6s %7s %7s %7s %7s %7s  %s" %
+              (name, len(rows), max(ncpus) if ncpus else '-',
+               format_fraction(cpu_p95, 95), format_fraction(cpu_peak),
+               format_size(mem_p95, 95), format_size(mem_peak),
+               format_size(mem_total), format_size(swap),
+               format_size(disk), ','.join(notes)))
+    return 0
+
+
+def format_fraction(values, p=None):
+    "Formats the p-th percentile (or max) of fractions as a percentage."
+
+    if not values:
+        return '-'
+    return "%d%%" % (100 * (percentile(values, p) if p else max(values)))
+
+
+def format_size(values, p=None):
+    "Formats the p-th percentile (or max) of sizes in MiB."
+
+    if not values:
+        return '-'
+    mib = percentile(values, p) if p else max(values)
+    if mib < 1024:
+        return "%dM" % mib
+    return "%.1fG" % (mib / 1024)
+
+
+def format_duration(secs):
+    if secs < 60:
+        return "%ds" % secs
+    if secs < 60 * 60:
+        return "%dm%02ds" % (secs // 60, secs % 60)
+    return "%dh%02dm" % (secs // 3600, secs % 3600 // 60)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
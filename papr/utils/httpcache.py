@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+'''
+    Shared on-disk cache of HTTP GET requests, so that e.g.
+    all the testrunners of a run don't each fetch the same
+    GitHub resources and site repo files.
+
+    Entries are fresh for a short TTL, after which they're
+    revalidated with If-None-Match/If-Modified-Since; GitHub
+    doesn't count 304 replies against the rate limit. Keys
+    include a hash of the request headers, so that responses
+    fetched with different tokens are kept apart.
+
+    From bash, it's used as:
+
+      httpcache.py github RESOURCE [KEY...]  -- print a field
+      httpcache.py fetch URL DIR             -- like curl -LO
+'''
+
+import os
+import sys
+import json
+import time
+import fcntl
+import base64
+import hashlib
+import argparse
+import urllib.parse
+
+CACHE_DIR = 'cache/http'
+
+DEFAULT_TTL = 60
+
+# entries older than this are pruned
+MAX_AGE = 24 * 60 * 60
+
+
+def cache_key(url, headers):
+    data = json.dumps([url, sorted((headers or {}).items())])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _read(fn):
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(fn, entry):
+    # write atomically since other runners may be reading concurrently
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+    os.rename(tmp, fn)
+
+
+def get(url, headers=None, ttl=DEFAULT_TTL):
+    """
+    Returns the body of a GET request, from the cache if
+    possible. Raises requests.HTTPError on failure.
+    """
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    key = cache_key(url, headers)
+    fn = os.path.join(CACHE_DIR, key + '.json')
+
+    entry = _read(fn)
+    if entry is not None and time.time() - entry['timestamp'] < ttl:
+        return base64.b64decode(entry['body'])
+
+    # only let one of the runners racing for it make the request
+    with open(os.path.join(CACHE_DIR, key + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        entry = _read(fn)
+        if entry is not None and time.time() - entry['timestamp'] < ttl:
+            return base64.b64decode(entry['body'])
+
+        req_headers = dict(headers or {})
+        if entry is not None:
+            if entry.get('etag'):
+                req_headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                req_headers['If-Modified-Since'] = entry['last_modified']
+
+        # NB: requests is slow to import, so only do it when needed
+        import requests
+
+        resp = requests.get(url, headers=req_headers)
+        if resp.status_code == requests.codes.not_modified and entry:
+            entry['timestamp'] = time.time()
+            _write(fn, entry)
+            return base64.b64decode(entry['body'])
+
+        resp.raise_for_status()
+        _write(fn, {'url': url, 'timestamp': time.time(),
+                    'etag': resp.headers.get('ETag'),
+                    'last_modified': resp.headers.get('Last-Modified'),
+                    'body': base64.b64encode(resp.content).decode('ascii')})
+        return resp.content
+
+
+def github(resource, ttl=DEFAULT_TTL):
+    "Returns the decoded JSON of a resource of the repo under test."
+
+    api_url = os.environ.get('github_api_url', 'https://api.github.com')
+    url = '%s/repos/%s/%s' % (api_url, os.environ['github_repo'], resource)
+    headers = {}
+    if os.environ.get('github_token'):
+        headers['Authorization'] = 'token ' + os.environ['github_token']
+    return json.loads(get(url, headers, ttl).decode('utf-8'))
+
+
+def fetch(url, outdir, ttl=DEFAULT_TTL):
+    "Downloads a file into outdir, named after the last part of its URL."
+
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    path = os.path.join(outdir, name)
+    with open(path, 'wb') as f:
+        f.write(get(url, ttl=ttl))
+    return path
+
+
+def prune():
+    "Delete expired entries."
+
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    now = time.time()
+    for name in os.listdir(CACHE_DIR):
+        fn = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(fn) > MAX_AGE:
+                os.unlink(fn)
+        except OSError:
+            # raced with another run; that's fine
+            pass
+
+
+def main():
+    "Main entry point."
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL,
+                        help="how long responses are fresh for (default: "
+                        "%(default)s secs)")
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    gh = subparsers.add_parser('github', help="print a field of a resource "
+                               "of the repo under test")
+    gh.add_argument('resource', help="e.g. pulls/1")
+    gh.add_argument('keys', nargs='*', metavar='KEY',
+                    help="path to the field to print")
+
+    fetch_cmd = subparsers.add_parser('fetch', help="download a file")
+    fetch_cmd.add_argument('url')
+    fetch_cmd.add_argument('outdir')
+
+    args = parser.parse_args()
+    if args.cmd == 'github':
+        j = github(args.resource, args.ttl)
+        for key in args.keys:
+            j = j[int(key) if key.isdigit() else key]
+        print(j)
+    elif args.cmd == 'fetch':
+        fetch(args.url, args.outdir, args.ttl)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
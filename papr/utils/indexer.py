@@ -25,13 +25,23 @@
 """
 Recursively create index.html file listings for
 directories that do not have any.
+
+Files moved to the blob store (see blobstore.py) are
+listed as if they were still there, linking to their blob.
 """
 
 import os
+import json
 import jinja2
 
 from os import getcwd, listdir
-from os.path import dirname, isfile, isdir, join, realpath
+from os.path import basename, dirname, isfile, isdir, join, realpath, relpath
+
+# we're run as a script
+if __package__:
+    from . import profiling
+else:
+    import profiling  # pylint: disable=import-error
 
 
 def get_index(dirpath):
@@ -43,11 +53,33 @@ def get_index(dirpath):
     return None
 
 
-def create_index(dirpath, tpl, at_top):
+def load_blobs(top):
+    "Returns dir -> file name -> blob of the files in the blob store"
+
+    blobs = {}
+    if isfile(join(top, 'manifest.json')):
+        with open(join(top, 'manifest.json')) as f:
+            manifest = json.load(f)
+        for path, entry in manifest['files'].items():
+            blobs.setdefault(dirname(path), {})[basename(path)] = entry['blob']
+    return blobs
+
+
+def create_index(dirpath, tpl, at_top, blobs=None):
     "Creates a new index.html file"
 
+    if blobs is None:
+        blobs = {}
+
     # get children
     files = {}
+
+    # the blobs dir is a sibling of the top dir
+    rel = relpath(dirpath, getcwd())
+    depth = 0 if rel == '.' else len(rel.split(os.sep))
+    for name, blob in blobs.get('' if rel == '.' else rel, {}).items():
+        files[name] = '../' * (depth + 1) + blob
+
     for name in listdir(dirpath):
         if isdir(join(dirpath, name)):
             name = name + '/'
@@ -66,15 +98,16 @@ def create_index(dirpath, tpl, at_top):
         f.write(tpl.render(files=files, at_top=at_top))
 
 
-def recurse(dirpath, tpl):
+def recurse(dirpath, tpl, blobs=None):
     for name in listdir(dirpath):
         path = join(dirpath, name)
         if isdir(path):
             if get_index(path) is None:
-                create_index(path, tpl, at_top=False)
-                recurse(path, tpl)
+                create_index(path, tpl, at_top=False, blobs=blobs)
+                recurse(path, tpl, blobs)
 
 
+@profiling.profiled('indexer')
 def main():
     "Main entry point"
 
@@ -88,8 +121,9 @@ def main():
 
     cwd = getcwd()
     if get_index(cwd) is None:
-        create_index(cwd, tpl, at_top=True)
-        recurse(cwd, tpl)
+        blobs = load_blobs(cwd)
+        create_index(cwd, tpl, at_top=True, blobs=blobs)
+        recurse(cwd, tpl, blobs)
 
 
 if __name__ == '__main__':
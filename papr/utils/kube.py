@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+
+'''
+    Run container testsuites as Kubernetes Jobs instead of in
+    containers on the local docker daemon. This is enabled by
+    setting kube_api_url, kube_checkout_claim and
+    kube_checkout_dir (see docs/RUNNING.md).
+
+    The spawner marks eligible suites and the testrunner
+    then calls us rather than provisioning a container:
+
+      kube.py checkout               -- export the tested tree to
+                                        the shared checkout volume
+      kube.py run STATE_DIR LOGFILE  -- create the Job, stream its
+                                        logs and write STATE_DIR/rc
+      kube.py delete STATE_DIR       -- delete the Job, if any
+
+    We only talk to the REST API directly (through requests)
+    and rely on watches rather than polling to follow Jobs.
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import argparse
+import contextlib
+
+# in-cluster defaults
+SA_DIR = '/var/run/secrets/kubernetes.io/serviceaccount'
+
+# rc we report when the Job hits its deadline, as run_loop does
+TIMEOUT_RC = 137
+
+# waiting reasons which mean the image will never be pulled
+IMAGE_ERRORS = ['ErrImagePull', 'ImagePullBackOff', 'InvalidImageName',
+                'ErrImageNeverPull']
+
+# how long to keep checkouts exported to the shared volume
+CHECKOUT_TTL = 24 * 60 * 60
+
+# where the pods find the checkout and the testrunner finds the Job name
+CHECKOUT_MOUNT = '/srv/checkout'
+JOB_FILE = 'kube_job'
+
+# user-facing error found by the backend, reported by the testrunner
+ERROR_FILE = 'kube_error'
+
+HEREDOC = 'PAPR_EOF'
+
+
+def enabled():
+    "Whether the Kubernetes backend is configured."
+
+    return all([os.environ.get(var) for var in
+                ['kube_api_url', 'kube_checkout_claim', 'kube_checkout_dir']])
+
+
+def eligible(suite):
+    "Whether a suite can run as a Kubernetes Job."
+
+    # we can't copy artifacts out of completed pods, and hosts still
+    # need OpenStack; pod steps also only run one at a time
+    return ('container' in suite and 'artifacts' not in suite and
+            not any(type(t) is list for t in suite.get('tests', [])))
+
+
+class KubeError(Exception):
+    pass
+
+
+class NotFound(KubeError):
+    pass
+
+
+class Client:
+    "Minimal client for the few API endpoints we need."
+
+    def __init__(self, url, token=None, ca_cert=None, namespace=None):
+
+        # NB: requests is slow to import, so only do it when needed
+        import requests
+
+        self.url = url.rstrip('/')
+        self.namespace = namespace or 'default'
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = 'Bearer ' + token
+        if ca_cert:
+            self.session.verify = ca_cert
+
+    @classmethod
+    def from_env(cls):
+
+        def read_sa(fn):
+            path = os.path.join(SA_DIR, fn)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    return f.read().strip()
+            return None
+
+        ca_cert = os.environ.get('kube_ca_cert')
+        if not ca_cert and os.path.isfile(os.path.join(SA_DIR, 'ca.crt')):
+            ca_cert = os.path.join(SA_DIR, 'ca.crt')
+
+        return cls(os.environ['kube_api_url'],
+                   token=os.environ.get('kube_token') or read_sa('token'),
+                   ca_cert=ca_cert,
+                   namespace=(os.environ.get('kube_namespace') or
+                              read_sa('namespace')))
+
+    def path(self, kind, name=None, sub=None):
+        "Returns the API path of a namespaced resource."
+
+        prefix = '/api/v1' if kind == 'pods' else '/apis/batch/v1'
+        path = '%s/namespaces/%s/%s' % (prefix, self.namespace, kind)
+        if name is not None:
+            path += '/' + name
+        if sub is not None:
+            path += '/' + sub
+        return path
+
+    def request(self, method, path, **kwargs):
+        resp = self.session.request(method, self.url + path, **kwargs)
+        if resp.status_code == 404:
+            raise NotFound(path)
+        if resp.status_code >= 400:
+            raise KubeError("%s %s failed [HTTP %d]: %s" %
+                            (method, path, resp.status_code, resp.text))
+        return resp
+
+    def create_job(self, job):
+        return self.request('POST', self.path('jobs'), json=job).json()
+
+    def delete_job(self, name):
+        # also delete its pods
+        body = {'kind': 'DeleteOptions', 'apiVersion': 'v1',
+                'propagationPolicy': 'Background'}
+        try:
+            self.request('DELETE', self.path('jobs', name), json=body)
+        except NotFound:
+            pass
+
+    def get_pod(self, name):
+        return self.request('GET', self.path('pods', name)).json()
+
+    def wait_for(self, kind, params, check):
+        """
+        Wait until check() returns something other than None
+        for one of the objects matching the given selectors,
+        and return that. We list them first and then watch
+        from there so as not to miss any update.
+        """
+
+        listing = self.request('GET', self.path(kind), params=params).json()
+        for obj in listing.get('items', []):
+            result = check(obj)
+            if result is not None:
+                return result
+
+        version = listing['metadata'].get('resourceVersion')
+        while True:
+            watch_params = dict(params, watch='1')
+            if version:
+                watch_params['resourceVersion'] = version
+            with self.request('GET', self.path(kind), params=watch_params,
+                              stream=True) as resp:
+                for line in resp.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line.decode('utf-8'))
+                    obj = event['object']
+                    if event['type'] == 'ERROR':
+                        # our version expired (410 Gone); just start over
+                        return self.wait_for(kind, params, check)
+                    version = obj['metadata'].get('resourceVersion')
+                    if event['type'] == 'DELETED':
+                        raise KubeError("%s deleted" % obj['metadata']['name'])
+                    result = check(obj)
+                    if result is not None:
+                        return result
+            # the server ends watches periodically; resume where we were
+
+    def follow_logs(self, pod, container, out):
+        "Stream the logs of a container into a binary file until it exits."
+
+        since = None
+        while True:
+            params = {'container': container, 'follow': 'true',
+                      'timestamps': 'true'}
+            if since is not None:
+                params['sinceTime'] = since
+            with self.request('GET', self.path('pods', pod, 'log'),
+                              params=params, stream=True) as resp:
+                for line in resp.iter_lines():
+                    ts, _, data = line.partition(b' ')
+                    ts = ts.decode('utf-8')
+                    # sinceTime is inclusive and only has second precision
+                    if since is not None and ts <= since:
+                        continue
+                    since = ts
+                    out.write(data + b'\n')
+                    out.flush()
+            # the stream may also end because of the API server, so check
+            # that the container really exited before returning
+            try:
+                if container_state(self.get_pod(pod), container) != 'running':
+                    return
+            except NotFound:
+                return
+
+
+def container_state(pod, container):
+    "Returns the state ('waiting', 'running' or 'terminated') of a container."
+
+    for status in pod.get('status', {}).get('containerStatuses', []):
+        if status['name'] == container:
+            return next(iter(status.get('state', {})), 'waiting')
+    return 'waiting'
+
+
+def build_id():
+    "Returns the BUILD_ID, stripped down to be usable in names and labels."
+
+    return ''.join([c for c in os.environ.get('BUILD_ID', '').lower()
+                    if c.isalnum()])[:16]
+
+
+def job_name(idx):
+    "Returns a unique name for the Job of a runner."
+
+    # names must be valid DNS labels, so keep them short and simple
+    parts = ['papr'] + ([build_id()] if build_id() else [])
+    parts += [str(idx), uuid.uuid4().hex[:8]]
+    return '-'.join(parts)
+
+
+def read_file(dir, fn, default=None):
+    path = os.path.join(dir, fn)
+    if not os.path.isfile(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def suite_script(parsed):
+    """
+    Returns the script run by the pod of a suite flushed to
+    the parsed dir. It mirrors what the testrunner does in
+    containers: inject repos, install packages, copy the
+    checkout, build, then run the tests, with the same log
+    markers as logged_envcmd.
+    """
+
+    lines = ['set -eu',
+             'exec 2>&1',
+             'papr_step() {',
+             '    start=$(date +%s)',
+             '    rc=0; sh /var/tmp/papr/step-$1.sh || rc=$?',
+             '    duration=$(($(date +%s) - start))',
+             '    if [ $rc != 0 ]; then',
+             '        echo "### EXITED WITH CODE $rc AFTER ${duration}s"',
+             '        exit $rc',
+             '    fi',
+             '    echo "### COMPLETED IN ${duration}s"',
+             '}',
+             'mkdir -p /var/tmp/papr /var/tmp/checkout',
+             heredoc('/var/tmp/papr/envs', read_file(parsed, 'envs', ''))]
+
+    repos = read_file(parsed, 'papr-extras.repo')
+    if repos is not None:
+        lines += ['mkdir -p /etc/yum.repos.d',
+                  heredoc('/etc/yum.repos.d/papr-extras.repo', repos)]
+
+    packages = read_file(parsed, 'packages')
+    if packages is not None:
+        # packages are already shell-quoted by flush_suite
+        lines += ['mgr=yum',
+                  'if rpm -q dnf >/dev/null 2>&1; then mgr=dnf; fi',
+                  'if ! $mgr install -y %s; then' % packages,
+                  '    echo "Could not install packages." '
+                  '> /dev/termination-log',
+                  '    exit 1',
+                  'fi']
+
+    lines += ['cp -a %s/. /var/tmp/checkout' % CHECKOUT_MOUNT]
+
+    steps = []
+    if read_file(parsed, 'build') is not None:
+        steps += build_steps(read_file(parsed, 'build.config_opts', ''),
+                             read_file(parsed, 'build.build_opts', ''),
+                             read_file(parsed, 'build.install_opts', ''))
+    tests = read_file(parsed, 'tests')
+    if tests is not None:
+        steps += tests.split('\n')
+
+    for i, step in enumerate(steps):
+        lines += [heredoc('/var/tmp/papr/step-%d.sh' % i,
+                          'set -euo pipefail\n'
+                          '. /var/tmp/papr/envs\n'
+                          'cd /var/tmp/checkout\n' + step),
+                  "cat <<'%s'\n>>> %s\n%s" % (HEREDOC, step, HEREDOC),
+                  'papr_step %d' % i]
+
+    return '\n'.join(lines) + '\n'
+
+
+def build_steps(config_opts, build_opts, install_opts):
+    "The same build steps as the testrunner, but decided in the pod."
+
+    return ['if [ ! -f configure ]; then '
+            'if [ -f autogen.sh ]; then NOCONFIGURE=1 ./autogen.sh; '
+            'elif [ -f autogen ]; then NOCONFIGURE=1 ./autogen; fi; fi',
+            './configure %s' % config_opts,
+            'make all --jobs $(getconf _NPROCESSORS_ONLN) %s' % build_opts,
+            'make install %s' % install_opts]
+
+
+def heredoc(path, content):
+    if not content.endswith('\n'):
+        content += '\n'
+    return "cat > %s <<'%s'\n%s%s" % (path, HEREDOC, content, HEREDOC)
+
+
+def job_spec(name, image, script, timeout=None, volumes=None, mounts=None,
+             init_containers=None, labels=None):
+    "Returns a Job running a script in the given image."
+
+    labels = dict(labels or {}, app='papr')
+    container = {'name': 'test',
+                 'image': image,
+                 'command': ['/bin/sh', '-c', script],
+                 'volumeMounts': mounts or [],
+                 'securityContext': {'runAsUser': 0}}
+    pod_spec = {'restartPolicy': 'Never',
+                'volumes': volumes or [],
+                'containers': [container]}
+    if init_containers:
+        pod_spec['initContainers'] = init_containers
+    spec = {'backoffLimit': 0,
+            'template': {'metadata': {'labels': dict(labels)},
+                         'spec': pod_spec}}
+    if timeout is not None:
+        spec['activeDeadlineSeconds'] = int(timeout)
+    return {'apiVersion': 'batch/v1',
+            'kind': 'Job',
+            'metadata': {'name': name, 'labels': labels},
+            'spec': spec}
+
+
+def checkout_volume(claim, subpath):
+    "Returns the volume and mount of a checkout on the shared volume."
+
+    volume = {'name': 'checkout',
+              'persistentVolumeClaim': {'claimName': claim,
+                                        'readOnly': True}}
+    mount = {'name': 'checkout',
+             'mountPath': CHECKOUT_MOUNT,
+             'subPath': subpath,
+             'readOnly': True}
+    return volume, mount
+
+
+def checkout_subpath():
+    "Path of the tested tree on the shared checkout volume."
+
+    # NB: this is the merge commit for PRs
+    with open('state/sha') as f:
+        sha = f.read().strip()
+    return os.path.join(os.environ['github_repo'], sha)
+
+
+@contextlib.contextmanager
+def locked(path):
+    with open(path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def export_checkout():
+    """
+    Copy the tested tree to the shared volume so that pods
+    can just mount it rather than cloning the repo. This is
+    done only once per commit no matter how many suites.
+    """
+
+    root = os.environ['kube_checkout_dir']
+    subpath = checkout_subpath()
+    dest = os.path.join(root, subpath)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    with locked(dest + '.lock'):
+        if not os.path.isdir(dest):
+            tmp = dest + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            src = os.path.join('checkouts', os.environ['github_repo'])
+            shutil.copytree(src, tmp, symlinks=True)
+            os.rename(tmp, dest)
+        # keep it alive while we use it
+        os.utime(dest)
+
+    prune_checkouts(os.path.dirname(dest))
+
+
+def prune_checkouts(dir):
+    "Delete the checkouts of a repo which were not used in a while."
+
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        if name.endswith('.lock') or name.endswith('.tmp'):
+            continue
+        with locked(path + '.lock'):
+            try:
+                if time.time() - os.stat(path).st_mtime < CHECKOUT_TTL:
+                    continue
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(path)
+
+
+def run(state, logfile):
+    "Run the suite in the given state dir and write its rc."
+
+    parsed = os.path.join(state, 'parsed')
+    idx = int(state.rstrip('/').rsplit('-', 1)[-1])
+    name = job_name(idx)
+
+    volume, mount = checkout_volume(os.environ['kube_checkout_claim'],
+                                    checkout_subpath())
+    job = job_spec(name, read_file(parsed, 'image').strip(),
+                   suite_script(parsed),
+                   timeout=read_file(parsed, 'timeout'),
+                   volumes=[volume], mounts=[mount],
+                   labels={'papr-build-id': build_id()})
+
+    client = Client.from_env()
+    # write it out first so that the testrunner can always clean up
+    with open(os.path.join(state, JOB_FILE), 'w') as f:
+        f.write(name)
+    client.create_job(job)
+
+    selector = {'labelSelector': 'job-name=' + name}
+    pod = client.wait_for('pods', selector, pod_started)
+    if pod['error'] is not None:
+        with open(os.path.join(state, ERROR_FILE), 'w') as f:
+            f.write(pod['error'])
+        return
+
+    with open(logfile, 'ab') as out:
+        if pod['state'] != 'never':
+            client.follow_logs(pod['name'], 'test', out)
+        rc, message = job_result(client, name, pod['name'])
+        if rc == TIMEOUT_RC:
+            out.write(b"### TIMED OUT\n")
+
+    if message:
+        # the script reports setup errors through the termination message
+        with open(os.path.join(state, ERROR_FILE), 'w') as f:
+            f.write(message)
+    else:
+        with open(os.path.join(state, 'rc'), 'w') as f:
+            f.write('%d\n' % rc)
+
+
+def pod_started(pod):
+    "Check for wait_for(): whether the test container started or failed."
+
+    name = pod['metadata']['name']
+    for status in pod.get('status', {}).get('containerStatuses', []):
+        state = status.get('state', {})
+        waiting = state.get('waiting', {})
+        if waiting.get('reason') in IMAGE_ERRORS:
+            image = pod['spec']['containers'][0]['image']
+            return {'name': name, 'state': 'waiting',
+                    'error': "Could not pull image '%s'." % image}
+        if 'running' in state or 'terminated' in state:
+            return {'name': name, 'state': next(iter(state)), 'error': None}
+    if pod.get('status', {}).get('phase') == 'Failed':
+        # e.g. the deadline expired before the container even started
+        return {'name': name, 'state': 'never', 'error': None}
+    return None
+
+
+def job_finished(job):
+    "Check for wait_for(): the final condition of the Job."
+
+    for cond in job.get('status', {}).get('conditions', []):
+        if cond['type'] in ['Complete', 'Failed'] and cond['status'] == 'True':
+            return cond
+    return None
+
+
+def job_result(client, name, pod):
+    "Wait for the Job to finish and return the rc and termination message."
+
+    cond = client.wait_for('jobs', {'fieldSelector': 'metadata.name=' + name},
+                           job_finished)
+    if cond['type'] == 'Complete':
+        return 0, None
+    if cond.get('reason') == 'DeadlineExceeded':
+        return TIMEOUT_RC, None
+
+    rc = 1
+    message = None
+    for status in client.get_pod(pod)['status'].get('containerStatuses', []):
+        terminated = status.get('state', {}).get('terminated')
+        if terminated is not None:
+            rc = terminated['exitCode']
+            message = terminated.get('message')
+    return rc, message
+
+
+def delete(state):
+    "Delete the Job of a runner, if it has one."
+
+    name = read_file(state, JOB_FILE)
+    if name is not None:
+        Client.from_env().delete_job(name.strip())
+
+
+def main():
+    "Main entry point."
+
+    parser = argparse.ArgumentParser(description="Run suites on Kubernetes")
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+    subparsers.add_parser('checkout', help="export the tested tree to the "
+                          "shared checkout volume")
+    run_parser = subparsers.add_parser('run', help="run a suite")
+    run_parser.add_argument('state', help="state dir of the runner")
+    run_parser.add_argument('logfile', help="file to append the logs to")
+    delete_parser = subparsers.add_parser('delete', help="delete the Job "
+                                          "of a runner")
+    delete_parser.add_argument('state', help="state dir of the runner")
+    args = parser.parse_args()
+
+    if args.cmd == 'checkout':
+        export_checkout()
+    elif args.cmd == 'run':
+        run(args.state, args.logfile)
+    elif args.cmd == 'delete':
+        delete(args.state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+'''
+    This script is not meant to be run manually. It is
+    called from the provisioner to cache ostree deployments
+    as OpenStack images (if os_image_cache is set).
+
+    Deploying a pinned ostree revision means downloading it,
+    deploying it and rebooting, which is the same work for
+    every node with the same base image and ostree spec.
+    So once a node is deployed, we snapshot it:
+
+      os_image_cache.py snapshot PARSEDHOST HOSTDIR
+
+    where PARSEDHOST is the parsed host dir and HOSTDIR is
+    as populated by os_provision.py, with the output of
+    `rpm-ostree status --json` of the node in
+    HOSTDIR/ostree_status.json. The image is named after the
+    booted checksum and tagged with a key derived from the
+    base image and the remote, branch and revision. We only
+    wait for the disk of the node to be captured, and write
+    the ID of the image to HOSTDIR/snapshot_id; it is then
+    uploaded while the tests run, and os_teardown.py waits
+    for it to be saved before deleting the node. Later
+    nodes with the same key can then boot straight from it:
+
+      os_image_cache.py lookup PARSEDHOST OUTFILE
+
+    writes the ID of the image to use to OUTFILE if there
+    is one (several snapshots of the same key may have the
+    same name, e.g. if they were taken concurrently). Only
+    the os_image_cache_size (default: 10) most recently used
+    snapshots are kept.
+
+    We assume that the usual OpenStack authentication env
+    vars are defined.
+
+    NB: the image API of nova we use is deprecated, but it is
+    still in python-novaclient 7.1.0 and available up to
+    microversion 2.35 (we use 2.0), like in os_provision.py.
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from novaclient import client as novaclient
+
+DEFAULT_CACHE_SIZE = 10
+
+# how long to wait for the disk of a node to be captured
+CAPTURE_TIMEOUT = 5 * 60
+
+# how long to wait for a snapshot to be saved
+SNAPSHOT_TIMEOUT = 30 * 60
+
+# task states of a server whose disk is not captured yet
+CAPTURING_STATES = ['image_snapshot', 'image_snapshot_pending',
+                    'image_pending_upload']
+
+# image metadata
+KEY = 'papr_ostree_key'
+CHECKSUM = 'papr_ostree_checksum'
+LAST_USED = 'papr_last_used'
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+
+    nova = novaclient.Client(2, auth_url=os.environ['OS_AUTH_URL'],
+                             tenant_id=os.environ['OS_TENANT_ID'],
+                             username=os.environ['OS_USERNAME'],
+                             password=os.environ['OS_PASSWORD'])
+    nova.authenticate()
+
+    spec = read_spec(args.parsedhost)
+    if spec is None:
+        print("INFO: ostree spec not pinned to a revision, not caching")
+        return 0
+
+    key = cache_key(nova, spec)
+    if args.cmd == 'lookup':
+        image = lookup(nova, key)
+        if image is not None:
+            print("INFO: using cached image %s" % image.name)
+            with open(args.outfile, 'w') as f:
+                f.write(image.id)
+        return 0
+
+    return 0 if snapshot(nova, key, args.hostdir) else 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    lookup = subparsers.add_parser('lookup')
+    lookup.add_argument('parsedhost', help="parsed host dir")
+    lookup.add_argument('outfile', help="file to write the image name to")
+
+    snapshot = subparsers.add_parser('snapshot')
+    snapshot.add_argument('parsedhost', help="parsed host dir")
+    snapshot.add_argument('hostdir', help="dir populated by os_provision.py")
+
+    return parser.parse_args()
+
+
+def read_spec(parsedhost):
+    "Returns the (distro, remote, branch, revision) to cache, or None."
+
+    def read(fn):
+        path = os.path.join(parsedhost, fn)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return f.read().strip()
+
+    revision = read('ostree_revision')
+    # without a revision, the result depends on when we deploy
+    if not revision:
+        return None
+    return (read('distro'), read('ostree_remote') or '',
+            read('ostree_branch') or '', revision)
+
+
+def cache_key(nova, spec):
+    distro, remote, branch, revision = spec
+    # include the base image itself so that updating it invalidates
+    # its snapshots (e.g. /etc and /var don't come from the commit)
+    base = nova.images.findall(name=distro)[0]
+    s = '|'.join([base.id, remote, branch, revision])
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def cached_images(nova):
+    "Returns all the snapshots we created, most recently used first."
+
+    images = [i for i in nova.images.list() if KEY in i.metadata]
+    images.sort(key=lambda i: int(i.metadata.get(LAST_USED, 0)),
+                reverse=True)
+    return images
+
+
+def lookup(nova, key):
+    for image in cached_images(nova):
+        if image.metadata[KEY] == key and image.status == 'ACTIVE':
+            nova.images.set_meta(image, {LAST_USED: str(int(time.time()))})
+            return image
+    return None
+
+
+def snapshot(nova, key, hostdir):
+
+    with open(os.path.join(hostdir, 'node_name')) as f:
+        name = f.read().strip()
+    with open(os.path.join(hostdir, 'ostree_status.json')) as f:
+        status = json.load(f)
+    checksum = [d for d in status['deployments'] if d['booted']][0]['checksum']
+
+    image_name = 'papr-ostree-%s-%s' % (checksum[:12], key[:8])
+    print("INFO: snapshotting %s as %s" % (name, image_name))
+    server = nova.servers.find(name=name)
+    image_id = nova.servers.create_image(server, image_name, metadata={
+        KEY: key, CHECKSUM: checksum, LAST_USED: str(int(time.time()))})
+
+    # the tests must not start before the disk is captured, but the
+    # upload itself can go on while they run
+    deadline = time.time() + CAPTURE_TIMEOUT
+    while capturing(server) and time.time() < deadline:
+        time.sleep(2)
+        server.get()
+
+    if capturing(server):
+        print("ERROR: disk of %s not captured in time" % name)
+        return False
+
+    with open(os.path.join(hostdir, 'snapshot_id'), 'w') as f:
+        f.write(image_id)
+    return True
+
+
+def capturing(server):
+    state = getattr(server, 'OS-EXT-STS:task_state', None)
+    return state in CAPTURING_STATES
+
+
+def wait_snapshot(nova, image_id):
+    "Waits until a snapshot is saved, then prunes the cache."
+
+    image = nova.images.get(image_id)
+    deadline = time.time() + SNAPSHOT_TIMEOUT
+    while image.status not in ['ACTIVE', 'ERROR'] and time.time() < deadline:
+        time.sleep(5)
+        image = nova.images.get(image_id)
+
+    if image.status != 'ACTIVE':
+        print("ERROR: snapshot is not ACTIVE (state: %s)" % image.status)
+        return False
+
+    prune(nova, int(os.environ.get('os_image_cache_size') or
+                    DEFAULT_CACHE_SIZE))
+    return True
+
+
+def prune(nova, size):
+    "Deletes all but the most recently used snapshots."
+
+    for image in cached_images(nova)[size:]:
+        print("INFO: deleting cached image %s" % image.name)
+        nova.images.delete(image)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,11 @@
       - os_user_data
       - os_name_prefix
       - os_floating_ip_pool (optional)
+      - os_image_id (optional, overrides os_image)
+
+    We exit with TRANSIENT_RC (EX_TEMPFAIL) if the server
+    failed to come up in a way that may well work on a retry
+    (see retry in common.sh), after cleaning up after it.
 '''
 
 import os
@@ -28,6 +33,11 @@ from cinderclient import client as cinderclient
 
 # XXX: clean this up
 
+TRANSIENT_RC = 75
+
+# how long servers may stay in BUILD
+BUILD_TIMEOUT = 10 * 60
+
 output_dir = sys.argv[1]
 
 nova = novaclient.Client(2, auth_url=os.environ['OS_AUTH_URL'],
@@ -38,10 +48,14 @@ nova = novaclient.Client(2, auth_url=os.environ['OS_AUTH_URL'],
 print("INFO: authenticating")
 nova.authenticate()
 
-# it's possible multiple images match, e.g. during automated
-# image uploads, in which case let's just pick the first one
-print("INFO: resolving image '%s'" % os.environ['os_image'])
-image = nova.images.findall(name=os.environ['os_image'])[0]
+if os.environ.get('os_image_id'):
+    print("INFO: using image %s" % os.environ['os_image_id'])
+    image = nova.images.get(os.environ['os_image_id'])
+else:
+    # it's possible multiple images match, e.g. during automated
+    # image uploads, in which case let's just pick the first one
+    print("INFO: resolving image '%s'" % os.environ['os_image'])
+    image = nova.images.findall(name=os.environ['os_image'])[0]
 
 # go through all the flavours and determine which one to use
 min_ram = int(os.environ['os_min_ram'])
@@ -121,9 +135,9 @@ def write_to_file(fn, s):
 write_to_file('node_name', name)
 
 # XXX: check if there's a more elegant way to do this
-# XXX: implement timeout
 print("INFO: waiting for server to become active...")
-while server.status == 'BUILD':
+deadline = time.time() + BUILD_TIMEOUT
+while server.status == 'BUILD' and time.time() < deadline:
     time.sleep(1)
     server.get()
 
@@ -131,7 +145,7 @@ if server.status != 'ACTIVE':
     print("ERROR: server is not ACTIVE (state: %s)" % server.status)
     print("ERROR: deleting server")
     server.delete()
-    sys.exit(1)
+    sys.exit(TRANSIENT_RC)
 
 vol = None
 min_ephemeral = int(os.environ['os_min_ephemeral'])
@@ -156,7 +170,7 @@ if min_ephemeral > 0:
             print("ERROR: volume is not available (state: %s)" % vol.status)
             server.delete()
             vol.delete()
-            sys.exit(1)
+            sys.exit(TRANSIENT_RC)
 
         # now we can safely attach the volume
         nova.volumes.create_server_volume(server.id, vol.id)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+'''
+    This script is not meant to be run manually. It is
+    called from the testrunner to tear down the nodes
+    provisioned by os_provision.py.
+
+    Each argument is a directory as populated by
+    os_provision.py (i.e. with node_name, node_addr and
+    node_volid files). All the nodes are torn down
+    concurrently, using a single nova and cinder session.
+    Nodes being snapshotted by os_image_cache.py (i.e. with
+    a snapshot_id file) are only deleted once it's saved.
+
+    We assume that the usual OpenStack authentication env
+    vars are defined. Additionally, the following env vars
+    are used:
+      - os_floating_ip_pool (optional)
+
+    It can also be used to sweep nodes left behind by
+    crashed runs, e.g.:
+      os_teardown.py --sweep papr-1234
+'''
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+from novaclient import client as novaclient
+from novaclient import exceptions as novaexceptions
+from cinderclient import client as cinderclient
+
+import os_image_cache  # pylint: disable=import-error
+
+# how long to wait for a volume to be detached
+DETACH_TIMEOUT = 120
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+
+    if args.background:
+        # Re-exec ourselves detached from the testrunner so
+        # that it can exit right away. NB: we must not hold
+        # on to its stdout, otherwise the spawner would still
+        # wait for us.
+        cmd = [sys.executable, os.path.realpath(__file__)]
+        if args.sweep:
+            cmd += ['--sweep', args.sweep]
+        with open(args.background, 'a') as log:
+            subprocess.Popen(cmd + args.hostdirs, stdin=subprocess.DEVNULL,
+                             stdout=log, stderr=subprocess.STDOUT,
+                             start_new_session=True)
+        return 0
+
+    nodes = [read_node(d) for d in args.hostdirs]
+    nodes = [node for node in nodes if node is not None]
+    if len(nodes) == 0 and not args.sweep:
+        return 0
+
+    nova = novaclient.Client(2, auth_url=os.environ['OS_AUTH_URL'],
+                             tenant_id=os.environ['OS_TENANT_ID'],
+                             username=os.environ['OS_USERNAME'],
+                             password=os.environ['OS_PASSWORD'])
+    nova.authenticate()
+
+    cinder = cinderclient.Client(2, os.environ['OS_USERNAME'],
+                                 os.environ['OS_PASSWORD'],
+                                 os.environ['OS_TENANT_NAME'],
+                                 os.environ['OS_AUTH_URL'])
+    cinder.authenticate()
+
+    if args.sweep:
+        nodes += find_orphans(nova, args.sweep)
+
+    failed = []
+    threads = []
+    for node in nodes:
+        t = threading.Thread(target=teardown_node_safe,
+                             args=(nova, cinder, node, failed))
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    if failed:
+        print("ERROR: failed to tear down: %s" % ', '.join(failed))
+        return 1
+
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--background', metavar='LOGFILE',
+                        help="tear down in a detached process logging to "
+                        "LOGFILE and return immediately")
+    parser.add_argument('--sweep', metavar='PREFIX',
+                        help="also tear down all nodes named PREFIX-*")
+    parser.add_argument('hostdirs', nargs='*', metavar='HOSTDIR',
+                        help="directory populated by os_provision.py")
+    return parser.parse_args()
+
+
+def read_node(hostdir):
+    "Returns a (name, floating ips, volume ids, snapshot) tuple, or None."
+
+    def read(fn):
+        path = os.path.join(hostdir, fn)
+        if not os.path.isfile(path):
+            return ''
+        with open(path) as f:
+            return f.read().strip()
+
+    name = read('node_name')
+    if not name:
+        return None
+
+    addr = read('node_addr')
+    fips = []
+    if addr and 'os_floating_ip_pool' in os.environ:
+        fips = [addr]
+
+    volid = read('node_volid')
+    volids = [volid] if volid else []
+
+    return (name, fips, volids, read('snapshot_id') or None)
+
+
+def find_orphans(nova, prefix):
+    "Returns nodes whose name starts with the given prefix."
+
+    # NB: the name filter is a regex on the server side
+    servers = nova.servers.list(search_opts={'name': '^%s-' % prefix})
+    fips = nova.floating_ips.list()
+
+    nodes = []
+    for server in servers:
+        print("INFO: found orphaned server %s" % server.name)
+        volids = [v.id for v in nova.volumes.get_server_volumes(server.id)]
+        node_fips = [f.ip for f in fips if f.instance_id == server.id]
+        nodes.append((server.name, node_fips, volids, None))
+    return nodes
+
+
+def teardown_node_safe(nova, cinder, node, failed):
+    try:
+        teardown_node(nova, cinder, *node)
+    except Exception as e:
+        print("ERROR: %s: %s" % (node[0], e))
+        failed.append(node[0])
+
+
+def teardown_node(nova, cinder, name, fips, volids, snapshot):
+
+    try:
+        server = nova.servers.find(name=name)
+    except novaexceptions.NotFound:
+        print("INFO: server %s already deleted" % name)
+        return
+
+    # deleting the server would abort the upload
+    if snapshot is not None:
+        print("INFO: %s: waiting for snapshot %s" % (name, snapshot))
+        try:
+            os_image_cache.wait_snapshot(nova, snapshot)
+        except Exception as e:
+            # the cache is just an optimization, still tear down
+            print("ERROR: %s: snapshot %s: %s" % (name, snapshot, e))
+
+    for volid in volids:
+        print("INFO: %s: detaching volume %s" % (name, volid))
+        nova.volumes.delete_server_volume(server.id, volid)
+
+    # rather than sleeping an arbitrary amount of time, wait until the
+    # volumes are actually detached before deleting them
+    leaked = []
+    deadline = time.time() + DETACH_TIMEOUT
+    for volid in volids:
+        vol = cinder.volumes.get(volid)
+        while vol.status != 'available' and time.time() < deadline:
+            time.sleep(1)
+            vol.get()
+        if vol.status != 'available':
+            # still delete the server below
+            print("ERROR: %s: volume %s not detached (state: %s)" %
+                  (name, volid, vol.status))
+            leaked.append(volid)
+            continue
+        print("INFO: %s: deleting volume %s" % (name, volid))
+        vol.delete()
+
+    for fip in fips:
+        print("INFO: %s: releasing floating ip %s" % (name, fip))
+        server.remove_floating_ip(fip)
+        for f in nova.floating_ips.findall(ip=fip):
+            nova.floating_ips.delete(f)
+
+    print("INFO: %s: deleting server" % name)
+    server.delete()
+
+    if leaked:
+        raise Exception("leaked volumes %s" % ', '.join(leaked))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
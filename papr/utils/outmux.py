@@ -0,0 +1,129 @@
+'''
+    Multiplexes the output of all the testrunners onto our
+    stdout from a single thread. We can't trust that output
+    (e.g. a test may dump binary junk without any newlines),
+    so it is read in fixed-size chunks, overlong lines are
+    split and each stream is rate-limited on the console.
+    The full output of each stream is kept in a compressed
+    log file regardless.
+'''
+
+import os
+import sys
+import gzip
+import time
+import selectors
+
+CHUNK_SIZE = 64 * 1024
+
+# lines longer than this are split, with the marker appended to all
+# but the last part
+MAX_LINE = 4096
+CONT_MARKER = b' \\'
+
+# maximum average console output per stream in bytes per second, and
+# how much it may burst above that
+RATE = 16 * 1024
+BURST = 1024 * 1024
+
+
+class _Stream:
+
+    def __init__(self, idx, f, logfile):
+        self.idx = idx
+        self.f = f
+        self.log = gzip.open(logfile, 'wb', compresslevel=6)
+        self.logfile = logfile
+        self.partial = b''
+        self.tokens = BURST
+        self.last_refill = time.monotonic()
+        self.suppressed = 0
+
+
+class OutputMux:
+
+    def __init__(self, out=None):
+        # pylint: disable=no-member
+        self.out = out or sys.stdout.buffer
+        self.sel = selectors.DefaultSelector()
+        self.streams = {}
+
+    def add(self, idx, f, logfile):
+        "Start multiplexing the pipe f, keeping a full copy in logfile."
+
+        os.set_blocking(f.fileno(), False)
+        stream = _Stream(idx, f, logfile)
+        self.sel.register(f.fileno(), selectors.EVENT_READ, stream)
+        self.streams[idx] = stream
+
+    def done(self, idx):
+        "Returns True once the stream of idx has reached EOF."
+        return idx not in self.streams
+
+    def poll(self, timeout):
+        "Wait up to timeout seconds for output and process it."
+
+        if not self.streams:
+            time.sleep(timeout)
+            return
+
+        for key, _ in self.sel.select(timeout):
+            stream = key.data
+            try:
+                data = os.read(key.fd, CHUNK_SIZE)
+            except BlockingIOError:
+                continue
+            stream.log.write(data)
+            if data == b'':
+                self._close(stream)
+            else:
+                self._feed(stream, data)
+        self.out.flush()
+
+    def _feed(self, stream, data):
+        lines = (stream.partial + data).split(b'\n')
+        stream.partial = lines.pop()
+        for line in lines:
+            self._emit_line(stream, line)
+        while len(stream.partial) > MAX_LINE:
+            self._emit(stream, stream.partial[:MAX_LINE] + CONT_MARKER)
+            stream.partial = stream.partial[MAX_LINE:]
+
+    def _emit_line(self, stream, line):
+        while len(line) > MAX_LINE:
+            self._emit(stream, line[:MAX_LINE] + CONT_MARKER)
+            line = line[MAX_LINE:]
+        self._emit(stream, line)
+
+    def _emit(self, stream, line):
+        now = time.monotonic()
+        stream.tokens = min(BURST, stream.tokens +
+                            (now - stream.last_refill) * RATE)
+        stream.last_refill = now
+
+        # once we start suppressing output, wait until the bucket is
+        # half full again so we don't alternate line by line
+        threshold = BURST // 2 if stream.suppressed else len(line)
+        if stream.tokens < threshold:
+            stream.suppressed += len(line) + 1
+            return
+
+        self._report_suppressed(stream)
+        stream.tokens -= len(line)
+        self.out.write((b'[%d] ' % stream.idx) + line + b'\n')
+
+    def _report_suppressed(self, stream):
+        if stream.suppressed > 0:
+            msg = ("... %d bytes of output suppressed, see %s" %
+                   (stream.suppressed, stream.logfile))
+            self.out.write((b'[%d] ' % stream.idx) + msg.encode() + b'\n')
+            stream.suppressed = 0
+
+    def _close(self, stream):
+        if stream.partial != b'':
+            self._emit_line(stream, stream.partial)
+        self._report_suppressed(stream)
+        self.sel.unregister(stream.f.fileno())
+        stream.f.close()
+        stream.log.close()
+        del self.streams[stream.idx]
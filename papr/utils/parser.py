@@ -9,6 +9,11 @@ import pykwalify.errors
 
 from . import PKG_DIR
 from . import common
+from . import ext_schema
+from . import profiling
+
+# line of the tests file standing for a parallel group
+PARALLEL_MARKER = '#papr:parallel '
 
 
 class ParserError(SyntaxError):
@@ -19,11 +24,37 @@ class ParserError(SyntaxError):
         input. We inherit from SyntaxError for the msg
         field.
     '''
-    pass
+
+    # index of the testsuite which caused the error, if any
+    suite_idx = None
+
+
+class _Core(pykwalify.core.Core):
+    '''
+        By default, pykwalify loads the extension files from
+        scratch for every Core instance (i.e. every suite).
+        Just reuse the module we already imported.
+    '''
+
+    def _load_extensions(self):
+        self.loaded_extensions = [ext_schema]
+
+
+_schema = None
+
+
+def _load_schema():
+    "Load the schema once and reuse it for all suites."
+    global _schema
+    if _schema is None:
+        with open(os.path.join(PKG_DIR, "schema.yml")) as f:
+            _schema = yaml.safe_load(f)
+    return _schema
 
 
 class SuiteParser:
 
+    @profiling.profiled('parser')
     def __init__(self, filepath):
         self.contexts = []
         self.met_required = False
@@ -57,8 +88,10 @@ class SuiteParser:
                 yield dict(suite)
             # tell users which suite exactly caused the error
             except ParserError as e:
-                raise ParserError("failed to parse %s testsuite: %s"
+                err = ParserError("failed to parse %s testsuite: %s"
                                   % (common.ordinal(idx + 1), e.msg))
+                err.suite_idx = idx
+                raise err
 
     def _merge(self, suite, new):
         "Merge the next document into the current one."
@@ -104,15 +137,11 @@ class SuiteParser:
                 del suite[k]
         return suite
 
+    @profiling.profiled('parser')
     def _validate(self, suite):
 
-        schema = os.path.join(PKG_DIR, "schema.yml")
-        ext = os.path.join(PKG_DIR, "ext_schema.py")
-
         try:
-            c = pykwalify.core.Core(source_data=suite,
-                                    schema_files=[schema],
-                                    extensions=[ext])
+            c = _Core(source_data=suite, schema_data=_load_schema())
             c.validate()
         except pykwalify.errors.PyKwalifyException as e:
             raise ParserError(e.msg)
@@ -120,6 +149,11 @@ class SuiteParser:
         if suite['context'] in self.contexts:
             raise ParserError("duplicate 'context' value detected")
 
+        for dep in suite.get('depends-on', []):
+            if dep not in self.contexts:
+                raise ParserError("'depends-on' context \"%s\" does not "
+                                  "match any previous testsuite" % dep)
+
         self.met_required = self.met_required or suite.get('required', False)
 
         if suite['context'] == "required" and self.met_required:
@@ -160,10 +194,29 @@ def _flush_host(host, outdir):
     _write_to_file(outdir, "distro", host['distro'])
 
 
-def flush_suite(suite, outdir):
+def _flush_tests(tests, outdir):
+    # the commands of a parallel group go in their own file, which
+    # the testrunner finds from the marker line in their place
+    lines = []
+    for i, test in enumerate(tests):
+        if type(test) is list:
+            fn = "tests.parallel-%d" % i
+            _write_to_file(outdir, fn, '\n'.join(test), utf8=True)
+            lines.append(PARALLEL_MARKER + fn)
+        else:
+            lines.append(test)
+    _write_to_file(outdir, "tests", '\n'.join(lines), utf8=True)
+
+
+def flush_suite(suite, outdir, shard=0):
 
     os.makedirs(outdir)
 
+    nshards = suite.get('shards', 1)
+    assert shard < nshards
+    if nshards > 1:
+        _write_to_file(outdir, "shard", "%d/%d" % (shard + 1, nshards))
+
     if 'host' in suite:
         dir = os.path.join(outdir, "host")
         os.mkdir(dir)
@@ -192,7 +245,7 @@ def flush_suite(suite, outdir):
         _write_to_file(outdir, 'envtype', 'cluster')
 
     if 'tests' in suite:
-        _write_to_file(outdir, "tests", '\n'.join(suite['tests']), utf8=True)
+        _flush_tests(suite['tests'], outdir)
 
     _write_to_file(outdir, "branches",
                    '\n'.join(suite.get('branches', ['master'])))
@@ -220,12 +273,15 @@ def flush_suite(suite, outdir):
     if 'artifacts' in suite:
         _write_to_file(outdir, "artifacts", '\n'.join(suite['artifacts']))
 
-    if 'env' in suite:
+    if 'env' in suite or nshards > 1:
         envs = ''
-        for k, v in suite['env'].items():
+        for k, v in suite.get('env', {}).items():
             # NB: the schema already ensures that k is ASCII
             # only, so utf8=True will only affect the value
             envs += 'export %s="%s"\n' % (k, v)
+        if nshards > 1:
+            envs += 'export PAPR_SHARD_INDEX=%d\n' % shard
+            envs += 'export PAPR_SHARD_TOTAL=%d\n' % nshards
         _write_to_file(outdir, "envs", envs, utf8=True)
 
     if 'build' in suite:
@@ -240,3 +296,5 @@ def flush_suite(suite, outdir):
                            v.get('build-opts', ''))
             _write_to_file(outdir, "build.install_opts",
                            v.get('install-opts', ''))
+            if v.get('ccache', False):
+                _write_to_file(outdir, "build.ccache", '')
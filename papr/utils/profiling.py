@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+'''
+    Optional cProfile hooks for the Python components,
+    enabled through the PAPR_PROFILE env var. Its value is
+    either "all" or a comma-separated list of components:
+
+      spawner    -- the whole spawner (including parsing)
+      parser     -- loading and validating the YAML file
+      gh         -- GitHub status updates
+      indexer    -- index.html generation
+      provision  -- os_provision.py
+
+    Each process writes one <component>.<pid>.prof file per
+    component in $PAPR_PROFILE_DIR (state/profiles by
+    default). The testrunners upload them along with the
+    suite artifacts. They can then be merged and summarized
+    across any number of runs, e.g.:
+
+      papr-profile summarize state/profiles
+      papr-profile summarize --component spawner runs/*/profiles
+'''
+
+import os
+import sys
+import atexit
+import argparse
+import functools
+
+COMPONENTS = ['spawner', 'parser', 'gh', 'indexer', 'provision']
+
+# component name -> cProfile.Profile for this process
+_profiles = {}
+
+# profiler currently collecting; cProfile does not support nesting, so
+# e.g. gh status updates from the spawner are accounted to the spawner
+_active = None
+
+
+def enabled(component):
+    "Whether profiling of the given component was requested."
+
+    wanted = os.environ.get('PAPR_PROFILE', '')
+    return wanted == 'all' or component in wanted.split(',')
+
+
+def profile_dir():
+    return os.environ.get('PAPR_PROFILE_DIR', 'state/profiles')
+
+
+def profiled(component):
+    "Decorator which profiles all calls to a function if enabled."
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _active
+            if _active is not None or not enabled(component):
+                return func(*args, **kwargs)
+            prof = _get_profile(component)
+            _active = prof
+            prof.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                prof.disable()
+                _active = None
+
+        return wrapper
+    return decorator
+
+
+def _get_profile(component):
+    # NB: we're imported by every component, so only pay for cProfile
+    # when profiling is actually requested
+    import cProfile
+
+    if component not in _profiles:
+        if not _profiles:
+            atexit.register(checkpoint)
+        _profiles[component] = cProfile.Profile()
+    return _profiles[component]
+
+
+def checkpoint():
+    """
+    Write out the profiles collected so far. This is done
+    automatically on exit, but long-running processes can
+    call it to make partial data available earlier.
+    """
+
+    if not _profiles:
+        return
+    outdir = profile_dir()
+    os.makedirs(outdir, exist_ok=True)
+    for component, prof in _profiles.items():
+        # dump_stats() stops the profiler, so restart it if needed
+        fn = os.path.join(outdir, '%s.%d.prof' % (component, os.getpid()))
+        prof.dump_stats(fn)
+        if prof is _active:
+            prof.enable()
+
+
+def find_profiles(paths, component=None):
+    "Yields all the profile files found in the given files or dirs."
+
+    for path in paths:
+        if os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = []
+            for dirpath, _, files in os.walk(path):
+                candidates += [os.path.join(dirpath, fn) for fn in files]
+        for fn in sorted(candidates):
+            name = os.path.basename(fn)
+            if not name.endswith('.prof'):
+                continue
+            if component is None or name.split('.')[0] == component:
+                yield fn
+
+
+def summarize(paths, component=None, sort='cumulative', limit=30,
+              out=sys.stdout):
+    "Merges the given profiles per component and prints their stats."
+
+    import pstats
+
+    by_component = {}
+    for fn in find_profiles(paths, component):
+        by_component.setdefault(os.path.basename(fn).split('.')[0],
+                                []).append(fn)
+
+    if not by_component:
+        print("No profiles found.", file=out)
+        return False
+
+    for name, files in sorted(by_component.items()):
+        print("### %s (%d profiles)" % (name, len(files)), file=out)
+        stats = pstats.Stats(*files, stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return True
+
+
+def main():
+    "Main entry point."
+
+    parser = argparse.ArgumentParser(
+        description="Inspect profiles collected with PAPR_PROFILE")
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    summary = subparsers.add_parser(
+        'summarize', help="merge profiles and print the top functions")
+    summary.add_argument('paths', nargs='+', metavar='PATH',
+                         help="profile files or dirs to search for them")
+    summary.add_argument('--component', choices=COMPONENTS,
+                         help="only include this component")
+    summary.add_argument('--sort', default='cumulative',
+                         help="pstats sort key (default: cumulative)")
+    summary.add_argument('--limit', type=int, default=30,
+                         help="number of functions to print (default: 30)")
+
+    args = parser.parse_args()
+    if args.cmd == 'summarize':
+        if not summarize(args.paths, args.component, args.sort, args.limit):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
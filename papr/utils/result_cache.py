@@ -0,0 +1,71 @@
+'''
+    Cache of passing testsuite results, keyed on the parsed
+    testsuite definition and the git tree being tested. This
+    allows us to skip suites which were already run on the
+    exact same content, e.g. after a rebase which results in
+    the same tree.
+'''
+
+import os
+import json
+import time
+import hashlib
+
+CACHE_DIR = 'cache/results'
+
+# entries older than this are ignored and eventually pruned
+MAX_AGE = 7 * 24 * 60 * 60
+
+
+def cache_key(suite, repo, tree):
+    "Compute the cache key of a suite as returned by SuiteParser.parse()."
+
+    data = json.dumps([repo, tree, suite], sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def lookup(key):
+    "Returns the cached result dict for the given key, or None."
+
+    fn = os.path.join(CACHE_DIR, key + '.json')
+    try:
+        with open(fn) as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - result.get('timestamp', 0) > MAX_AGE:
+        return None
+
+    return result
+
+
+def store(key, rc, url, commit):
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    result = {'rc': rc, 'url': url, 'commit': commit,
+              'timestamp': int(time.time())}
+
+    # write atomically since other runs may be reading concurrently
+    fn = os.path.join(CACHE_DIR, key + '.json')
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(result, f)
+    os.rename(tmp, fn)
+
+
+def prune():
+    "Delete expired entries."
+
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    now = time.time()
+    for name in os.listdir(CACHE_DIR):
+        fn = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(fn) > MAX_AGE:
+                os.unlink(fn)
+        except OSError:
+            # raced with another run; that's fine
+            pass
@@ -0,0 +1,301 @@
+'''
+    Live, machine-readable status of a run in progress, so
+    that dashboards don't have to scrape the console log.
+
+    The spawner keeps state/status.json up to date while the
+    runners go, from what it knows of the suites and from the
+    files each testrunner keeps in its state dir: the phase it
+    is in, its last commit status, its timings and its nodes.
+    A status.html rendered from it is written next to it.
+
+    If s3_prefix is set, both are periodically uploaded under
+    a prefix fixed for the whole run (next to the index of the
+    'required' context):
+
+      <s3_prefix>/<repo>/<commit>.<run>/status.json
+
+    along with what the runners have written of their logs so
+    far, in suite-N/. Once a suite finishes, its 'url' points
+    to its final results as usual. Uploads happen in a thread
+    so that they never hold up the scheduling of the runners.
+'''
+
+import os
+import json
+import time
+import threading
+import traceback
+
+from glob import glob
+
+PKG_DIR = os.path.dirname(os.path.realpath(__file__))
+
+STATUS_FILE = 'state/status.json'
+HTML_FILE = 'state/status.html'
+
+# how often we rewrite the status locally and upload it
+WRITE_INTERVAL = 5
+UPLOAD_INTERVAL = 30
+
+# like the testrunner, only upload the start of huge logs
+MAX_LOG_SIZE = 5 * 1024 * 1024
+
+# in order of preference for the log to link to
+LOG_FILES = ['output.log', 'build.log', 'setup.log']
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _write(fn, data):
+    # write atomically since dashboards may be reading it
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, fn)
+
+
+def runner_status(idx):
+    "Returns the status of a runner from its state dir."
+
+    state = 'state/suite-%d' % idx
+    status = {'index': idx, 'phase': None, 'phase_started': None,
+              'status': None, 'description': None, 'phases': [],
+              'nodes': [], 'rc': None, 'url': _read(state + '/url')}
+
+    phase = _read(state + '/phase')
+    if phase:
+        name, started = phase.split()
+        status['phase'] = name
+        status['phase_started'] = float(started)
+
+    gh_status = _read(state + '/status')
+    if gh_status:
+        status['status'], _, status['description'] = gh_status.partition(' ')
+
+    timings = _read(state + '/timings')
+    for line in (timings or '').splitlines():
+        name, started, finished = line.split()
+        status['phases'].append({'name': name, 'started': float(started),
+                                 'finished': float(finished)})
+
+    # NB: host is a symlink to host-0 for clusters
+    for host in sorted(glob(state + '/host-*')) or [state + '/host']:
+        name = _read(host + '/node_name')
+        if name:
+            status['nodes'].append(name)
+    cid = _read(state + '/cid')
+    if cid:
+        status['nodes'].append('container ' + cid[:12])
+    job = _read(state + '/kube_job')
+    if job:
+        status['nodes'].append('job ' + job)
+
+    rc = _read(state + '/rc')
+    if rc:
+        status['rc'] = int(rc)
+    return status
+
+
+def format_since(now, t):
+    "Formats how long ago t was, e.g. '1h02m'."
+
+    if t is None:
+        return ''
+    mins = int(now - t) // 60
+    if mins < 60:
+        return '%dm' % mins
+    return '%dh%02dm' % (mins // 60, mins % 60)
+
+
+def suite_state(suite):
+    if 'rc' not in suite:
+        return 'running' if 'started' in suite else 'pending'
+    if suite.get('outcome') in ['skipped', 'cached', 'cancelled']:
+        return suite['outcome']
+    if 'outcome' not in suite:
+        # cancelled by fail_fast or a failed dependency before starting
+        return 'cancelled'
+    return 'passed' if suite['rc'] == 0 else 'failed'
+
+
+class RunStatus:
+    "Keeps the status files of the run up to date."
+
+    def __init__(self, suites):
+        self.suites = suites
+        self.started = time.time()
+        self.state = 'running'
+        self.required_url = None
+        self.prefix = None
+        if os.environ.get('s3_prefix'):
+            self.prefix = '%s/%s/%s.%d' % (os.environ['s3_prefix'],
+                                           os.environ['github_repo'],
+                                           os.environ['github_commit'],
+                                           # rough equivalent of date +%s%N
+                                           int(self.started * 1e9))
+        self.written = None
+        self.last_write = 0
+        self.uploaded = None
+        self.last_upload = 0
+        self.log_sizes = {}
+        self.uploader = None
+        self.s3 = None
+
+    def url(self, name='status.html'):
+        "Returns the URL of an uploaded file, if we upload them."
+        if self.prefix is None:
+            return None
+        return 'https://s3.amazonaws.com/%s/%s' % (self.prefix, name)
+
+    def manifest(self):
+        suites = []
+        for suite in self.suites:
+            runners = []
+            # once it's done, the runners' state dirs stay as they were
+            for idx in suite.get('runners', []):
+                runner = runner_status(idx)
+                runner['log_url'] = self._log_url(idx)
+                runners.append(runner)
+            suites.append({'context': suite['context'],
+                           'required': suite.get('required', False),
+                           'state': suite_state(suite),
+                           'rc': suite.get('rc'),
+                           'url': suite.get('url'),
+                           'started': suite.get('started'),
+                           'duration': suite.get('duration'),
+                           'runners': runners})
+
+        return {'repo': os.environ['github_repo'],
+                'commit': os.environ['github_commit'],
+                'branch': os.environ.get('github_branch'),
+                'pull_id': os.environ.get('github_pull_id'),
+                'url': os.environ.get('github_url'),
+                'state': self.state,
+                'started': self.started,
+                'status_url': self.url(),
+                'required_url': self.required_url,
+                'suites': suites}
+
+    def _log_url(self, idx):
+        for name in LOG_FILES:
+            if ('suite-%d/%s' % (idx, name)) in self.log_sizes:
+                return self.url('suite-%d/%s' % (idx, name))
+        return None
+
+    def update(self, force=False):
+        "Rewrites the status, and uploads it if it's time to."
+
+        now = time.time()
+        if not force and now - self.last_write < WRITE_INTERVAL:
+            return
+        self.last_write = now
+
+        # skip a round if the previous upload is still going
+        upload = (self.prefix is not None and not self._uploading() and
+                  (force or now - self.last_upload >= UPLOAD_INTERVAL))
+
+        # the status is nice to have, but not worth failing the run over
+        try:
+            manifest = self.manifest()
+            if manifest != self.written:
+                self._write(manifest)
+            if upload:
+                self.last_upload = now
+                # NB: the thread must not look at the suites, which
+                # keep changing under it
+                self.uploader = threading.Thread(target=self._upload_all,
+                                                 args=(manifest,
+                                                       self._running_logs()),
+                                                 daemon=True)
+                self.uploader.start()
+        except Exception:
+            traceback.print_exc()
+
+    def finish(self, state):
+        # make sure the final status is the last one uploaded
+        self._wait_upload()
+        self.state = state
+        self.update(force=True)
+        self._wait_upload()
+
+    def _uploading(self):
+        return self.uploader is not None and self.uploader.is_alive()
+
+    def _wait_upload(self):
+        if self.uploader is not None:
+            self.uploader.join()
+
+    def _upload_all(self, manifest, logs):
+        "Uploads what was written of the logs so far, then the status."
+
+        try:
+            for path, name in logs:
+                self._upload_log(path, name)
+            if manifest != self.uploaded:
+                self._upload(manifest)
+        except Exception:
+            traceback.print_exc()
+
+    def _write(self, manifest):
+        # only load jinja2 when we actually need it, like the spawner
+        import jinja2
+
+        run = dict(manifest, updated=time.time())
+        _write(STATUS_FILE, json.dumps(run, indent=2, sort_keys=True))
+
+        with open(os.path.join(PKG_DIR, 'status.j2')) as f:
+            tpl = jinja2.Template(f.read(), autoescape=True)
+        tpl.globals['since'] = lambda t: format_since(run['updated'], t)
+        _write(HTML_FILE, tpl.render(run=run))
+        self.written = manifest
+
+    def _upload(self, manifest):
+        with open(STATUS_FILE, 'rb') as f:
+            self._put('status.json', f.read(), 'application/json')
+        with open(HTML_FILE, 'rb') as f:
+            self._put('status.html', f.read(), 'text/html')
+        self.uploaded = manifest
+
+    def _running_logs(self):
+        "Returns the logs of running suites, as (path, name) pairs."
+
+        logs = []
+        for suite in self.suites:
+            if 'started' not in suite or 'rc' in suite:
+                continue
+            for idx in suite['runners']:
+                upload_dir = _read('state/suite-%d/upload_dir' % idx)
+                if not upload_dir:
+                    continue
+                for name in LOG_FILES:
+                    logs.append((os.path.join(upload_dir, name),
+                                 'suite-%d/%s' % (idx, name)))
+        return logs
+
+    def _upload_log(self, path, name):
+        try:
+            size = min(os.path.getsize(path), MAX_LOG_SIZE)
+        except OSError:
+            return
+        if self.log_sizes.get(name) == size:
+            return
+        with open(path, 'rb') as f:
+            data = f.read(size)
+        self._put(name, data, 'text/plain; charset=utf-8')
+        self.log_sizes[name] = size
+
+    def _put(self, name, data, type):
+        # NB: only ever used from one upload thread at a time
+        if self.s3 is None:
+            import boto3
+            self.s3 = boto3.resource("s3")
+        bucket, key = ('%s/%s' % (self.prefix, name)).split('/', 1)
+        # don't let anything cache the live status for long
+        self.s3.Object(bucket, key).put(Body=data, ContentType=type,
+                                        CacheControl='max-age=10')
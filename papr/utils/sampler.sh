@@ -0,0 +1,131 @@
+#!/bin/sh
+set -u
+
+# This script is not meant to be run manually. It is copied
+# into the test environment next to worker.sh by the
+# testrunner (if usage_sampling is set) and left running in
+# the background while the testsuite builds and runs. Every
+# INTERVAL seconds, it appends raw usage counters to CSVFILE:
+#
+#   sampler.sh INTERVAL CSVFILE
+#
+# The CSV is fetched back with the artifacts and aggregated
+# by the history module (see read_usage() in history.py).
+#
+# In containers, CPU, memory and IO come from the cgroup of
+# the container; swap and disk usage are left empty since
+# /proc and df only show those of the host. We stick to
+# POSIX sh and awk since we run in whatever image is tested.
+
+interval=$1; shift
+csv=$1; shift
+
+echo $$ > $csv.pid
+echo "time,ncpus,cpu_usec,mem_used_kb,mem_total_kb,swap_used_kb,swap_pages,disk_used_kb,io_read_kb,io_write_kb" > $csv
+
+cg=/sys/fs/cgroup
+in_container=
+if [ -f /.dockerenv ] || [ -f /run/.containerenv ]; then
+    in_container=1
+fi
+cgroup2=
+if [ -f $cg/cgroup.controllers ]; then
+    cgroup2=1
+fi
+
+meminfo() {
+    awk -v key=$1: '$1 == key { print $2 }' /proc/meminfo
+}
+
+ncpus() {
+    n=$(getconf _NPROCESSORS_ONLN)
+    # a CPU quota caps us to fewer CPUs than the host has
+    if [ -n "$in_container" ] && [ -n "$cgroup2" ] && [ -f $cg/cpu.max ]; then
+        n=$(awk -v n=$n '$1 != "max" { q = int(($1 + $2 - 1) / $2);
+                                       if (q < n) n = q } END { print n }' \
+              $cg/cpu.max)
+    fi
+    echo $n
+}
+
+cpu_usec() {
+    if [ -n "$in_container" ] && [ -n "$cgroup2" ]; then
+        awk '$1 == "usage_usec" { print $2 }' $cg/cpu.stat
+    elif [ -n "$in_container" ]; then
+        awk '{ printf "%d\n", $1 / 1000 }' $cg/cpuacct/cpuacct.usage
+    else
+        # user nice system irq softirq steal, in USER_HZ (i.e. 10ms)
+        awk '$1 == "cpu" { printf "%d\n", ($2 + $3 + $4 + $7 + $8 + $9) * 10000 }' \
+            /proc/stat
+    fi
+}
+
+# memory used, not counting the page cache which could be reclaimed
+mem_used_kb() {
+    if [ -n "$in_container" ] && [ -n "$cgroup2" ]; then
+        awk -v cur=$(cat $cg/memory.current) \
+            '$1 == "inactive_file" { printf "%d\n", (cur - $2) / 1024 }' \
+            $cg/memory.stat
+    elif [ -n "$in_container" ]; then
+        awk -v cur=$(cat $cg/memory/memory.usage_in_bytes) \
+            '$1 == "total_inactive_file" { printf "%d\n", (cur - $2) / 1024 }' \
+            $cg/memory/memory.stat
+    else
+        echo $(($(meminfo MemTotal) - $(meminfo MemAvailable)))
+    fi
+}
+
+mem_total_kb() {
+    total=$(meminfo MemTotal) limit=max
+    if [ -n "$in_container" ] && [ -n "$cgroup2" ]; then
+        limit=$(cat $cg/memory.max)
+    elif [ -n "$in_container" ]; then
+        limit=$(cat $cg/memory/memory.limit_in_bytes)
+    fi
+    if [ "$limit" != max ] && [ $((limit / 1024)) -lt $total ]; then
+        total=$((limit / 1024))
+    fi
+    echo $total
+}
+
+swap() {
+    if [ -z "$in_container" ]; then
+        echo $(($(meminfo SwapTotal) - $(meminfo SwapFree))),$(awk \
+            '$1 == "pswpin" || $1 == "pswpout" { n += $2 } END { print n }' \
+            /proc/vmstat)
+    else
+        echo ,
+    fi
+}
+
+disk_used_kb() {
+    if [ -z "$in_container" ]; then
+        df -Pk / | awk 'NR == 2 { print $3 }'
+    fi
+}
+
+io_kb() {
+    if [ -n "$in_container" ] && [ -n "$cgroup2" ] && [ -f $cg/io.stat ]; then
+        awk '{ for (i = 2; i <= NF; i++) {
+                   split($i, kv, "=");
+                   if (kv[1] == "rbytes") r += kv[2];
+                   if (kv[1] == "wbytes") w += kv[2] } }
+             END { printf "%d,%d\n", r / 1024, w / 1024 }' $cg/io.stat
+    elif [ -z "$in_container" ]; then
+        # whole physical disks only, so that nothing is counted twice;
+        # the stat fields are in 512-byte sectors
+        for dev in /sys/block/*; do
+            case ${dev##*/} in
+                loop*|ram*|zram*|dm-*|md*) ;;
+                *) cat $dev/stat ;;
+            esac
+        done | awk '{ r += $3; w += $7 } END { printf "%d,%d\n", r / 2, w / 2 }'
+    else
+        echo ,
+    fi
+}
+
+while true; do
+    echo "$(date +%s),$(ncpus),$(cpu_usec),$(mem_used_kb),$(mem_total_kb),$(swap),$(disk_used_kb),$(io_kb)" >> $csv
+    sleep $interval
+done
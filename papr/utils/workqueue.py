@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+
+'''
+    Spreads the testsuites of a run across several builders
+    (if work_queue is set). Rather than running testrunners
+    itself, the spawner then starts a proxy for each:
+
+      python3 -m papr.utils.workqueue proxy IDX
+
+    which publishes the state dir of the runner as a task in
+    the queue, a SQLite database at the path given by
+    work_queue. It must be on a filesystem shared by all the
+    builders, with working locks (e.g. NFSv4). Workers on
+    the builders claim tasks whenever they have a free slot:
+
+      papr-workqueue work --slots 4
+
+    and run the testrunner on their own checkout of the
+    tested commit, streaming its output back through the
+    queue. Once it exits, the proxy writes its rc, url,
+    timings and logs in the local state dir and exits with
+    its exit code, so that to the spawner, it's as if the
+    testrunner had run locally.
+
+    Workers take the github_* variables describing the run
+    from the task, and all the others (credentials, s3_prefix,
+    etc...) from their own environment.
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import fcntl
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import tarfile
+import argparse
+import threading
+import traceback
+import contextlib
+import subprocess
+
+from papr import PKG_DIR
+
+# dirs of the worker, relative to its cwd
+TASKS_DIR = 'tasks'
+TREES_DIR = 'trees'
+MIRRORS_DIR = 'checkouts'
+
+# directories shared by all the tasks of a worker
+SHARED_DIRS = ['cache', 'cluster_keypair']
+
+# variables describing the run, passed on to the worker
+TASK_VARS = ['github_repo', 'github_branch', 'github_pull_id',
+             'github_commit', 'github_url', 'BUILD_ID', 'PAPR_PROFILE']
+TASK_VAR_PREFIXES = ('PAPR_DEBUG_', 'RHCI_DEBUG_')
+
+# files of the global state dir the testrunner reads
+STATE_FILES = ['sha', 'is_merge_sha', 'pull_target_branch']
+
+# files of the runner state dir sent back, along with the
+# top-level files (i.e. logs) of the upload dir
+RESULT_FILES = ['rc', 'url', 'timings', 'usage.csv', 'upload_dir',
+                'transient']
+
+POLL_INTERVAL = 1
+HEARTBEAT_INTERVAL = 10
+
+# running tasks whose worker wasn't heard from in this long are lost
+# (NB: this includes the initial clone of the repo)
+LOST_TIMEOUT = 15 * 60
+
+# finished tasks and unused checkouts are deleted after this long
+MAX_AGE = 24 * 60 * 60
+PRUNE_INTERVAL = 60 * 60
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        repo TEXT NOT NULL,
+        runner INTEGER NOT NULL,
+        -- what to fetch, and the tree to check out
+        ref TEXT NOT NULL,
+        sha TEXT NOT NULL,
+        env TEXT NOT NULL,
+        state_tar BLOB,
+        -- one of queued, running, done, cancelled or lost
+        state TEXT NOT NULL DEFAULT 'queued',
+        cancel INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        heartbeat REAL,
+        rc INTEGER,
+        results BLOB,
+        created REAL NOT NULL,
+        started REAL,
+        finished REAL
+    );
+    CREATE TABLE IF NOT EXISTS output (
+        task INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (task, seq)
+    );
+'''
+
+
+def enabled():
+    "Whether suites should be run through the work queue."
+    return len(os.environ.get('work_queue', '')) > 0
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+    return args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="PAPR work queue")
+    parser.add_argument('--queue', default=os.environ.get('work_queue'),
+                        required=not enabled(), metavar='PATH',
+                        help="path of the queue database (default: "
+                        "$work_queue)")
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    proxy = subparsers.add_parser('proxy', help="run a testrunner through "
+                                  "the queue (called by the spawner)")
+    proxy.add_argument('runner', type=int, help="index of the runner")
+    proxy.set_defaults(func=cmd_proxy)
+
+    work = subparsers.add_parser('work', help="run queued testrunners")
+    work.add_argument('--slots', type=int, default=4, metavar='N',
+                      help="maximum number of testrunners to run at once")
+    work.add_argument('--name', help="name of the worker (default: "
+                      "<hostname>:<cwd>)")
+    work.set_defaults(func=cmd_work)
+
+    ls = subparsers.add_parser('list', help="list tasks")
+    ls.add_argument('--limit', type=int, default=20, metavar='N',
+                    help="list at most the last N tasks")
+    ls.set_defaults(func=cmd_list)
+
+    return parser.parse_args()
+
+
+def open_db(path):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # proxies and workers all over the place write to it
+    db = sqlite3.connect(path, timeout=60, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+def cmd_list(args):
+    db = open_db(args.queue)
+    for task in db.execute("SELECT id, repo, runner, state, worker, rc "
+                           "FROM tasks ORDER BY id DESC LIMIT ?",
+                           (args.limit,)):
+        rc = '' if task['rc'] is None else 'rc=%d' % task['rc']
+        print("%d\t%s\t%d\t%s\t%s\t%s" % (task['id'], task['repo'],
+                                          task['runner'], task['state'],
+                                          task['worker'] or '', rc))
+    return 0
+
+
+def cmd_proxy(args):
+    db = open_db(args.queue)
+    task_id = publish(db, args.runner)
+    print("INFO: queued runner %d as task %d" % (args.runner, task_id))
+
+    # the spawner kills us to stop the run; pass it on
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+
+    out = sys.stdout.buffer
+    seq = 0
+    cancelled = False
+    while True:
+        task = db.execute("SELECT state, worker, heartbeat FROM tasks "
+                          "WHERE id = ?", (task_id,)).fetchone()
+        for row in db.execute("SELECT seq, data FROM output WHERE "
+                              "task = ? AND seq > ? ORDER BY seq",
+                              (task_id, seq)):
+            out.write(row['data'])
+            seq = row['seq']
+        out.flush()
+
+        if task['state'] not in ['queued', 'running']:
+            break
+
+        if stopping and not cancelled:
+            cancel(db, task_id)
+            cancelled = True
+        elif (task['state'] == 'running' and
+                time.time() - task['heartbeat'] > LOST_TIMEOUT):
+            db.execute("UPDATE tasks SET state = 'lost' WHERE id = ? "
+                       "AND state = 'running'", (task_id,))
+
+        time.sleep(POLL_INTERVAL)
+
+    task = db.execute("SELECT * FROM tasks WHERE id = ?",
+                      (task_id,)).fetchone()
+    rc = 1
+    if task['state'] == 'done':
+        if task['results'] is not None:
+            extract(task['results'], 'state')
+        rc = task['rc']
+    else:
+        print("ERROR: task %d %s (worker: %s)" %
+              (task_id, task['state'], task['worker']))
+
+    # we're the only one who needed those
+    db.execute("UPDATE tasks SET state_tar = NULL, results = NULL "
+               "WHERE id = ?", (task_id,))
+    db.execute("DELETE FROM output WHERE task = ?", (task_id,))
+    return rc
+
+
+def publish(db, idx):
+    "Add the runner of index idx as a new task and return its id."
+
+    env = {var: val for var, val in os.environ.items()
+           if var in TASK_VARS or var.startswith(TASK_VAR_PREFIXES)}
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        tar.add('state/suite-%d' % idx, arcname='suite-%d' % idx)
+        for fn in STATE_FILES:
+            path = os.path.join('state', fn)
+            if os.path.exists(path):
+                tar.add(path, arcname=fn)
+
+    with open('state/sha') as f:
+        sha = f.read().strip()
+
+    cur = db.execute("INSERT INTO tasks (repo, runner, ref, sha, env, "
+                     "state_tar, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (os.environ['github_repo'], idx, fetch_ref(), sha,
+                      json.dumps(env), buf.getvalue(), time.time()))
+    return cur.lastrowid
+
+
+def fetch_ref():
+    "The ref main fetched to get the tested commit."
+
+    if os.environ.get('github_branch'):
+        return os.environ['github_branch']
+    if os.path.isfile('state/is_merge_sha'):
+        return 'refs/pull/%s/merge' % os.environ['github_pull_id']
+    return 'refs/pull/%s/head' % os.environ['github_pull_id']
+
+
+def cancel(db, task_id):
+    db.execute('BEGIN IMMEDIATE')
+    db.execute("UPDATE tasks SET state = 'cancelled' WHERE id = ? "
+               "AND state = 'queued'", (task_id,))
+    # if it's already running, the worker will kill it (which
+    # tears down its environment as usual)
+    db.execute("UPDATE tasks SET cancel = 1 WHERE id = ?", (task_id,))
+    db.execute('COMMIT')
+
+
+def extract(data, dest):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(dest, filter='data')
+        else:
+            tar.extractall(dest)
+
+
+def cmd_work(args):
+    name = args.name or '%s:%s' % (socket.gethostname(), os.getcwd())
+
+    db = open_db(args.queue)
+    # tasks we were running when a previous worker died
+    db.execute("UPDATE tasks SET state = 'lost' "
+               "WHERE state = 'running' AND worker = ?", (name,))
+
+    for d in SHARED_DIRS + [TASKS_DIR, TREES_DIR, MIRRORS_DIR]:
+        os.makedirs(d, exist_ok=True)
+
+    threads = []
+    last_prune = 0
+    while True:
+        threads = [t for t in threads if t.is_alive()]
+        while len(threads) < args.slots:
+            task = claim_task(db, name)
+            if task is None:
+                break
+            print("INFO: running task %d (%s runner %d)" %
+                  (task['id'], task['repo'], task['runner']))
+            t = threading.Thread(target=run_task, args=(args.queue, task))
+            t.start()
+            threads.append(t)
+
+        if time.time() - last_prune > PRUNE_INTERVAL:
+            prune(db)
+            last_prune = time.time()
+
+        time.sleep(2)
+
+
+def claim_task(db, name):
+    "Mark the oldest queued task as ours and return it."
+
+    db.execute('BEGIN IMMEDIATE')
+    # the spawner queues them in the order it wants them started
+    task = db.execute("SELECT * FROM tasks WHERE state = 'queued' "
+                      "ORDER BY id LIMIT 1").fetchone()
+    if task is not None:
+        now = time.time()
+        db.execute("UPDATE tasks SET state = 'running', worker = ?, "
+                   "started = ?, heartbeat = ? WHERE id = ?",
+                   (name, now, now, task['id']))
+    db.execute('COMMIT')
+    return task
+
+
+class Output:
+    "Buffers the output of a task and appends it to the queue."
+
+    def __init__(self, db, task_id):
+        self.db = db
+        self.task_id = task_id
+        self.seq = 0
+        self.buf = b''
+        self.last_flush = time.time()
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= 65536:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.seq += 1
+            self.db.execute("INSERT INTO output VALUES (?, ?, ?)",
+                            (self.task_id, self.seq, self.buf))
+            self.buf = b''
+        self.last_flush = time.time()
+
+
+def run_task(queue, task):
+    db = open_db(queue)
+    out = Output(db, task['id'])
+    rc, results = 1, None
+    try:
+        task_dir = prepare_task(task, out)
+        rc = run_testrunner(db, task, task_dir, out)
+        results = pack_results(task_dir, task['runner'])
+    except Exception:
+        # shows up in the runner log on the other side
+        out.write(traceback.format_exc().encode('utf-8'))
+        traceback.print_exc()
+    out.flush()
+
+    print("INFO: task %d exited with rc %d" % (task['id'], rc))
+    db.execute("UPDATE tasks SET state = 'done', rc = ?, results = ?, "
+               "finished = ? WHERE id = ? AND state = 'running'",
+               (rc, results, time.time(), task['id']))
+    db.close()
+
+
+def prepare_task(task, out):
+    "Set up the dir to run the testrunner of a task from."
+
+    task_dir = os.path.join(TASKS_DIR, str(task['id']))
+    os.makedirs(task_dir)
+    extract(task['state_tar'], os.path.join(task_dir, 'state'))
+
+    # like main, the testrunner works relative to its cwd
+    for d in SHARED_DIRS:
+        os.symlink(os.path.abspath(d), os.path.join(task_dir, d))
+
+    tree = checkout_tree(task['repo'], task['ref'], task['sha'], out)
+    checkout = os.path.join(task_dir, 'checkouts', task['repo'])
+    os.makedirs(os.path.dirname(checkout))
+    os.symlink(os.path.abspath(tree), checkout)
+    return task_dir
+
+
+@contextlib.contextmanager
+def locked(path):
+    with open(path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def git(out, *args):
+    p = subprocess.run(['git'] + list(args), stdin=subprocess.DEVNULL,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out.write(p.stdout)
+    p.check_returncode()
+
+
+def checkout_tree(repo, ref, sha, out):
+    """
+    Returns the path of a checkout of the tested commit. We
+    keep one per commit since tasks of different commits may
+    run at the same time, and share them between suites.
+    """
+
+    mirror = os.path.join(MIRRORS_DIR, repo)
+    tree = os.path.join(TREES_DIR, repo, sha)
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    os.makedirs(os.path.dirname(tree), exist_ok=True)
+
+    with locked(tree + '.lock'):
+        if not os.path.isdir(tree):
+            with locked(mirror + '.lock'):
+                if not os.path.isdir(mirror):
+                    git(out, 'clone', '-q', '--bare',
+                        'https://github.com/%s' % repo, mirror)
+                git(out, '-C', mirror, 'fetch', '-q', 'origin', ref)
+                # the ref may have moved on since main fetched it
+                if subprocess.call(['git', '-C', mirror, 'cat-file', '-e',
+                                    sha + '^{commit}'],
+                                   stderr=subprocess.DEVNULL) != 0:
+                    git(out, '-C', mirror, 'fetch', '-q', 'origin', sha)
+                # keep it from being garbage collected
+                git(out, '-C', mirror, 'update-ref', 'refs/papr/' + sha, sha)
+
+            tmp = tree + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            # local clones hardlink all the objects, so this is cheap
+            git(out, 'clone', '-q', '--no-checkout', mirror, tmp)
+            git(out, '-C', tmp, 'checkout', '-q', sha)
+            git(out, '-C', tmp, 'remote', 'set-url', 'origin',
+                'https://github.com/%s' % repo)
+            os.rename(tmp, tree)
+        # keep it alive while we use it
+        os.utime(tree)
+
+    return tree
+
+
+def run_testrunner(db, task, task_dir, out):
+    "Run the testrunner of a task and return its exit code."
+
+    env = dict(os.environ)
+    for var in TASK_VARS:
+        env.pop(var, None)
+    env.update(json.loads(task['env']))
+
+    # its own process group, like in the spawner
+    p = subprocess.Popen([os.path.join(PKG_DIR, 'testrunner'),
+                          str(task['runner'])],
+                         cwd=task_dir, env=env, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+
+    fd = p.stdout.fileno()
+    killed = False
+    last_beat = time.time()
+    while True:
+        if select.select([fd], [], [], POLL_INTERVAL)[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            out.write(data)
+        if time.time() - out.last_flush >= POLL_INTERVAL:
+            out.flush()
+
+        if time.time() - last_beat > HEARTBEAT_INTERVAL:
+            last_beat = time.time()
+            db.execute("UPDATE tasks SET heartbeat = ? WHERE id = ?",
+                       (last_beat, task['id']))
+            row = db.execute("SELECT cancel FROM tasks WHERE id = ?",
+                             (task['id'],)).fetchone()
+            if row['cancel'] and not killed:
+                print("INFO: cancelling task %d" % task['id'])
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                killed = True
+
+    p.stdout.close()
+    return p.wait()
+
+
+def pack_results(task_dir, idx):
+    "Returns a tarball of what the spawner needs from the state dir."
+
+    state = os.path.join(task_dir, 'state')
+
+    def add(tar, path):
+        tar.add(os.path.join(state, path), arcname=path)
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for fn in RESULT_FILES:
+            path = os.path.join('suite-%d' % idx, fn)
+            if os.path.isfile(os.path.join(state, path)):
+                add(tar, path)
+
+        if os.path.isdir(os.path.join(state, 'suite-%d' % idx, 'profiles')):
+            add(tar, os.path.join('suite-%d' % idx, 'profiles'))
+
+        fn = os.path.join(state, 'suite-%d' % idx, 'upload_dir')
+        if os.path.isfile(fn):
+            with open(fn) as f:
+                # NB: it's relative to the task dir
+                upload_dir = os.path.join(task_dir, f.read().strip())
+            for name in os.listdir(upload_dir):
+                path = os.path.join(upload_dir, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    add(tar, os.path.relpath(path, state))
+
+    return buf.getvalue()
+
+
+def prune(db):
+    "Delete old task dirs, checkouts and queue entries."
+
+    cutoff = time.time() - MAX_AGE
+    for name in os.listdir(TASKS_DIR):
+        path = os.path.join(TASKS_DIR, name)
+        if os.stat(path).st_mtime < cutoff:
+            # NB: files copied out of containers may be owned by root
+            shutil.rmtree(path, ignore_errors=True)
+
+    for dirpath, dirnames, _ in os.walk(TREES_DIR):
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            # trees are the dirs named after a commit
+            if len(name) != 40 or name.endswith('.tmp'):
+                continue
+            dirnames.remove(name)
+            with locked(path + '.lock'):
+                if os.stat(path).st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    # e.g. the proxy was killed before it could clean up
+    db.execute("DELETE FROM output WHERE task IN (SELECT id FROM tasks "
+               "WHERE created < ? AND state NOT IN ('queued', 'running'))",
+               (cutoff,))
+    db.execute("DELETE FROM tasks WHERE created < ? AND state NOT IN "
+               "('queued', 'running')", (cutoff,))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,11 @@ setup(
     version="0.1",
     packages=find_packages(),
     entry_points={
-        "console_scripts": ["papr = papr:main"],
+        "console_scripts": ["papr = papr:main",
+                            "papr-service = papr.service:main",
+                            "papr-history = papr.utils.history:main",
+                            "papr-profile = papr.utils.profiling:main",
+                            "papr-workqueue = papr.utils.workqueue:main"],
     },
     # just copy the bash scripts for now until they're fully ported over
     package_data={"papr": ["main", "testrunner", "provisioner"],
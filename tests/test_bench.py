@@ -0,0 +1,107 @@
+'''
+    End-to-end tests of whole runs against the fake backends
+    of the benchmark harness (see bench/README.md).
+'''
+
+import os
+import sys
+import json
+import subprocess
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+RUN = os.path.join(TOP_DIR, 'bench', 'run.py')
+
+
+def bench(tmp_path, *args):
+    "Runs the benchmark with the given options and returns its results."
+
+    p = subprocess.run([sys.executable, RUN, '--json',
+                        '--workdir', str(tmp_path)] + list(args),
+                       cwd=str(tmp_path), stdout=subprocess.PIPE,
+                       universal_newlines=True)
+    return json.loads(p.stdout)
+
+
+def read_log(result):
+    with open(os.path.join(result['rundir'], 'output.log')) as f:
+        return f.read()
+
+
+def s3_files(result):
+    "Returns the paths of all the files in the fake S3."
+
+    root = os.path.join(result['rundir'], 'bench-state', 's3')
+    return [os.path.relpath(os.path.join(d, fn), root)
+            for d, _, fns in os.walk(root) for fn in fns]
+
+
+def test_containers(tmp_path):
+    result, = bench(tmp_path, '--suites', '3')
+    assert result['rc'] == 0
+    assert result['failures'] == 0
+    assert result['calls']['docker run'] == 3
+    assert result['github_calls']['POST statuses'] > 0
+
+
+def test_failures(tmp_path):
+    result, = bench(tmp_path, '--suites', '2', '--test-cmd', 'false')
+    assert result['failures'] == 2
+
+
+def test_hosts(tmp_path):
+    result, = bench(tmp_path, '--suites', '2', '--env', 'host')
+    assert result['rc'] == 0
+    assert result['failures'] == 0
+    assert result['calls']['nova servers.create'] == 2
+    assert result['calls']['nova servers.delete'] == 2
+
+
+def test_cluster(tmp_path):
+    result, = bench(tmp_path, '--suites', '1', '--env', 'cluster',
+                    '--cluster-size', '3')
+    assert result['rc'] == 0
+    assert result['failures'] == 0
+    assert result['calls']['nova servers.create'] == 3
+
+
+def test_kube(tmp_path):
+    result, = bench(tmp_path, '--suites', '3', '--kube')
+    assert result['rc'] == 0
+    assert result['failures'] == 0
+    assert result['calls']['kube POST jobs'] == 3
+    assert result['calls']['kube DELETE jobs'] == 3
+    assert 'docker run' not in result['calls']
+
+
+def test_ostree_image_cache(tmp_path):
+    result, = bench(tmp_path, '--suites', '3', '--env', 'host',
+                    '--ostree', '27.5', '--var', 'os_image_cache=1',
+                    '--var', 'max_runners=1')
+    assert result['rc'] == 0
+    assert result['failures'] == 0
+    # the first node is snapshotted, the next ones boot from it
+    assert result['calls']['nova servers.create_image'] == 1
+    assert read_log(result).count('INFO: using cached image') == 2
+
+
+def test_artifact_blobs(tmp_path):
+    result, = bench(tmp_path, '--suites', '3', '--artifacts', '3', '--s3',
+                    '--var', 's3_blobs=1')
+    assert result['rc'] == 0
+    assert result['failures'] == 0
+
+    # all the suites have the same artifacts, so they're only stored once
+    files = s3_files(result)
+    blobs = [f for f in files if '/blobs/' in f]
+    assert len(blobs) == 3
+
+    manifests = [f for f in files if f.endswith('/manifest.json')]
+    assert len(manifests) == 3
+    root = os.path.join(result['rundir'], 'bench-state', 's3')
+    for manifest in manifests:
+        with open(os.path.join(root, manifest)) as f:
+            entries = json.load(f)['files'].values()
+        # blob keys are relative to the repo dir, next to the suite dirs
+        repo_dir = os.path.dirname(os.path.dirname(manifest))
+        assert sorted(os.path.join(repo_dir, e['blob'])
+                      for e in entries) == sorted(blobs)
@@ -0,0 +1,23 @@
+'''
+    Import time budgets of the entry points of each run
+    (see bench/importtime.py).
+'''
+
+import os
+import sys
+import statistics
+
+import pytest
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(TOP_DIR, 'bench'))
+
+import importtime  # noqa: E402
+
+
+@pytest.mark.parametrize('module,path,budget,forbidden',
+                         importtime.ENTRY_POINTS)
+def test_importtime(module, path, budget, forbidden):
+    times, loaded = importtime.measure(module, path, 3)
+    assert loaded.isdisjoint(forbidden)
+    assert statistics.median(times) <= budget
@@ -0,0 +1,72 @@
+'''
+    Tests of the LRU pruning of ostree snapshots, against the
+    fake novaclient of the benchmark harness.
+'''
+
+import os
+import sys
+import tempfile
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(TOP_DIR, 'bench', 'fakes'))
+sys.path.insert(0, os.path.join(TOP_DIR, 'papr', 'utils'))
+# the fake novaclient keeps its state there, though we don't use it
+os.environ.setdefault('PAPR_BENCH_STATE', tempfile.mkdtemp())
+
+import os_image_cache  # noqa: E402
+
+
+class Image:
+
+    def __init__(self, name, last_used, ours=True):
+        self.name = name
+        self.status = 'ACTIVE'
+        self.metadata = {}
+        if ours:
+            self.metadata = {os_image_cache.KEY: name,
+                             os_image_cache.LAST_USED: str(last_used)}
+
+
+class Images:
+
+    def __init__(self, images):
+        self.images = images
+        self.deleted = []
+
+    def list(self):
+        return list(self.images)
+
+    def delete(self, image):
+        self.deleted.append(image.name)
+        self.images.remove(image)
+
+    def set_meta(self, image, metadata):
+        image.metadata.update(metadata)
+
+
+class Nova:
+
+    def __init__(self, images):
+        self.images = Images(images)
+
+
+def test_prune_keeps_most_recently_used():
+    nova = Nova([Image('a', 30), Image('b', 10), Image('c', 20),
+                 Image('base', 0, ours=False)])
+    os_image_cache.prune(nova, 2)
+    assert nova.images.deleted == ['b']
+
+
+def test_lookup_marks_used():
+    nova = Nova([Image('a', 30), Image('b', 10)])
+    assert os_image_cache.lookup(nova, 'b').name == 'b'
+    assert int(nova.images.images[1].metadata[os_image_cache.LAST_USED]) > 30
+    # so it's kept over the other one now
+    os_image_cache.prune(nova, 1)
+    assert nova.images.deleted == ['a']
+
+
+def test_lookup_skips_unsaved():
+    image = Image('a', 30)
+    image.status = 'SAVING'
+    assert os_image_cache.lookup(Nova([image]), 'a') is None
@@ -3,24 +3,236 @@
 '''
     Simple script to validate a YAML file.
     Usage: ./validator.py /my/github/project/.papr.yml
+
+    Many files can be validated at once, e.g. to check a
+    schema change against all the repos we monitor before
+    rolling it out. Paths may be files, dirs containing a
+    PAPR file, or globs. They're validated in parallel and
+    a summary (or JSON with --json) is printed instead:
+
+      ./validator.py --json 'repos/*' > results.json
+
+    With --output-dir, the flushed suites of each file are
+    kept so that a later run can be compared against them:
+
+      ./validator.py --output-dir before 'repos/*'
+      ./validator.py --diff-against before 'repos/*'
 '''
 
 import os
+import sys
+import json
+import glob
+import time
 import pprint
+import shutil
 import argparse
+import tempfile
+import traceback
+import multiprocessing
 import papr.utils.parser as parser
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument('yml_file', help="YAML file to parse and validate")
-argparser.add_argument('--output-dir', metavar="DIR",
-                       help="directory to which to flush suites if desired")
-args = argparser.parse_args()
-
-suite_parser = parser.SuiteParser(args.yml_file)
-for idx, suite in enumerate(suite_parser.parse()):
-    print("INFO: validated suite %d" % idx)
-    pprint.pprint(suite, indent=4)
-    if args.output_dir:
-        suite_dir = os.path.join(args.output_dir, str(idx))
-        parser.flush_suite(suite, suite_dir)
-        print("INFO: flushed to %s" % suite_dir)
+# same names and order as the spawner
+YML_NAMES = ['.papr.yml', '.papr.yaml', '.redhat-ci.yml']
+
+
+def main():
+    "Main entry point."
+
+    args = parse_args()
+
+    files = expand_paths(args.yml_files)
+    if not files:
+        print("ERROR: no YAML files found", file=sys.stderr)
+        return 1
+
+    batch = (len(files) > 1 or len(args.yml_files) > 1 or args.json
+             or args.diff_against is not None)
+    if not batch:
+        validate_one(files[0], args.output_dir)
+        return 0
+
+    return validate_batch(files, args)
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('yml_files', nargs='+', metavar='yml_file',
+                           help="YAML file to parse and validate, or dir "
+                           "containing one, or glob")
+    argparser.add_argument('--output-dir', metavar="DIR",
+                           help="directory to which to flush suites if "
+                           "desired")
+    argparser.add_argument('--diff-against', metavar="DIR",
+                           help="compare flushed suites with those of a "
+                           "previous run with --output-dir DIR")
+    argparser.add_argument('--json', action='store_true',
+                           help="print results as JSON")
+    argparser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                           metavar='N', help="number of files to validate "
+                           "in parallel (default: number of CPUs)")
+    return argparser.parse_args()
+
+
+def expand_paths(paths):
+    "Resolve dirs and globs into a list of YAML files."
+
+    files = []
+    for path in paths:
+        matches = sorted(glob.glob(path, recursive=True))
+        # keep non-existent paths so they're reported as errors
+        for match in matches or [path]:
+            if os.path.isdir(match):
+                for name in YML_NAMES:
+                    if os.path.isfile(os.path.join(match, name)):
+                        files.append(os.path.join(match, name))
+                        break
+            else:
+                files.append(match)
+    return files
+
+
+def validate_one(yml_file, output_dir):
+    "Validate a single file and print its suites (the original mode)."
+
+    suite_parser = parser.SuiteParser(yml_file)
+    for idx, suite in enumerate(suite_parser.parse()):
+        print("INFO: validated suite %d" % idx)
+        pprint.pprint(suite, indent=4)
+        if output_dir:
+            for suite_dir in flush(suite, idx, output_dir):
+                print("INFO: flushed to %s" % suite_dir)
+
+
+def flush(suite, idx, output_dir):
+    "Flush all the shards of a suite, yielding their dirs."
+
+    for shard in range(suite.get('shards', 1)):
+        suite_dir = os.path.join(output_dir, str(idx))
+        if shard > 0:
+            suite_dir += '.%d' % shard
+        parser.flush_suite(suite, suite_dir, shard)
+        yield suite_dir
+
+
+def flush_key(yml_file):
+    "Path under the output dir at which to flush the suites of a file."
+
+    # make sure we stay under the output dir
+    parts = os.path.normpath(yml_file).split(os.sep)
+    return os.path.join(*[p if p != '..' else '__' for p in parts if p])
+
+
+def validate_file(job):
+    "Validate a file in a worker. Returns a JSON-able result."
+
+    yml_file, output_dir, diff_against = job
+
+    # NB: suites stays None for invalid files, to tell them apart from
+    # valid files without any suites
+    result = {'file': yml_file, 'valid': False, 'suites': None,
+              'error': None, 'suite_idx': None}
+    start = time.perf_counter()
+    try:
+        # the schema is loaded on first use and then reused by the worker
+        suite_parser = parser.SuiteParser(yml_file)
+        suites = list(suite_parser.parse())
+        if output_dir is not None:
+            outdir = os.path.join(output_dir, flush_key(yml_file))
+            # support re-using the same output dir
+            shutil.rmtree(outdir, ignore_errors=True)
+            for idx, suite in enumerate(suites):
+                for _ in flush(suite, idx, outdir):
+                    pass
+        result['valid'] = True
+        result['suites'] = len(suites)
+    except parser.ParserError as e:
+        result['error'] = e.msg
+        result['suite_idx'] = e.suite_idx
+    except Exception as e:
+        # e.g. missing file; still report it rather than failing the batch
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['secs'] = round(time.perf_counter() - start, 4)
+
+    if diff_against is not None and result['valid']:
+        key = flush_key(yml_file)
+        outdir = os.path.join(output_dir, key)
+        result['diff'] = diff_dirs(os.path.join(diff_against, key), outdir)
+
+    return result
+
+
+def read_tree(dir):
+    "Returns a dict of relative path -> contents of all files in a dir."
+
+    tree = {}
+    for dirpath, _, files in os.walk(dir):
+        for fn in files:
+            path = os.path.join(dirpath, fn)
+            with open(path, 'rb') as f:
+                tree[os.path.relpath(path, dir)] = f.read()
+    return tree
+
+
+def diff_dirs(old_dir, new_dir):
+    "Compare two flushed output dirs of the same file."
+
+    old = read_tree(old_dir)
+    new = read_tree(new_dir)
+    return {'added': sorted(set(new) - set(old)),
+            'removed': sorted(set(old) - set(new)),
+            'changed': sorted(k for k in set(old) & set(new)
+                              if old[k] != new[k])}
+
+
+def validate_batch(files, args):
+
+    output_dir = args.output_dir
+    tmpdir = None
+    if args.diff_against is not None and output_dir is None:
+        output_dir = tmpdir = tempfile.mkdtemp(prefix='papr-validator-')
+
+    jobs = [(fn, output_dir, args.diff_against) for fn in files]
+    start = time.perf_counter()
+    try:
+        with multiprocessing.Pool(max(1, args.jobs)) as pool:
+            results = list(pool.imap(validate_file, jobs, chunksize=4))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    secs = time.perf_counter() - start
+
+    invalid = [r for r in results if not r['valid']]
+    changed = [r for r in results if any(r.get('diff', {}).values())]
+
+    if args.json:
+        json.dump({'files': results,
+                   'summary': {'total': len(results),
+                               'invalid': len(invalid),
+                               'changed': len(changed),
+                               'secs': round(secs, 3)}},
+                  sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            print_result(r)
+        print("INFO: validated %d files in %.2fs: %d invalid, %d changed"
+              % (len(results), secs, len(invalid), len(changed)))
+
+    return 1 if invalid else 0
+
+
+def print_result(r):
+    if r['valid']:
+        print("OK: %s (%d suites, %.3fs)"
+              % (r['file'], r['suites'], r['secs']))
+    else:
+        print("INVALID: %s: %s" % (r['file'], r['error']))
+    for kind in ['added', 'removed', 'changed']:
+        for path in r.get('diff', {}).get(kind, []):
+            print("  %s: %s" % (kind, path))
+
+
+if __name__ == '__main__':
+    sys.exit(main())